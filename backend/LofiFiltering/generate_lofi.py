@@ -2,6 +2,11 @@ import subprocess
 import os
 import sys
 import uuid
+import shutil
+import argparse
+import tempfile
+import time
+import threading
 from pathlib import Path
 
 # Hardcoded Paths 
@@ -10,55 +15,258 @@ SOUNDFONT_PATH = BASE_DIR / "soundfonts" / "undertale.sf2"
 MIDI_INPUT     = BASE_DIR.parent / "MusicTransformer-Pytorch" / "songs" / "rand.mid"
 OUTPUT_DIR     = BASE_DIR / "lofi_songs"
 
-def main():
-    # Prep
-    out_dir = Path(OUTPUT_DIR)
-    out_dir.mkdir(parents=True, exist_ok=True)
+LOFI_FILTER    = "aresample=8000,lowpass=f=3000,highpass=f=100,volume=0.8" # Lofi Filtering
+MP3_QUALITY    = "4" # for quality, 0 - 9, where lower is better. Choose middle for now
+SAMPLE_RATE    = 44100 # FluidSynth output rate (before the filter resamples it)
+LOFI_RATE      = 8000 # output rate of the lo-fi chain (aresample=8000)
 
-    sf2 = Path(SOUNDFONT_PATH)
-    mid = Path(MIDI_INPUT)
+def generate_lofi(midi_file, mp3_file, workdir=None, on_stage=None, effects=None, synth=None) -> Path:
+    """
+    Renders midi_file to a lo-fi MP3 at mp3_file in a single pass.
 
-    # Unique filenames per run
-    song_id      = uuid.uuid4().hex # Make random Universally unique ID for song
-    wav_file     = out_dir / f"{song_id}.wav"
-    filtered_wav = out_dir / f"{song_id}_lofi.wav"
-    mp3_file     = out_dir / f"{song_id}_lofi.mp3"
+    FluidSynth writes raw PCM into a named pipe that one ffmpeg process reads, filters and
+    encodes as it arrives, so synthesis, filtering and encoding overlap and the MP3 is the only
+    file written. The pipe lives in workdir (a fresh temp folder if not given). on_stage, if given,
+    is called with "render" when the pipeline starts and "encode" once synthesis is done.
+
+    If effects is given (a dict of LofiFilter options from lofi_dsp.py, e.g. {"wow_ms": 2.0}),
+    the lo-fi chain and the extra effects run in Python between the pipe and ffmpeg, which then
+    only encodes.
+
+    If synth is given (a resident SynthPool from synth.py, or a PianoRenderer from piano.py), the
+    MIDI is rendered in process with its already loaded SoundFont and the PCM is written straight
+    to ffmpeg, without starting fluidsynth or creating the pipe.
+    """
+    mp3_file = Path(mp3_file)
+    if synth is not None:
+        return _generate_lofi_resident(midi_file, mp3_file, synth, on_stage, effects)
 
+    # Built before anything starts, so bad effect options fail here rather than in the DSP thread
+    lofi = None
+    if effects is not None:
+        from lofi_dsp import LofiFilter
+        lofi = LofiFilter(SAMPLE_RATE, 2, LOFI_RATE, **effects)
+
+    own_dir  = workdir is None
+    workdir  = Path(tempfile.mkdtemp(prefix="lofi_")) if own_dir else Path(workdir)
+    pcm_pipe = workdir / f"{mp3_file.stem}.pcm"
+    os.mkfifo(pcm_pipe)
+
+    def stage(name):
+        if on_stage is not None:
+            on_stage(name)
+
+    encoder = renderer = dsp = None
     try:
-        print("🎹 Rendering MIDI to WAV with FluidSynth...", flush=True)
-        # fluidsynth -F <out.wav> <soundfont.sf2> <input.mid>
-        # -F, Render MIDI file into raw audio data and store in file (wav)
-        # Use soundfont (undertale) and MIDI file
-        subprocess.run([
+        stage("render")
+        print("🎹 Rendering MIDI through lo-fi filtering to MP3...", flush=True)
+        source = pcm_pipe if effects is None else "pipe:0"
+        encoder = subprocess.Popen(_encoder_command(source, mp3_file, effects),
+                                   stdin=(None if effects is None else subprocess.PIPE))
+        if effects is not None:
+            dsp = _start_dsp(pcm_pipe, encoder.stdin, lofi)
+        # -F with -T raw: render the MIDI as raw 16 bit little endian stereo into the pipe
+        renderer = subprocess.Popen([
             "fluidsynth",
-            "-F", str(wav_file), 
-            str(sf2),
-            str(mid)
-        ], check=True)
-
-        print("🎧 Applying lo-fi filtering with ffmpeg...", flush=True)
-        subprocess.run([
-            "ffmpeg",
-            "-y",
-            "-i", str(wav_file),
-            "-af", "aresample=8000,lowpass=f=3000,highpass=f=100,volume=0.8", # Lofi Filtering
-            str(filtered_wav)
-        ], check=True)
-
-        print("🎶 Converting to MP3...", flush=True)
-        subprocess.run([
-            "ffmpeg",
-            "-y", # Overwrite output files, takes away prompting issue
-            "-i", str(filtered_wav), #infile 
-            "-codec:a", "libmp3lame", # basic audio codec
-            "-qscale:a", "4", # for quality, 0 - 9, where lower is better. Choose middle for now
-            str(mp3_file) # output file
-        ], check=True)
+            "-ni",
+            "-F", str(pcm_pipe),
+            "-T", "raw", "-O", "s16", "-E", "little",
+            "-r", str(SAMPLE_RATE),
+            str(SOUNDFONT_PATH),
+            str(midi_file)
+        ], stdout=subprocess.DEVNULL)
+
+        # Whichever side fails first must not leave the other blocked on the pipe
+        while renderer.poll() is None:
+            if encoder.poll() not in (None, 0):
+                raise subprocess.CalledProcessError(encoder.returncode, "ffmpeg")
+            if dsp is not None and not dsp.is_alive():
+                # Nothing reads the pipe any more, FluidSynth could block on it forever
+                renderer.kill()
+                renderer.wait()
+                break
+            time.sleep(0.05)
+
+        # Until release() the filter only stops early on an error or a dead encoder, and that
+        # (not FluidSynth's broken pipe) is the failure to report
+        if dsp is not None and not dsp.is_alive():
+            if dsp.error is not None:
+                raise dsp.error
+            raise subprocess.CalledProcessError(encoder.wait(), "ffmpeg")
+
+        if renderer.wait() != 0:
+            encoder.kill()
+            encoder.wait()
+            raise subprocess.CalledProcessError(renderer.returncode, "fluidsynth")
+
+        if dsp is not None:
+            dsp.release()
+        else:
+            # If FluidSynth exited without ever opening the pipe, give ffmpeg its end of file
+            try:
+                os.close(os.open(pcm_pipe, os.O_WRONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+
+        stage("encode")
+        if dsp is not None:
+            dsp.join()
+            if dsp.error is not None:
+                raise dsp.error
+        if encoder.wait() != 0:
+            raise subprocess.CalledProcessError(encoder.returncode, "ffmpeg")
+    except BaseException:
+        mp3_file.unlink(missing_ok=True) # never leave a truncated MP3 behind
+        raise
+    finally:
+        for proc in (renderer, encoder):
+            if proc is not None and proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        if dsp is not None:
+            dsp.release()
+            dsp.join()
+        pcm_pipe.unlink(missing_ok=True)
+        if own_dir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return mp3_file
+
+def _encoder_command(source, mp3_file, effects=None) -> list[str]:
+    """
+    ffmpeg command encoding SAMPLE_RATE s16le stereo from source with the lo-fi filter, or, when
+    effects are used, LOFI_RATE PCM already filtered by lofi_dsp.
+    """
+    if effects is None:
+        encoder_input = [
+            "-f", "s16le", "-ar", str(SAMPLE_RATE), "-ac", "2",
+            "-i", str(source), # raw PCM from FluidSynth
+            "-af", LOFI_FILTER, # Lofi Filtering
+        ]
+    else:
+        encoder_input = [
+            "-f", "s16le", "-ar", str(LOFI_RATE), "-ac", "2",
+            "-i", str(source), # PCM already filtered by lofi_dsp
+        ]
+    return [
+        "ffmpeg",
+        "-y", # Overwrite output files, takes away prompting issue
+        "-loglevel", "error",
+        *encoder_input,
+        "-codec:a", "libmp3lame", # basic audio codec
+        "-qscale:a", MP3_QUALITY, # for quality, 0 - 9, where lower is better
+        str(mp3_file) # output file
+    ]
+
+def _generate_lofi_resident(midi_file, mp3_file: Path, synth, on_stage=None, effects=None) -> Path:
+    """
+    generate_lofi with a resident SynthPool: PCM blocks go from the synth (through LofiFilter if
+    effects are used) into ffmpeg's stdin as they are rendered.
+    """
+    def stage(name):
+        if on_stage is not None:
+            on_stage(name)
+
+    lofi = None
+    if effects is not None:
+        from lofi_dsp import LofiFilter
+        lofi = LofiFilter(SAMPLE_RATE, 2, LOFI_RATE, **effects)
+
+    encoder = None
+    try:
+        stage("render")
+        print("🎹 Rendering MIDI through lo-fi filtering to MP3...", flush=True)
+        encoder = subprocess.Popen(_encoder_command("pipe:0", mp3_file, effects), stdin=subprocess.PIPE)
+        try:
+            for pcm in synth.render_file(midi_file):
+                encoder.stdin.write(pcm if lofi is None else lofi.process(pcm))
+            if lofi is not None:
+                encoder.stdin.write(lofi.flush())
+            encoder.stdin.close()
+        except BrokenPipeError:
+            pass # the encoder died, its exit code is reported below
+
+        stage("encode")
+        if encoder.wait() != 0:
+            raise subprocess.CalledProcessError(encoder.returncode, "ffmpeg")
+    except BaseException:
+        mp3_file.unlink(missing_ok=True) # never leave a truncated MP3 behind
+        raise
+    finally:
+        if encoder is not None and encoder.poll() is None:
+            encoder.kill()
+            encoder.wait()
+
+    return mp3_file
+
+def _start_dsp(pcm_pipe, encoder_stdin, lofi) -> threading.Thread:
+    """
+    Starts a thread that reads FluidSynth's PCM from pcm_pipe, runs it through the LofiFilter
+    lofi and writes the result to the encoder. Any error is kept on the thread as .error.
+
+    The returned thread holds a write end of the pipe so the filter cannot see end of file before
+    FluidSynth has opened it; call its release() once FluidSynth has exited.
+    """
+    src_fd = os.open(pcm_pipe, os.O_RDONLY | os.O_NONBLOCK)
+    os.set_blocking(src_fd, True)
+    hold_fd = os.open(pcm_pipe, os.O_WRONLY)
+
+    def release():
+        nonlocal hold_fd
+        if hold_fd is not None:
+            os.close(hold_fd)
+            hold_fd = None
+
+    def run():
+        try:
+            with os.fdopen(src_fd, "rb") as src:
+                lofi.filter_stream(src, encoder_stdin)
+        except BrokenPipeError:
+            pass # the encoder died, the caller reports its exit code
+        except Exception as e:
+            thread.error = e
+        finally:
+            try:
+                encoder_stdin.close()
+            except BrokenPipeError:
+                pass
+
+    thread = threading.Thread(target=run, name="lofi-dsp", daemon=True)
+    thread.error = None
+    thread.release = release
+    thread.start()
+    return thread
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-midi", type=str, default=str(MIDI_INPUT), help="MIDI file to render")
+    parser.add_argument("-output", type=str, default=None, help="MP3 to write (defaults to a new unique file in lofi_songs)")
+    parser.add_argument("--dsp", action="store_true", help="Run the lo-fi chain in Python (lofi_dsp.py) instead of ffmpeg")
+    parser.add_argument("-bitcrush_bits", type=int, default=None, help="Bit depth to crush to (with --dsp)")
+    parser.add_argument("-wow_ms", type=float, default=0.0, help="Tape wow depth in milliseconds (with --dsp)")
+    parser.add_argument("-flutter_ms", type=float, default=0.0, help="Tape flutter depth in milliseconds (with --dsp)")
+    parser.add_argument("-noise_level", type=float, default=0.0, help="Vinyl hiss and crackle level, 0 - 1 (with --dsp)")
+    args = parser.parse_args()
+
+    # Unique filenames per run
+    if args.output is None:
+        song_id  = uuid.uuid4().hex # Make random Universally unique ID for song
+        mp3_file = Path(OUTPUT_DIR) / f"{song_id}_lofi.mp3"
+    else:
+        mp3_file = Path(args.output)
+    mp3_file.parent.mkdir(parents=True, exist_ok=True)
+
+    try:
+        effects = None
+        if args.dsp:
+            effects = {"bitcrush_bits": args.bitcrush_bits, "wow_ms": args.wow_ms,
+                       "flutter_ms": args.flutter_ms, "noise_level": args.noise_level}
+        generate_lofi(args.midi, mp3_file, effects=effects)
 
         # Print the absolute path so callers can capture it easily
         print(str(mp3_file.resolve()))
     except subprocess.CalledProcessError as e:
-        fail(f"Processing failed: {e}")
+        sys.exit(f"Processing failed: {e}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,287 @@
+import sys
+import subprocess
+from math import gcd
+
+import numpy as np
+from scipy import signal
+
+# Same chain as LOFI_FILTER in generate_lofi.py:
+# aresample=8000,lowpass=f=3000,highpass=f=100,volume=0.8
+LOFI_RATE      = 8000
+LOWPASS_HZ     = 3000.0
+HIGHPASS_HZ    = 100.0
+GAIN           = 0.8
+BIQUAD_Q       = 0.707 # ffmpeg's default width for lowpass / highpass (width_type q)
+
+
+def biquad(kind: str, freq: float, sample_rate: int, q: float = BIQUAD_Q) -> np.ndarray:
+    """
+    RBJ cookbook lowpass / highpass biquad as one second-order section (the design ffmpeg's
+    lowpass and highpass filters use).
+    """
+    w0 = 2.0 * np.pi * freq / sample_rate
+    alpha = np.sin(w0) / (2.0 * q)
+    cos_w0 = np.cos(w0)
+
+    if kind == "lowpass":
+        b = [(1.0 - cos_w0) / 2.0, 1.0 - cos_w0, (1.0 - cos_w0) / 2.0]
+    elif kind == "highpass":
+        b = [(1.0 + cos_w0) / 2.0, -(1.0 + cos_w0), (1.0 + cos_w0) / 2.0]
+    else:
+        raise ValueError(f"Unknown biquad kind: {kind}")
+    a = [1.0 + alpha, -2.0 * cos_w0, 1.0 - alpha]
+
+    return np.concatenate([np.array(b) / a[0], np.array(a) / a[0]])
+
+
+class PolyphaseResampler:
+    """
+    Streaming polyphase resampler (rational up / down factor) for (frames, channels) blocks.
+
+    Uses the same Kaiser windowed FIR as scipy.signal.resample_poly, delay compensated, so
+    feeding a signal in any number of blocks and then calling flush() gives the same samples as
+    resample_poly on the whole signal.
+    """
+
+    def __init__(self, rate_in: int, rate_out: int, channels: int, half_len: int | None = None):
+        g = gcd(rate_in, rate_out)
+        self.up = rate_out // g
+        self.down = rate_in // g
+        self.channels = channels
+
+        # resample_poly's default filter: cutoff at the lower Nyquist, Kaiser beta 5
+        if half_len is None:
+            half_len = 10 * max(self.up, self.down)
+        h = signal.firwin(2 * half_len + 1, 1.0 / max(self.up, self.down), window=("kaiser", 5.0)) * self.up
+        self.delay = half_len # in upsampled samples
+
+        # Polyphase bank: output n reads phase (n * down + delay) % up, taps t = 0 .. n_taps - 1
+        # against input i - t with i = (n * down + delay) // up
+        self.n_taps = -(-len(h) // self.up)
+        bank = np.zeros((self.up, self.n_taps))
+        for phase in range(self.up):
+            taps = h[phase::self.up]
+            bank[phase, :len(taps)] = taps
+        self.bank = bank
+
+        self.history = np.zeros((self.n_taps - 1, channels)) # inputs before the current block
+        self.n_in = 0   # inputs consumed so far
+        self.n_out = 0  # outputs produced so far
+
+    def process(self, x: np.ndarray) -> np.ndarray:
+        """
+        Resamples the next block, returning every output whose inputs have all arrived.
+        """
+        x = np.asarray(x, dtype=np.float64).reshape(-1, self.channels)
+        return self._run(x, self.n_in + len(x))
+
+    def flush(self) -> np.ndarray:
+        """
+        Returns the remaining outputs, treating the signal as zero after its end.
+        """
+        total_out = -(-self.n_in * self.up // self.down)
+        last_i = ((total_out - 1) * self.down + self.delay) // self.up if total_out > self.n_out else self.n_in
+        pad = np.zeros((max(0, last_i + 1 - self.n_in), self.channels))
+        return self._run(pad, self.n_in + len(pad), total_out)
+
+    def _run(self, x: np.ndarray, available: int, limit: int | None = None) -> np.ndarray:
+        # Input sample i lives at buf[i - base]; history always covers the oldest tap
+        buf = np.concatenate([self.history, x])
+        base = self.n_in - len(self.history)
+        self.n_in += len(x)
+
+        # Outputs whose newest input index is below available
+        end = (available * self.up - self.delay - 1) // self.down + 1
+        if limit is not None:
+            end = min(end, limit)
+        n = np.arange(self.n_out, max(end, self.n_out))
+
+        # Outputs up apart share a phase and read inputs down apart, so each phase is one
+        # matrix product over a strided view of the buffer (newest input last in each window)
+        y = np.empty((len(n), self.channels))
+        windows = np.lib.stride_tricks.sliding_window_view(buf, self.n_taps, axis=0) if len(n) else None
+        for j in range(min(self.up, len(n))):
+            pos = n[j] * self.down + self.delay
+            start = pos // self.up - base - (self.n_taps - 1)
+            count = len(range(j, len(n), self.up))
+            frames = windows[start:start + (count - 1) * self.down + 1:self.down]
+            y[j::self.up] = frames @ self.bank[pos % self.up, ::-1]
+
+        self.n_out += len(n)
+        self.history = buf[len(buf) - (self.n_taps - 1):]
+        return y
+
+
+class LofiFilter:
+    """
+    Block-by-block lo-fi effect chain on interleaved 16 bit PCM.
+
+    The core chain mirrors the ffmpeg filter in generate_lofi.py: polyphase resampling to 8 kHz,
+    RBJ biquad lowpass at 3 kHz and highpass at 100 Hz, then 0.8 gain. Optional extras, all off
+    by default: bit-crush to bitcrush_bits, tape wow (slow pitch drift) and flutter (fast
+    wobble) as a modulated delay with depths in milliseconds, and vinyl noise (hiss plus random
+    crackle) at noise_level of full scale. Filter, delay and noise state carries across blocks,
+    so any chunking gives the same output.
+    """
+
+    def __init__(self, rate_in: int = 44100, channels: int = 2, rate_out: int = LOFI_RATE,
+                 lowpass: float = LOWPASS_HZ, highpass: float = HIGHPASS_HZ, gain: float = GAIN,
+                 bitcrush_bits: int | None = None, wow_ms: float = 0.0, flutter_ms: float = 0.0,
+                 noise_level: float = 0.0, seed: int | None = None):
+        self.channels = channels
+        self.rate_out = rate_out
+        self.gain = gain
+        self.bitcrush_bits = bitcrush_bits
+        self.noise_level = noise_level
+
+        self.resampler = PolyphaseResampler(rate_in, rate_out, channels)
+
+        self.sos = np.stack([biquad("lowpass", lowpass, rate_out), biquad("highpass", highpass, rate_out)])
+        self.zi = np.zeros((len(self.sos), 2, channels))
+
+        # Wow / flutter: delay line long enough for the deepest modulation
+        self.wow = wow_ms * rate_out / 1000.0
+        self.flutter = flutter_ms * rate_out / 1000.0
+        self.max_delay = self.wow + self.flutter
+        self.delay_history = np.zeros((int(np.ceil(2 * self.max_delay)) + 2, channels))
+
+        self.rng = np.random.default_rng(seed)
+        self.hiss_zi = np.zeros((1, 2, channels))
+        self.hiss_sos = biquad("lowpass", 2000.0, rate_out)[None, :]
+        self.t = 0 # output samples so far
+
+    def process(self, pcm: bytes) -> bytes:
+        """
+        Filters the next block of interleaved s16le PCM, returning s16le PCM at rate_out.
+        """
+        x = np.frombuffer(pcm, dtype="<i2").reshape(-1, self.channels) / 32768.0
+        return self._finish(self.resampler.process(x))
+
+    def flush(self) -> bytes:
+        """
+        Returns the tail of the stream (resampler delay) once the input has ended.
+        """
+        return self._finish(self.resampler.flush())
+
+    def process_array(self, x: np.ndarray) -> np.ndarray:
+        """
+        Filters a whole float signal (frames, channels) in [-1, 1] and returns float output.
+        """
+        y = self._effects(self.resampler.process(x))
+        return np.concatenate([y, self._effects(self.resampler.flush())])
+
+    def filter_stream(self, src, dst, block_bytes: int = 1 << 16):
+        """
+        Reads s16le PCM from the binary file src until end of file and writes the filtered PCM
+        to dst, including the flushed tail. Partial frames are carried into the next read.
+        """
+        frame = 2 * self.channels
+        pending = b""
+        while True:
+            data = src.read(block_bytes)
+            if not data:
+                break
+            data = pending + data
+            cut = len(data) - len(data) % frame
+            pending = data[cut:]
+            dst.write(self.process(data[:cut]))
+        dst.write(self.flush())
+
+    def _finish(self, y: np.ndarray) -> bytes:
+        y = self._effects(y)
+        return (np.clip(np.round(y * 32768.0), -32768, 32767).astype("<i2")).tobytes()
+
+    def _effects(self, y: np.ndarray) -> np.ndarray:
+        if len(y) == 0:
+            return y
+
+        y, self.zi = signal.sosfilt(self.sos, y, axis=0, zi=self.zi)
+        y = y * self.gain
+
+        if self.max_delay > 0:
+            y = self._wow_flutter(y)
+        if self.noise_level > 0:
+            y = y + self._vinyl_noise(len(y))
+        if self.bitcrush_bits is not None:
+            steps = 2 ** (self.bitcrush_bits - 1)
+            y = np.round(y * steps) / steps
+
+        self.t += len(y)
+        return y
+
+    def _wow_flutter(self, y: np.ndarray) -> np.ndarray:
+        # Delay (in samples) swings around max_delay (+1 so the newest sample has a neighbour) with a 0.5 Hz wow and a 6 Hz flutter
+        t = (self.t + np.arange(len(y))) / self.rate_out
+        delay = (1.0 + self.max_delay
+                 + self.wow * np.sin(2 * np.pi * 0.5 * t)
+                 + self.flutter * np.sin(2 * np.pi * 6.0 * t))
+
+        buf = np.concatenate([self.delay_history, y])
+        pos = len(self.delay_history) + np.arange(len(y)) - delay
+        i0 = np.floor(pos).astype(np.int64)
+        frac = (pos - i0)[:, None]
+        out = buf[i0] * (1.0 - frac) + buf[i0 + 1] * frac
+
+        self.delay_history = buf[len(buf) - len(self.delay_history):]
+        return out
+
+    def _vinyl_noise(self, n: int) -> np.ndarray:
+        # One row of draws per sample, so the noise does not depend on how the stream is chunked
+        u = self.rng.random((n, self.channels + 2))
+        hiss = (u[:, :self.channels] - 0.5) * 0.6
+        hiss, self.hiss_zi = signal.sosfilt(self.hiss_sos, hiss, axis=0, zi=self.hiss_zi)
+
+        # Crackle: a few sparse clicks per second, the same on both channels
+        clicks = (u[:, -2] < 4.0 / self.rate_out) * (2.0 * u[:, -1] - 1.0)
+        return self.noise_level * (hiss + clicks[:, None])
+
+def ffmpeg_reference(x: np.ndarray, rate_in: int = 44100) -> np.ndarray:
+    """
+    Runs the ffmpeg LOFI_FILTER chain on a float (frames, channels) signal and returns its output
+    as float, for comparing against LofiFilter.
+    """
+    from generate_lofi import LOFI_FILTER
+
+    channels = x.shape[1]
+    out = subprocess.run([
+        "ffmpeg", "-loglevel", "error",
+        "-f", "f32le", "-ar", str(rate_in), "-ac", str(channels), "-i", "pipe:0",
+        "-af", LOFI_FILTER,
+        "-f", "f32le", "pipe:1"
+    ], input=x.astype("<f4").tobytes(), capture_output=True, check=True).stdout
+    return np.frombuffer(out, dtype="<f4").reshape(-1, channels).astype(np.float64)
+
+
+def compare_to_ffmpeg(seconds: float = 5.0, rate_in: int = 44100, seed: int = 0, max_lag: int = 32) -> dict:
+    """
+    Filters the same test signal (tones plus noise) with LofiFilter and ffmpeg and returns the
+    difference relative to the reference level, after aligning the two by up to max_lag samples
+    (the resamplers may compensate their delay differently).
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * rate_in)) / rate_in
+    tones = sum(np.sin(2 * np.pi * f * t) for f in (55.0, 220.0, 440.0, 1000.0, 2500.0, 6000.0)) / 8.0
+    x = np.stack([tones, np.roll(tones, 100)], axis=1) + 0.05 * rng.standard_normal((len(t), 2))
+
+    ours = LofiFilter(rate_in, x.shape[1]).process_array(x)
+    ref = ffmpeg_reference(x, rate_in)
+
+    # Edges hold the filter start up and the resampler tails, compare the steady middle
+    margin = LOFI_RATE // 10
+    n = min(len(ours), len(ref)) - 2 * margin - 2 * max_lag
+    mid = ref[margin + max_lag:margin + max_lag + n]
+
+    def error(lag):
+        return ours[margin + max_lag + lag:margin + max_lag + lag + n] - mid
+
+    lag = min(range(-max_lag, max_lag + 1), key=lambda lag: np.mean(error(lag) ** 2))
+    diff = error(lag)
+    return {"lag": lag, "samples": n,
+            "rms_error": float(np.sqrt(np.mean(diff ** 2) / np.mean(mid ** 2))),
+            "max_error": float(np.abs(diff).max() / np.abs(mid).max())}
+
+
+if __name__ == "__main__":
+    result = compare_to_ffmpeg()
+    print(result)
+    sys.exit(0 if result["rms_error"] < 0.05 else 1)
@@ -0,0 +1,214 @@
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+import pretty_midi
+
+from generate_lofi import SAMPLE_RATE
+
+VELOCITY_BINS   = 32    # velocity tokens of the MusicTransformer tokenizer (velocity // 4)
+SAMPLE_SECONDS  = 3.0   # length of each cached note, longer notes are cut off here
+RELEASE_SECONDS = 0.25  # fade out applied after a note off
+BLOCK_SECONDS   = 0.5   # PCM handed out per block by render_file
+SILENCE         = 2     # int16 level below which the end of a cached note is dropped
+
+
+def velocity_bin(velocity: int) -> int:
+    return min(int(velocity) // 4, VELOCITY_BINS - 1)
+
+
+class NoteSampleCache:
+    """
+    In-memory bank of pre-rendered notes, one per (program, pitch, velocity bin).
+
+    Each sample is rendered once, on first use, by holding the note for SAMPLE_SECONDS on an
+    instance of the resident synth (a SynthPool) and is kept as int16 stereo without its silent
+    end. With the 32 tokenizer velocity bins, a program never needs more than 128 * 32 samples.
+
+    Given a path, the samples already saved there are loaded up front and sync() writes newly
+    rendered ones back, so processes after the first start warm.
+    """
+
+    def __init__(self, synth, sample_rate: int = SAMPLE_RATE, sample_seconds: float = SAMPLE_SECONDS,
+                 path=None):
+        self.synth = synth
+        self.sample_rate = sample_rate
+        self.length = int(round(sample_seconds * sample_rate))
+        self.path = Path(path) if path is not None else None
+        self._samples: dict[tuple[int, int, int], np.ndarray] = {}
+        self._lock = threading.Lock()
+
+        if self.path is not None and self.path.exists():
+            self.load(self.path)
+        self._saved = len(self._samples)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def nbytes(self) -> int:
+        return sum(s.nbytes for s in self._samples.values())
+
+    def get(self, program: int, pitch: int, vel_bin: int) -> np.ndarray:
+        """
+        Returns the (at most length, 2) int16 sample for a note, rendering it first if needed.
+        """
+        key = (program, pitch, vel_bin)
+        sample = self._samples.get(key)
+        if sample is None:
+            with self._lock:
+                sample = self._samples.get(key)
+                if sample is None:
+                    sample = self._render(*key)
+                    self._samples[key] = sample
+        return sample
+
+    def prefetch(self, keys):
+        for key in set(keys):
+            self.get(*key)
+
+    def _render(self, program: int, pitch: int, vel_bin: int) -> np.ndarray:
+        # Velocities decode as bin * 4, bin 0 still has to sound
+        velocity = max(vel_bin * 4, 1)
+        with self.synth.session() as session:
+            session.program(0, program)
+            session.note_on(0.0, pitch, velocity)
+            pcm = session.render_until(self.length / self.sample_rate)
+        sample = np.frombuffer(pcm, dtype="<i2").reshape(-1, 2)
+
+        # Piano notes decay, drop the silent end so quiet and high notes take less memory
+        audible = np.flatnonzero(np.abs(sample).max(axis=1) > SILENCE)
+        return sample[:audible[-1] + 1 if len(audible) else 0].copy()
+
+    def sync(self):
+        """
+        Saves the cache to its path if samples were rendered since it was loaded or last saved.
+        Samples other processes saved to the file in the meantime are merged in first, and the
+        file is replaced atomically, so worker processes can share one file.
+        """
+        if self.path is None or len(self._samples) == self._saved:
+            return
+        with self._lock:
+            if self.path.exists():
+                self.load(self.path)
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+            with open(tmp_path, "wb") as stream:
+                self.save(stream)
+            os.replace(tmp_path, self.path)
+            self._saved = len(self._samples)
+
+    def save(self, path):
+        """
+        Writes every cached sample to an .npz file (a path or an open binary file), see load.
+        """
+        keys = sorted(self._samples)
+        lengths = [len(self._samples[k]) for k in keys]
+        np.savez(path, keys=np.array(keys, dtype=np.int16).reshape(-1, 3),
+                 offsets=np.cumsum([0] + lengths),
+                 samples=np.concatenate([self._samples[k] for k in keys] + [np.zeros((0, 2), np.int16)]))
+
+    def load(self, path):
+        """
+        Adds the samples of an .npz file written by save (with the same SoundFont and rate).
+        """
+        with np.load(path) as data:
+            offsets, samples = data["offsets"], data["samples"]
+            for i, key in enumerate(data["keys"]):
+                key = tuple(int(k) for k in key)
+                if key not in self._samples:
+                    self._samples[key] = samples[offsets[i]:min(offsets[i + 1], offsets[i] + self.length)]
+
+
+class PianoRenderer:
+    """
+    Built-in renderer for the single piano instrument of decoded MusicTransformer output.
+
+    Every note is its cached sample (see NoteSampleCache) cut at the note off and faded out
+    over RELEASE_SECONDS, mixed by overlap-add into one float32 buffer: the held part of each
+    note is a single slice add, the release part one precomputed envelope multiply, so the
+    mix costs two vector operations per note and no synthesis at all.
+
+    Has the same render_file interface as SynthPool, so it can be passed as synth= to
+    generate_lofi. With a cache_file, the note samples persist across processes (see
+    NoteSampleCache), and render_file saves the ones each song adds.
+    """
+
+    def __init__(self, synth, sample_rate: int = SAMPLE_RATE, sample_seconds: float = SAMPLE_SECONDS,
+                 release_seconds: float = RELEASE_SECONDS, cache: NoteSampleCache | None = None,
+                 cache_file=None):
+        self.sample_rate = sample_rate
+        self.cache = cache if cache is not None else NoteSampleCache(synth, sample_rate, sample_seconds, cache_file)
+        self.release = int(round(release_seconds * sample_rate))
+        # Linear fade from 1 to 0 over the release, as a column so it scales both channels
+        self.release_env = np.linspace(1.0, 0.0, self.release, endpoint=False, dtype=np.float32)[:, None]
+
+    def render_notes(self, notes: list[pretty_midi.Note], program: int = 0, end: float | None = None) -> np.ndarray:
+        """
+        Mixes notes into a (frames, 2) float32 buffer in int16 scale. The buffer runs until the
+        last release ends, or until end (in seconds) if given.
+        """
+        starts = [int(round(n.start * self.sample_rate)) for n in notes]
+        helds = [int(round((n.end - n.start) * self.sample_rate)) for n in notes]
+
+        if end is not None:
+            frames = int(round(end * self.sample_rate))
+        else:
+            frames = max([s + min(h, self.cache.length) + self.release for s, h in zip(starts, helds)], default=0)
+        out = np.zeros((frames, 2), dtype=np.float32)
+
+        for n, s, h in zip(notes, starts, helds):
+            if s >= frames:
+                continue
+            sample = self.cache.get(program, n.pitch, velocity_bin(n.velocity))
+            # A note held into the last release frames of its sample fades out over them instead
+            h = min(max(h, 0), max(len(sample) - self.release, 0), frames - s)
+            out[s:s + h] += sample[:h]
+            r = min(self.release, len(sample) - h, frames - s - h)
+            if r > 0:
+                out[s + h:s + h + r] += sample[h:h + r] * self.release_env[:r]
+        return out
+
+    def render_midi(self, midi: pretty_midi.PrettyMIDI) -> np.ndarray:
+        """
+        Mixes every non-drum instrument of a PrettyMIDI (frames, 2) in int16 scale.
+        """
+        parts = [self.render_notes(inst.notes, inst.program) for inst in midi.instruments if not inst.is_drum]
+        frames = max([len(p) for p in parts], default=0)
+        out = np.zeros((frames, 2), dtype=np.float32)
+        for p in parts:
+            out[:len(p)] += p
+        return out
+
+    def render_file(self, midi_file, block_seconds: float = BLOCK_SECONDS):
+        """
+        Renders a MIDI file, yielding s16le stereo PCM blocks of block_seconds.
+        """
+        pcm = to_pcm(self.render_midi(pretty_midi.PrettyMIDI(str(midi_file))))
+        block = int(block_seconds * self.sample_rate) * 4
+        for i in range(0, len(pcm), block):
+            yield pcm[i:i + block]
+        self.cache.sync()
+
+
+def sample_cache_file(synth) -> Path:
+    """
+    Where the note samples of a SynthPool are kept: next to its SoundFont, one file per
+    sample rate and gain since both change the rendered samples.
+    """
+    soundfont = Path(synth.soundfont)
+    return soundfont.with_name(f"{soundfont.stem}_notes_{synth.sample_rate}_{synth.gain:g}.npz")
+
+
+def resident_piano(synth) -> PianoRenderer:
+    """
+    PianoRenderer for a SynthPool with its note samples persisted in sample_cache_file.
+    """
+    return PianoRenderer(synth, synth.sample_rate, cache_file=sample_cache_file(synth))
+
+
+def to_pcm(audio: np.ndarray) -> bytes:
+    """
+    Clips a float buffer in int16 scale and returns it as s16le bytes.
+    """
+    return np.clip(np.round(audio), -32768, 32767).astype("<i2").tobytes()
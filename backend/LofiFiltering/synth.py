@@ -0,0 +1,187 @@
+import heapq
+import queue
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+import pretty_midi
+
+from generate_lofi import SOUNDFONT_PATH, SAMPLE_RATE
+
+try:
+    import fluidsynth # pyfluidsynth, needs libfluidsynth
+except (ImportError, OSError):
+    fluidsynth = None
+
+GAIN          = 0.2 # same as the fluidsynth command line default
+BLOCK_SECONDS = 0.5 # PCM handed out per block while rendering a file
+TAIL_SECONDS  = 1.0 # release after the last event of a file
+
+
+class SynthSession:
+    """
+    One FluidSynth instance driven by timed MIDI events, rendering s16le stereo PCM on demand.
+
+    Events are queued with note_on / note_off / control_change / pitch_bend at absolute times in
+    seconds and rendered in order by render_until, so a caller can keep adding events while
+    audio is produced (token streams) or queue a whole file up front (render_midi).
+    """
+
+    def __init__(self, synth, sfid: int, sample_rate: int = SAMPLE_RATE):
+        self.synth = synth
+        self.sfid = sfid
+        self.sample_rate = sample_rate
+        self.reset()
+
+    def reset(self):
+        """
+        Silences every voice and forgets the timeline, ready for the next song.
+        """
+        self.synth.system_reset()
+        self.frames = 0 # frames rendered so far
+        self._events = []
+        self._seq = 0
+
+    @property
+    def time(self) -> float:
+        return self.frames / self.sample_rate
+
+    def program(self, channel: int, program: int, is_drum: bool = False):
+        self.synth.program_select(channel, self.sfid, 128 if is_drum else 0, program)
+
+    def note_on(self, t: float, pitch: int, velocity: int, channel: int = 0):
+        self._push(t, self.synth.noteon, channel, pitch, velocity)
+
+    def note_off(self, t: float, pitch: int, channel: int = 0):
+        self._push(t, self.synth.noteoff, channel, pitch)
+
+    def control_change(self, t: float, number: int, value: int, channel: int = 0):
+        self._push(t, self.synth.cc, channel, number, value)
+
+    def pitch_bend(self, t: float, value: int, channel: int = 0):
+        self._push(t, self.synth.pitch_bend, channel, value)
+
+    def _push(self, t, fn, *args):
+        # Events in the past (already rendered) apply at the current time
+        frame = max(int(round(t * self.sample_rate)), self.frames)
+        heapq.heappush(self._events, (frame, self._seq, fn, args))
+        self._seq += 1
+
+    def render_until(self, t: float) -> bytes:
+        """
+        Applies every queued event before t and returns the PCM from the current time up to t.
+        """
+        end = int(round(t * self.sample_rate))
+        chunks = []
+        while self.frames < end:
+            if self._events and self._events[0][0] <= self.frames:
+                _, _, fn, args = heapq.heappop(self._events)
+                fn(*args)
+                continue
+            stop = min(end, self._events[0][0]) if self._events else end
+            chunks.append(self.synth.get_samples(stop - self.frames).tobytes())
+            self.frames = stop
+        return b"".join(chunks)
+
+    def render_midi(self, midi: pretty_midi.PrettyMIDI, block_seconds: float = BLOCK_SECONDS,
+                    tail_seconds: float = TAIL_SECONDS):
+        """
+        Renders a PrettyMIDI from the start, yielding PCM blocks of block_seconds.
+        """
+        melodic = [c for c in range(16) if c != 9] # channel 9 is reserved for drums
+        for i, inst in enumerate(midi.instruments):
+            channel = 9 if inst.is_drum else melodic[i % len(melodic)]
+            self.program(channel, inst.program, inst.is_drum)
+            for cc in inst.control_changes:
+                self.control_change(cc.time, cc.number, cc.value, channel)
+            for bend in inst.pitch_bends:
+                self.pitch_bend(bend.time, bend.pitch, channel)
+            for note in inst.notes:
+                self.note_on(note.start, note.pitch, note.velocity, channel)
+                self.note_off(note.end, note.pitch, channel)
+
+        end = midi.get_end_time() + tail_seconds
+        t = 0.0
+        while t < end:
+            t = min(t + block_seconds, end)
+            yield self.render_until(t)
+
+
+class SynthPool:
+    """
+    Resident FluidSynth renderer: the SoundFont is loaded once and kept for the life of the
+    process, with `instances` synths so that many songs can render at once.
+
+    Every instance loads the same SoundFont file, which FluidSynth serves from its in-process
+    sample cache, so the sample data is read and held in memory once and shared by all
+    instances. session() lends out an idle instance (blocking while all are busy); render_file
+    renders a whole MIDI file through one.
+    """
+
+    def __init__(self, soundfont=SOUNDFONT_PATH, instances: int = 1, sample_rate: int = SAMPLE_RATE,
+                 gain: float = GAIN):
+        if fluidsynth is None:
+            raise RuntimeError("pyfluidsynth (and libfluidsynth) is needed for the resident synth")
+
+        self.soundfont = Path(soundfont)
+        self.instances = instances
+        self.sample_rate = sample_rate
+        self.gain = gain
+        self._idle: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def load(self) -> "SynthPool":
+        """
+        Creates the synth instances and loads the SoundFont (done on first use if not called).
+        """
+        with self._lock:
+            if self._loaded:
+                return self
+            for _ in range(self.instances):
+                synth = fluidsynth.Synth(gain=self.gain, samplerate=float(self.sample_rate))
+                sfid = synth.sfload(str(self.soundfont))
+                if sfid == -1:
+                    raise RuntimeError(f"Could not load SoundFont {self.soundfont}")
+                self._idle.put(SynthSession(synth, sfid, self.sample_rate))
+            self._loaded = True
+        return self
+
+    @contextmanager
+    def session(self):
+        """
+        Lends out an idle synth instance, reset for a new song when it is handed back.
+        """
+        self.load()
+        session = self._idle.get()
+        try:
+            yield session
+        finally:
+            session.reset()
+            self._idle.put(session)
+
+    def render_file(self, midi_file, block_seconds: float = BLOCK_SECONDS):
+        """
+        Renders a MIDI file, yielding s16le stereo PCM blocks as they are synthesized.
+        """
+        midi = pretty_midi.PrettyMIDI(str(midi_file))
+        with self.session() as session:
+            yield from session.render_midi(midi, block_seconds)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().synth.delete()
+            except queue.Empty:
+                break
+        self._loaded = False
+
+
+def resident_synth(instances: int = 1) -> SynthPool | None:
+    """
+    Returns a SynthPool, or None when pyfluidsynth is not installed (callers then fall back to
+    running the fluidsynth command line for each render).
+    """
+    if fluidsynth is None:
+        return None
+    return SynthPool(instances=instances)
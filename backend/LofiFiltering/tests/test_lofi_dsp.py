@@ -0,0 +1,76 @@
+import io
+
+import numpy as np
+import pytest
+from scipy import signal
+
+from lofi_dsp import LofiFilter, PolyphaseResampler
+
+RATE_IN = 44100
+RATE_OUT = 8000
+
+
+def resample_blocks(x: np.ndarray, blocks: list[int], rate_in: int = RATE_IN, rate_out: int = RATE_OUT) -> np.ndarray:
+    resampler = PolyphaseResampler(rate_in, rate_out, x.shape[1])
+    out = []
+    i = 0
+    for n in blocks:
+        out.append(resampler.process(x[i:i + n]))
+        i += n
+    out.append(resampler.process(x[i:]))
+    out.append(resampler.flush())
+    return np.concatenate(out)
+
+
+@pytest.fixture
+def noise() -> np.ndarray:
+    return np.random.default_rng(0).standard_normal((RATE_IN + 37, 2))
+
+
+@pytest.mark.parametrize("blocks", [[], [1000, 3, 20000], [7] * 300, [0, 1, 0, 1]])
+def test_resampler_matches_resample_poly(noise, blocks):
+    ref = signal.resample_poly(noise, 80, 441, axis=0)
+    y = resample_blocks(noise, blocks)
+
+    assert y.shape == ref.shape
+    np.testing.assert_allclose(y, ref, atol=1e-9)
+
+
+@pytest.mark.parametrize("rate_in, rate_out", [(48000, 8000), (8000, 22050), (44100, 22050)])
+def test_resampler_other_rates(noise, rate_in, rate_out):
+    g = np.gcd(rate_in, rate_out)
+    ref = signal.resample_poly(noise, rate_out // g, rate_in // g, axis=0)
+
+    np.testing.assert_allclose(resample_blocks(noise, [999, 5], rate_in, rate_out), ref, atol=1e-9)
+
+
+def test_lofi_filter_is_chunk_invariant(noise):
+    pcm = (noise * 3000).astype("<i2").tobytes()
+    effects = dict(wow_ms=2.0, flutter_ms=0.3, noise_level=0.01, seed=1, bitcrush_bits=8)
+
+    whole = LofiFilter(**effects)
+    ref = whole.process(pcm) + whole.flush()
+
+    chunked = LofiFilter(**effects)
+    out = b"".join(chunked.process(pcm[i:i + 4000]) for i in range(0, len(pcm), 4000)) + chunked.flush()
+
+    assert out == ref
+    assert len(ref) == 2 * 2 * -(-(len(noise) * RATE_OUT) // RATE_IN)
+
+
+def test_filter_stream_carries_partial_frames(noise):
+    pcm = (noise * 3000).astype("<i2").tobytes()
+
+    whole = LofiFilter(seed=1, noise_level=0.01)
+    ref = whole.process(pcm) + whole.flush()
+
+    dst = io.BytesIO()
+    LofiFilter(seed=1, noise_level=0.01).filter_stream(io.BytesIO(pcm), dst, block_bytes=1001)
+
+    assert dst.getvalue() == ref
+
+
+def test_lofi_filter_empty_input():
+    lofi = LofiFilter()
+    assert lofi.process(b"") == b""
+    assert lofi.flush() == b""
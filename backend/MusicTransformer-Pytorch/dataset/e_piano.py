@@ -1,6 +1,8 @@
 import os
+import json
 import pickle
 import random
+import numpy as np
 import torch
 import torch.nn as nn
 from torch.utils.data import Dataset
@@ -66,6 +68,307 @@ class EPianoDataset(Dataset):
 
         return x, tgt
 
+    # piece
+    def piece(self, idx):
+        """
+        ----------
+        All tokens of piece idx as a uint16 array
+        ----------
+        """
+
+        with open(self.data_files[idx], "rb") as i_stream:
+            return np.asarray(pickle.load(i_stream), dtype=np.uint16)
+
+    # piece_lengths
+    def piece_lengths(self):
+        """
+        ----------
+        Token count of every data file. Taken from the preprocessing manifest of the dataset root
+        (preprocess_midi.py) where it has one, else read from the file once.
+        ----------
+        """
+
+        dataset_root = os.path.dirname(os.path.normpath(self.root))
+        manifest_file = os.path.join(dataset_root, MANIFEST_FILE)
+
+        known = {}
+        if(os.path.isfile(manifest_file)):
+            with open(manifest_file, "r") as stream:
+                for entry in json.load(stream).get("files", {}).values():
+                    if("tokens" in entry):
+                        known[os.path.normpath(os.path.join(dataset_root, entry["output"]))] = entry["tokens"]
+
+        lengths = []
+        for idx, f in enumerate(self.data_files):
+            n = known.get(os.path.normpath(f))
+            lengths.append(n if n is not None else len(self.piece(idx)))
+
+        return np.array(lengths, dtype=np.int64)
+
+# EPianoShardDataset
+class EPianoShardDataset(Dataset):
+    """
+    ----------
+    Same items as EPianoDataset, read from the packed token shard of a split written by
+    preprocess_midi.py --shards instead of one pickle per piece.
+
+    The token array is memory mapped, so a window is a view into the page cache and only the
+    max_seq + 1 tokens of the window are converted to TORCH_LABEL_TYPE. The mapping is opened
+    lazily in each process, so DataLoader workers map the same file and share its pages rather
+    than receiving a copy.
+    ----------
+    """
+
+    def __init__(self, root, split, max_seq=2048, random_seq=True):
+        self.root       = root
+        self.split      = split
+        self.max_seq    = max_seq
+        self.random_seq = random_seq
+
+        self.tokens_file    = os.path.join(root, SHARD_TOKENS_FILE % split)
+        self.offsets        = np.load(os.path.join(root, SHARD_OFFSETS_FILE % split))
+        self.tokens         = None
+
+    def __getstate__(self):
+        # Workers map the shard themselves instead of pickling the mapped array
+        state = self.__dict__.copy()
+        state["tokens"] = None
+        return state
+
+    # __len__
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    # piece
+    def piece(self, idx):
+        """
+        ----------
+        Zero-copy uint16 view of all tokens of piece idx
+        ----------
+        """
+
+        if(self.tokens is None):
+            self.tokens = np.load(self.tokens_file, mmap_mode="r")
+
+        return self.tokens[self.offsets[idx]:self.offsets[idx+1]]
+
+    # __getitem__
+    def __getitem__(self, idx):
+        """
+        ----------
+        Gets the indexed midi batch, choosing the window exactly like EPianoDataset/process_midi.
+
+        Returns the input and the target.
+        ----------
+        """
+
+        raw_mid     = self.piece(idx)
+        full_seq    = self.max_seq + 1
+
+        start = SEQUENCE_START
+        if(self.random_seq and len(raw_mid) > full_seq):
+            start = random.randint(SEQUENCE_START, len(raw_mid) - full_seq)
+
+        window = torch.from_numpy(raw_mid[start:start+full_seq].astype(np.int64))
+        return process_midi(window, self.max_seq, False)
+
+# EPianoWindowDataset
+class EPianoWindowDataset(Dataset):
+    """
+    ----------
+    Window-indexed version of EPianoDataset, where an item is one max_seq + 1 token window of a
+    piece instead of one random window per piece. Every piece's length is read once (shard
+    offsets or the preprocessing manifest) and the windows are indexed up front, so long pieces
+    get as many items as they have windows:
+
+    - stride: every piece is cut into windows starting every stride tokens (max_seq by default),
+      plus a last window ending at the end of the piece, covering every token once per epoch.
+    - epoch_tokens: the epoch is epoch_tokens / max_seq windows, each drawn from a piece chosen
+      in proportion to its length in tokens, at a uniformly random start. Pieces are seen in
+      proportion to their length whatever the epoch size.
+
+    epoch_tokens is set in both modes to the (expected) number of tokens an epoch trains on.
+    Short pieces give one padded window, exactly as in EPianoDataset.
+    ----------
+    """
+
+    def __init__(self, root, split, max_seq=2048, stride=None, epoch_tokens=None, shards=False):
+        self.root       = root
+        self.split      = split
+        self.max_seq    = max_seq
+
+        if(stride is not None and epoch_tokens is not None):
+            raise ValueError("Give either a window stride or an epoch size in tokens, not both")
+
+        if(shards):
+            self.pieces     = EPianoShardDataset(root, split, max_seq, False)
+            self.lengths    = np.diff(self.pieces.offsets)
+        else:
+            self.pieces     = EPianoDataset(os.path.join(root, split), max_seq, False)
+            self.lengths    = self.pieces.piece_lengths()
+
+        full_seq    = max_seq + 1
+        positions   = np.maximum(self.lengths - full_seq + 1, 1) # window starts per piece
+        targets     = np.minimum(self.lengths, max_seq)         # non-pad targets per window
+
+        self.proportional = epoch_tokens is not None
+        if(self.proportional):
+            self.positions      = positions
+            self.cum_lengths    = np.cumsum(self.lengths)
+            self.n_windows      = -(-int(epoch_tokens) // max_seq)
+            self.epoch_tokens   = int(round(self.n_windows * np.dot(self.lengths, targets) / max(self.cum_lengths[-1], 1)))
+        else:
+            stride = max_seq if stride is None else stride
+
+            # Starts 0, stride, ... and a last window flush with the end of the piece
+            n_per_piece         = -(-(positions - 1) // stride) + 1
+            self.window_piece   = np.repeat(np.arange(len(self.lengths)), n_per_piece)
+            first               = np.cumsum(n_per_piece) - n_per_piece
+            k                   = np.arange(len(self.window_piece)) - np.repeat(first, n_per_piece)
+            self.window_start   = np.minimum(k * stride, np.repeat(positions - 1, n_per_piece))
+            self.n_windows      = len(self.window_piece)
+            self.epoch_tokens   = int(np.dot(n_per_piece, targets))
+
+    # __len__
+    def __len__(self):
+        return self.n_windows
+
+    # __getitem__
+    def __getitem__(self, idx):
+        """
+        ----------
+        Gets window idx (strided), or a freshly drawn window (epoch_tokens).
+
+        Returns the input and the target.
+        ----------
+        """
+
+        if(self.proportional):
+            r = random.randrange(int(self.cum_lengths[-1]))
+            piece = int(np.searchsorted(self.cum_lengths, r, side="right"))
+            start = random.randrange(int(self.positions[piece]))
+        else:
+            piece = int(self.window_piece[idx])
+            start = int(self.window_start[idx])
+
+        window = self.pieces.piece(piece)[start:start+self.max_seq+1]
+        return process_midi(torch.from_numpy(window.astype(np.int64)), self.max_seq, False)
+
+# EPianoPackedDataset
+class EPianoPackedDataset(Dataset):
+    """
+    ----------
+    Packed-sequence version of EPianoDataset. All pieces of a split are laid end to end, each
+    followed by TOKEN_END, and the stream is cut into consecutive windows of max_seq + 1 tokens,
+    so a window holds the end of one piece and the start of the next instead of TOKEN_PAD. Only
+    the last window of the split is padded.
+
+    The target of every TOKEN_END separator is set to TOKEN_PAD, since the first token of a piece
+    cannot be predicted from the piece before it (it is never a target in EPianoDataset either).
+
+    With segments, items also carry the piece index of every input position (TOKEN_END counts
+    with the piece it ends, padding is -1). MusicTransformer.forward turns these into a
+    block-diagonal attention mask so pieces do not attend across the boundaries.
+
+    With random_seq, each window starts a random 0 .. max_seq - 1 tokens after its slot, like
+    the random windows of EPianoDataset. Reads the token shards of the split (preprocess_midi.py
+    --shards) when shards is set, else loads every pickle of root/split into memory once.
+    ----------
+    """
+
+    def __init__(self, root, split, max_seq=2048, random_seq=True, segments=False, shards=True):
+        self.root       = root
+        self.split      = split
+        self.max_seq    = max_seq
+        self.random_seq = random_seq
+        self.segments   = segments
+
+        if(shards):
+            self.pieces = EPianoShardDataset(root, split, max_seq, random_seq)
+            offsets     = self.pieces.offsets
+        else:
+            self.pieces = None
+            self.tokens, offsets = load_pieces(os.path.join(root, split))
+
+        # Piece i starts at stream position starts[i] and its TOKEN_END is at starts[i+1] - 1
+        self.starts         = offsets + np.arange(len(offsets))
+        self.stream_len     = int(self.starts[-1])
+
+    # __len__
+    def __len__(self):
+        return max(-(-(self.stream_len - 1) // self.max_seq), 0)
+
+    # piece
+    def piece(self, idx):
+        if(self.pieces is not None):
+            return self.pieces.piece(idx)
+        return self.tokens[self.starts[idx] - idx:self.starts[idx+1] - idx - 1]
+
+    # __getitem__
+    def __getitem__(self, idx):
+        """
+        ----------
+        Gets window idx of the packed stream.
+
+        Returns the input and the target, and the segment ids of the input with segments.
+        ----------
+        """
+
+        full_seq    = self.max_seq + 1
+
+        start = idx * self.max_seq
+        if(self.random_seq):
+            start = min(start + random.randint(0, self.max_seq - 1), max(self.stream_len - full_seq, 0))
+        end = min(start + full_seq, self.stream_len)
+
+        data = np.full(full_seq, TOKEN_PAD, dtype=np.int64)
+        seg  = np.full(full_seq, -1, dtype=np.int64)
+
+        # Copies the part of every piece (and its TOKEN_END) that falls in the window
+        first = int(np.searchsorted(self.starts, start, side="right")) - 1
+        for p in range(first, len(self.starts) - 1):
+            p0, p1 = int(self.starts[p]), int(self.starts[p+1])
+            if(p0 >= end):
+                break
+            lo, hi = max(p0, start), min(p1, end)
+            tokens = self.piece(p)
+            n_tok = max(min(hi, p1 - 1) - lo, 0)
+            data[lo-start:lo-start+n_tok] = tokens[lo-p0:lo-p0+n_tok]
+            if(hi == p1):
+                data[p1-1-start] = TOKEN_END
+            seg[lo-start:hi-start] = p
+
+        data = torch.from_numpy(data)
+        x   = data[:self.max_seq]
+        tgt = data[1:full_seq].clone()
+
+        # Nothing predicts the first token of the next piece
+        tgt[x == TOKEN_END] = TOKEN_PAD
+
+        if(self.segments):
+            return x, tgt, torch.from_numpy(seg[:self.max_seq])
+        return x, tgt
+
+# load_pieces
+def load_pieces(root):
+    """
+    ----------
+    Loads every pre-processed pickle in root into one token array and piece offsets, laid out
+    like the token shards (piece i is tokens[offsets[i]:offsets[i+1]])
+    ----------
+    """
+
+    fs = sorted(os.path.join(root, f) for f in os.listdir(root))
+    pieces = []
+    for f in fs:
+        if(os.path.isfile(f)):
+            with open(f, "rb") as i_stream:
+                pieces.append(np.asarray(pickle.load(i_stream), dtype=np.uint16))
+
+    offsets = np.cumsum([0] + [len(p) for p in pieces], dtype=np.int64)
+    tokens  = np.concatenate(pieces) if pieces else np.zeros(0, dtype=np.uint16)
+    return tokens, offsets
+
 # process_midi
 def process_midi(raw_mid, max_seq, random_seq):
     """
@@ -115,16 +418,35 @@ def process_midi(raw_mid, max_seq, random_seq):
 
 
 # create_epiano_datasets
-def create_epiano_datasets(dataset_root, max_seq, random_seq=True):
+def create_epiano_datasets(dataset_root, max_seq, random_seq=True, shards=False, pack=False, pack_mask=False,
+                           stride=None, epoch_tokens=None):
     """
     ----------
     Author: Damon Gwinn
     ----------
     Creates train, evaluation, and test EPianoDataset objects for a pre-processed (preprocess_midi.py)
-    root containing train, val, and test folders.
+    root containing train, val, and test folders. With shards, creates EPianoShardDataset objects
+    reading the packed token shards (preprocess_midi.py --shards) instead. With pack, creates
+    EPianoPackedDataset objects (with segment ids for the block-diagonal mask given pack_mask).
+    With a stride or epoch_tokens, the train dataset is an EPianoWindowDataset.
     ----------
     """
 
+    if(pack and (stride is not None or epoch_tokens is not None)):
+        raise ValueError("Packed datasets already cover every token, give no window stride or epoch size with pack")
+
+    if(pack):
+        return tuple(EPianoPackedDataset(dataset_root, split, max_seq, random_seq, pack_mask, shards)
+                     for split in ("train", "val", "test"))
+
+    if(stride is not None or epoch_tokens is not None):
+        train_dataset = EPianoWindowDataset(dataset_root, "train", max_seq, stride, epoch_tokens, shards)
+        _, val_dataset, test_dataset = create_epiano_datasets(dataset_root, max_seq, random_seq, shards)
+        return train_dataset, val_dataset, test_dataset
+
+    if(shards):
+        return tuple(EPianoShardDataset(dataset_root, split, max_seq, random_seq) for split in ("train", "val", "test"))
+
     train_root = os.path.join(dataset_root, "train")
     val_root = os.path.join(dataset_root, "val")
     test_root = os.path.join(dataset_root, "test")
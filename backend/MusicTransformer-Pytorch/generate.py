@@ -7,6 +7,8 @@ from third_party.midi_processor.processor import decode_midi, encode_midi
 
 from utilities.argument_funcs import parse_generate_args, print_generate_args
 from model.music_transformer_patched import MusicTransformer
+from model.quantize import quantize_model
+from model.prefix_cache import PrefixCache, checkpoint_hash
 # from model.music_transformer import MusicTransformer
 from dataset.e_piano import create_epiano_datasets, compute_epiano_accuracy, process_midi
 from torch.utils.data import DataLoader
@@ -33,6 +35,12 @@ def main():
         print("WARNING: Forced CPU usage, expect model to perform slower")
         print("")
 
+    # Dynamically quantized weights only run on the cpu
+    if(args.quantized and not args.force_cpu):
+        use_cuda(False)
+        print("Quantized model, using the cpu")
+        print("")
+
     os.makedirs(args.output_dir, exist_ok=True)
 
     # Grabbing dataset if needed
@@ -44,10 +52,12 @@ def main():
     else:
         f = args.primer_file
 
+    primer_id = None
     if(f.isdigit()):
         idx = int(f)
         primer, _  = dataset[idx]
         primer = primer.to(get_device())
+        primer_id = os.path.basename(dataset.data_files[idx])
 
         print("Using primer index:", idx, "(", dataset.data_files[idx], ")")
 
@@ -62,11 +72,38 @@ def main():
 
         print("Using primer file:", f)
 
+    # Extra samples each get their own random dataset primer unless a primer was given
+    primers = [primer[:args.num_prime]]
+    for _ in range(args.num_samples - 1):
+        if(args.primer_file is None):
+            idx = random.randrange(len(dataset))
+            extra_primer, _ = dataset[idx]
+            primers.append(extra_primer[:args.num_prime].to(get_device()))
+
+            print("Using primer index:", idx, "(", dataset.data_files[idx], ")")
+        else:
+            primers.append(primer[:args.num_prime])
+
     model = MusicTransformer(n_layers=args.n_layers, num_heads=args.num_heads,
                 d_model=args.d_model, dim_feedforward=args.dim_feedforward,
                 max_sequence=args.max_sequence, rpr=args.rpr).to(get_device())
 
-    model.load_state_dict(torch.load(args.model_weights))
+    # int8 checkpoints need the quantized module structure before loading
+    if(args.quantized):
+        model = quantize_model(model)
+
+    model.load_state_dict(torch.load(args.model_weights, map_location=get_device()))
+
+    # Optional draft model for speculative decoding (same vocabulary and max_sequence)
+    if(args.draft_weights is None):
+        draft = None
+    else:
+        draft = MusicTransformer(n_layers=args.draft_n_layers, num_heads=args.draft_num_heads,
+                    d_model=args.draft_d_model, dim_feedforward=args.draft_dim_feedforward,
+                    max_sequence=args.max_sequence, rpr=args.draft_rpr).to(get_device())
+
+        draft.load_state_dict(torch.load(args.draft_weights, map_location=get_device()))
+        draft.eval()
 
     # Saving primer first
     f_path = os.path.join(args.output_dir, "primer.mid")
@@ -77,13 +114,37 @@ def main():
     with torch.set_grad_enabled(False):
         if(args.beam > 0):
             print("BEAM:", args.beam)
-            beam_seq = model.generate(primer[:args.num_prime], args.target_seq_length, beam=args.beam)
+            beam_seq = model.generate(primer[:args.num_prime], args.target_seq_length, beam=args.beam,
+                                      length_penalty=args.length_penalty)
 
             f_path = os.path.join(args.output_dir, "beam.mid")
             decode_midi(beam_seq[0].cpu().numpy(), file_path=f_path)
+        elif(args.num_samples > 1):
+            print("RAND DIST BATCH:", args.num_samples)
+            if(args.target_seq_length <= args.max_sequence):
+                rand_seqs = model.generate_batch(primers, args.target_seq_length)
+            # Batches stop at max_sequence, longer samples slide a window one at a time
+            else:
+                rand_seqs = [model.generate(p, args.target_seq_length, beam=0, window_stride=args.window_stride)[0]
+                             for p in primers]
+
+            for i, rand_seq in enumerate(rand_seqs):
+                f_path = os.path.join(args.output_dir, "rand_" + str(i) + ".mid")
+                decode_midi(rand_seq.cpu().numpy(), file_path=f_path)
         else:
             print("RAND DIST")
-            rand_seq = model.generate(primer[:args.num_prime], args.target_seq_length, beam=0)
+
+            # Dataset primers can resume from a cached prefix instead of encoding the primer
+            prefix = None
+            if(args.prefix_cache_dir is not None and primer_id is not None and draft is None and not args.no_kv_cache):
+                prefix_cache = PrefixCache(max_bytes=args.prefix_cache_mb * (1 << 20), cache_dir=args.prefix_cache_dir)
+                key = (checkpoint_hash(args.model_weights), primer_id, args.num_prime)
+                prefix = prefix_cache.prime(model, primer[:args.num_prime], key)
+                print("Primer prefix cache:", "hit" if prefix_cache.hits else "miss")
+
+            rand_seq = model.generate(primer[:args.num_prime], args.target_seq_length, beam=0, use_cache=(not args.no_kv_cache),
+                                      draft=draft, num_draft=args.num_draft, window_stride=args.window_stride,
+                                      cache=prefix, device=get_device())
 
             f_path = os.path.join(args.output_dir, "rand.mid")
             decode_midi(rand_seq[0].cpu().numpy(), file_path=f_path)
@@ -0,0 +1,375 @@
+import torch
+
+from utilities.constants import *
+
+from .kv_cache import KVCache
+
+# generate_batch
+def generate_batch(model, primers, target_seq_length=1024, seeds=None):
+    """
+    ----------
+    Generates one sequence per primer in a single batch using cached incremental decoding.
+
+    Primers may differ in length; they are left padded so that every row advances one token per
+    forward pass. Each row keeps its own length and stops on TOKEN_END or at target_seq_length,
+    after which it is dropped from the batch and costs nothing more. Optional seeds (one per
+    primer) give every row its own random generator so results do not depend on batch makeup.
+
+    target_seq_length may not exceed the model's max_sequence (unlike generate, there is no
+    sliding window fallback).
+
+    Returns a list of 1D tensors, one per primer, in the order given (TOKEN_END is not included).
+    ----------
+    """
+
+    assert (not model.training), "Cannot generate while in training mode"
+    assert (seeds is None) or (len(seeds) == len(primers)), "Need one seed per primer"
+    assert target_seq_length <= model.max_seq, \
+        "Batched generation is limited to max_sequence, use sliding_window_generate per primer for longer pieces"
+
+    device      = next(model.parameters()).device
+    n_seq       = len(primers)
+    primers     = [p.type(TORCH_LABEL_TYPE).to(device) for p in primers]
+    primer_lens = torch.tensor([len(p) for p in primers], dtype=TORCH_LABEL_TYPE, device=device)
+    max_primer  = int(primer_lens.max())
+    min_primer  = int(primer_lens.min())
+
+    print("Generating", n_seq, "sequences of max length:", target_seq_length)
+
+    if(seeds is None):
+        generators = None
+    else:
+        generators = []
+        for seed in seeds:
+            gen = torch.Generator(device=device)
+            gen.manual_seed(seed)
+            generators.append(gen)
+
+    gen_seq = torch.full((n_seq, max(target_seq_length, max_primer)), TOKEN_PAD, dtype=TORCH_LABEL_TYPE, device=device)
+    x       = torch.full((n_seq, max_primer), TOKEN_PAD, dtype=TORCH_LABEL_TYPE, device=device)
+    for i, p in enumerate(primers):
+        gen_seq[i, :len(p)] = p
+        x[i, max_primer - len(p):] = p
+
+    # Cache slots run from the longest primer to the longest possible row
+    capacity    = max_primer + max(0, target_seq_length - min_primer)
+    cache       = KVCache.for_model(model, n_seq, capacity=capacity)
+    cache.pad_lens = max_primer - primer_lens
+
+    cur_lens    = primer_lens.clone()
+    final_lens  = primer_lens.clone()
+    active      = torch.arange(n_seq, device=device)
+
+    # Rows whose primer already fills the target need no generation
+    keep = (cur_lens < target_seq_length)
+    if(not keep.all()):
+        active = active[keep]
+        x = x[keep]
+        cache.index_select(keep.nonzero().squeeze(1))
+
+    n_step = 0
+    while(active.numel() > 0):
+        logits = model.forward_cached(x, cache)
+        token_probs = model.softmax(logits[:, -1, :])[..., :TOKEN_END]
+
+        if(generators is None):
+            distrib = torch.distributions.categorical.Categorical(probs=token_probs)
+            next_token = distrib.sample()
+        else:
+            next_token = torch.stack([
+                torch.multinomial(token_probs[i], 1, generator=generators[row]).squeeze(0)
+                for i, row in enumerate(active.tolist())
+            ])
+
+        ended = (next_token == TOKEN_END)
+        gen_seq[active, cur_lens[active]] = next_token
+        cur_lens[active] += (~ended).long()
+        final_lens[active] = cur_lens[active]
+
+        # Finished rows leave the batch (and the cache) entirely
+        keep = (~ended) & (cur_lens[active] < target_seq_length)
+        if(not keep.all()):
+            rows = keep.nonzero().squeeze(1)
+            active = active[rows]
+            next_token = next_token[rows]
+            cache.index_select(rows)
+
+        x = next_token.unsqueeze(1)
+
+        n_step += 1
+        if(n_step % 50 == 0):
+            print(n_step, "steps,", active.numel(), "/", n_seq, "sequences still generating")
+
+    return [gen_seq[i, :final_lens[i]] for i in range(n_seq)]
+
+# beam_search
+def beam_search(model, primer, target_seq_length=1024, beam=3, length_penalty=0.0, early_stop=True):
+    """
+    ----------
+    Beam search decoding from a single primer using cached incremental decoding.
+
+    The beam hypotheses live as one (beam, L) batch that is scored with summed log-probabilities
+    and runs through a single forward pass per step. Hypotheses (and their key/value caches) are
+    reordered with index_select. A hypothesis that emits TOKEN_END is finished; with early_stop,
+    search ends once beam hypotheses have finished. Final scores are divided by the GNMT length
+    penalty ((5 + n) / 6) ** length_penalty over the n generated tokens (0.0 disables it).
+
+    Returns the best sequence as (1, length), including the primer and without TOKEN_END.
+    ----------
+    """
+
+    assert (not model.training), "Cannot generate while in training mode"
+    assert beam > 0, "Beam width must be positive"
+
+    device      = next(model.parameters()).device
+    primer      = primer.type(TORCH_LABEL_TYPE).to(device)
+    num_primer  = len(primer)
+
+    print("Beam searching sequence of max length:", target_seq_length, "with beam:", beam)
+
+    gen_seq = torch.full((1, target_seq_length), TOKEN_PAD, dtype=TORCH_LABEL_TYPE, device=device)
+    gen_seq[0, :num_primer] = primer
+
+    scores  = torch.zeros(1, device=device)
+    cache   = KVCache.for_model(model, 1, capacity=max(target_seq_length, num_primer))
+    x       = gen_seq[:, :num_primer]
+
+    def normalize(score, n_gen):
+        return score / (((5.0 + n_gen) / 6.0) ** length_penalty)
+
+    finished = []   # (normalized score, sequence)
+    cur_i = num_primer
+    while(cur_i < target_seq_length):
+        logits      = model.forward_cached(x, cache)
+        log_probs   = torch.log_softmax(logits[:, -1, :], dim=-1)
+        log_probs[:, TOKEN_PAD] = float("-inf")
+
+        cand        = (scores.unsqueeze(1) + log_probs).flatten()
+
+        # Twice the beam so enough candidates survive after removing finished ones
+        top_scores, top_i = torch.topk(cand, min(2 * beam, cand.numel()))
+        top_rows    = top_i // VOCAB_SIZE
+        top_tokens  = top_i % VOCAB_SIZE
+
+        is_end = (top_tokens == TOKEN_END)
+        for s, r in zip(top_scores[is_end].tolist(), top_rows[is_end].tolist()):
+            finished.append((normalize(s, cur_i - num_primer + 1), gen_seq[r, :cur_i].clone()))
+
+        live        = (~is_end).nonzero().squeeze(1)[:beam]
+        rows        = top_rows[live]
+        scores      = top_scores[live]
+        gen_seq     = gen_seq.index_select(0, rows)
+        gen_seq[:, cur_i] = top_tokens[live]
+        cache.index_select(rows)
+
+        cur_i += 1
+        if(cur_i % 50 == 0):
+            print(cur_i, "/", target_seq_length)
+
+        if(early_stop and len(finished) >= beam):
+            print("Beam search finished", len(finished), "hypotheses at:", cur_i, "/", target_seq_length)
+            break
+
+        x = gen_seq[:, cur_i-1:cur_i]
+
+    # Hypotheses still alive compete with the finished ones
+    if(len(finished) < beam or not early_stop):
+        for s, r in zip(scores.tolist(), range(gen_seq.shape[0])):
+            finished.append((normalize(s, cur_i - num_primer), gen_seq[r, :cur_i].clone()))
+
+    best = max(finished, key=lambda f: f[0])[1]
+    return best.unsqueeze(0)
+
+# speculative_generate
+def speculative_generate(model, draft, primer, target_seq_length=1024, num_draft=4):
+    """
+    ----------
+    Speculative sampling (https://arxiv.org/abs/2211.17192) with a small draft MusicTransformer
+    sharing the token vocabulary.
+
+    Each round the draft proposes up to num_draft tokens one at a time, then the full model scores
+    all of them in a single cached forward pass. Draft token x is accepted with probability
+    min(1, p(x) / q(x)); the first rejected token is resampled from max(0, p - q), and when every
+    draft token is accepted one extra token is sampled from the full model. The output follows the
+    same distribution as sampling from the full model alone.
+
+    Returns the generated sequence as (1, length), including the primer.
+    ----------
+    """
+
+    assert (not model.training) and (not draft.training), "Cannot generate while in training mode"
+    assert num_draft > 0, "Need at least one draft token per round"
+
+    device      = next(model.parameters()).device
+    primer      = primer.type(TORCH_LABEL_TYPE).to(device)
+    num_primer  = len(primer)
+
+    print("Generating sequence of max length:", target_seq_length, "with", num_draft, "draft tokens per step")
+
+    gen_seq = torch.full((1, target_seq_length), TOKEN_PAD, dtype=TORCH_LABEL_TYPE, device=device)
+    gen_seq[0, :num_primer] = primer
+
+    cache       = KVCache.for_model(model, 1, capacity=target_seq_length)
+    draft_cache = KVCache.for_model(draft, 1, capacity=target_seq_length)
+
+    def token_dist(m, logits):
+        probs = m.softmax(logits)[..., :TOKEN_END]
+        return probs / probs.sum(dim=-1, keepdim=True)
+
+    n_proposed  = 0
+    n_accepted  = 0
+    cur_i       = num_primer
+    while(cur_i < target_seq_length):
+        # Leave room for the token sampled by the full model after the drafts
+        n_draft = min(num_draft, target_seq_length - cur_i - 1)
+
+        draft_probs = []
+        for i in range(n_draft):
+            logits = draft.forward_cached(gen_seq[:, draft_cache.length:cur_i+i], draft_cache)
+            q = token_dist(draft, logits[0, -1])
+            gen_seq[0, cur_i+i] = torch.multinomial(q, 1)[0]
+            draft_probs.append(q)
+
+        # One pass of the full model scores every draft token plus the one after them
+        logits = model.forward_cached(gen_seq[:, cache.length:cur_i+n_draft], cache)
+        p_all = token_dist(model, logits[0, -(n_draft+1):])
+
+        n_ok = 0
+        while(n_ok < n_draft):
+            tok = gen_seq[0, cur_i+n_ok]
+            p_tok = p_all[n_ok, tok]
+            q_tok = draft_probs[n_ok][tok]
+            if(torch.rand(1, device=device)[0] * q_tok > p_tok):
+                break
+            n_ok += 1
+
+        if(n_ok < n_draft):
+            residual = (p_all[n_ok] - draft_probs[n_ok]).clamp(min=0)
+            if(residual.sum() <= 0):
+                residual = p_all[n_ok]
+            next_token = torch.multinomial(residual / residual.sum(), 1)[0]
+        else:
+            next_token = torch.multinomial(p_all[n_draft], 1)[0]
+
+        gen_seq[0, cur_i+n_ok] = next_token
+
+        n_proposed  += n_draft
+        n_accepted  += n_ok
+        prev_i      = cur_i
+        cur_i       += n_ok + 1
+
+        # Both caches keep everything except the newest token, which is fed next round
+        cache.crop(cur_i - 1)
+        draft_cache.crop(min(draft_cache.length, cur_i - 1))
+
+        if(cur_i // 50 != prev_i // 50):
+            print(cur_i, "/", target_seq_length)
+
+    if(n_proposed > 0):
+        print("Draft acceptance rate:", n_accepted / n_proposed, "(", n_accepted, "/", n_proposed, ")")
+
+    return gen_seq[:, :cur_i]
+
+# stream_generate
+def stream_generate(model, primer, target_seq_length=1024, window_stride=None, cache=None):
+    """
+    ----------
+    Generator version of sampling with the KV cache. Yields each new token (as an int) as soon as
+    it is sampled, so downstream stages (see StreamingDecoder in the midi processor) can start
+    before the piece is complete. The primer itself is not yielded.
+
+    Samples exactly like MusicTransformer.generate, so for a fixed seed the yielded tokens are
+    the tokens generate appends after the primer.
+
+    A target_seq_length past the model's max_sequence is generated with a sliding window: once
+    max_sequence tokens are cached, the newest max_sequence - window_stride tokens (window_stride
+    defaults to half of max_sequence) are re-encoded as a fresh window starting at position 0 and
+    decoding continues from there. Each re-encode is amortized over window_stride new tokens, so
+    the cost per token stays bounded and long pieces take time linear in their length.
+
+    A cache already holding the start of the primer (see PrefixCache) is resumed from instead of
+    running those tokens through the model again.
+    ----------
+    """
+
+    assert (not model.training), "Cannot generate while in training mode"
+
+    max_seq = model.max_seq
+    if(window_stride is None):
+        window_stride = max_seq // 2
+    assert 0 < window_stride < max_seq, "window_stride must be between 0 and max_sequence"
+
+    device      = next(model.parameters()).device
+    primer      = primer.type(TORCH_LABEL_TYPE).to(device)
+    num_primer  = len(primer)
+
+    # The first n_window tokens of window are the newest tokens of the sequence, those from
+    # cache.length on are not cached yet. One slot past capacity holds the token that forces a slide.
+    if(cache is None):
+        capacity    = min(max(target_seq_length, num_primer), max_seq)
+        cache       = KVCache.for_model(model, 1, capacity=capacity)
+    else:
+        capacity    = cache.capacity
+        assert capacity <= max_seq, "KVCache capacity is past max_sequence"
+        assert cache.length < num_primer <= capacity, "Cache does not hold a prefix of this primer"
+
+    window      = torch.full((1, capacity + 1), TOKEN_PAD, dtype=TORCH_LABEL_TYPE, device=device)
+    n_window    = min(num_primer, capacity)
+    window[0, :n_window] = primer[num_primer-n_window:]
+
+    cur_i = num_primer
+    while(cur_i < target_seq_length):
+        if(n_window > capacity):
+            # Slide: drop the oldest tokens and re-encode the rest from position 0
+            n_keep = max_seq - window_stride
+            window[0, :n_keep] = window[0, n_window-n_keep:n_window].clone()
+            n_window = n_keep
+            cache.crop(0)
+
+        x = window[:, cache.length:n_window]
+        token_probs = model.softmax(model.forward_cached(x, cache))[..., :TOKEN_END][:, -1, :]
+
+        distrib = torch.distributions.categorical.Categorical(probs=token_probs)
+        next_token = distrib.sample()
+
+        # Let the transformer decide to end if it wants to
+        if(next_token == TOKEN_END):
+            return
+
+        yield int(next_token)
+
+        window[0, n_window] = next_token
+        n_window += 1
+        cur_i += 1
+
+# sliding_window_generate
+def sliding_window_generate(model, primer, target_seq_length=1024, window_stride=None, cache=None):
+    """
+    ----------
+    Samples a piece of any length, sliding a max_sequence window over it once it outgrows the
+    model's context (see stream_generate).
+
+    Returns the generated sequence as (1, length), including the primer.
+    ----------
+    """
+
+    device      = next(model.parameters()).device
+    primer      = primer.type(TORCH_LABEL_TYPE).to(device)
+    num_primer  = len(primer)
+
+    print("Generating sequence of max length:", target_seq_length, "with a sliding window of:", model.max_seq)
+
+    gen_seq = torch.full((1, max(target_seq_length, num_primer)), TOKEN_PAD, dtype=TORCH_LABEL_TYPE, device=device)
+    gen_seq[0, :num_primer] = primer
+
+    cur_i = num_primer
+    for token in stream_generate(model, primer, target_seq_length, window_stride=window_stride, cache=cache):
+        gen_seq[0, cur_i] = token
+        cur_i += 1
+        if(cur_i % 50 == 0):
+            print(cur_i, "/", target_seq_length)
+
+    if(cur_i < target_seq_length):
+        print("Model called end of sequence at:", cur_i, "/", target_seq_length)
+
+    return gen_seq[:, :cur_i]
@@ -0,0 +1,257 @@
+import torch
+from torch.nn import functional as F
+
+from .rpr import rpr_cached_logits
+
+# KVCache
+class KVCache:
+    """
+    ----------
+    Per-layer key/value cache for incremental decoding with MusicTransformer.
+
+    Keys and values are stored pre-allocated as (batch, heads, capacity, head_dim) so that every
+    decoding step only projects the newest tokens and attends over what is already cached.
+    Capacity defaults to max_sequence since neither the positional encoding nor Er extend past it.
+
+    Rows of a batch may be left padded to a common length (pad_lens). Padded slots are never
+    attended to by real tokens and positions are counted from each row's first real token.
+    ----------
+    """
+
+    def __init__(self, n_layers, batch_size, num_heads, head_dim, capacity, dtype=torch.float32, device=None):
+        self.n_layers   = n_layers
+        self.num_heads  = num_heads
+        self.head_dim   = head_dim
+        self.capacity   = capacity
+        self.length     = 0
+        self.pad_lens   = None
+
+        shape = (batch_size, num_heads, capacity, head_dim)
+        self.keys   = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(n_layers)]
+        self.values = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(n_layers)]
+
+    @classmethod
+    def for_model(cls, model, batch_size=1, capacity=None):
+        """
+        ----------
+        Builds an empty cache sized for the given MusicTransformer
+        ----------
+        """
+
+        param = next(model.parameters())
+        if(capacity is None):
+            capacity = model.max_seq
+
+        return cls(model.nlayers, batch_size, model.nhead, model.d_model // model.nhead, capacity,
+                   dtype=param.dtype, device=param.device)
+
+    @property
+    def batch_size(self):
+        return self.keys[0].shape[0]
+
+    # update
+    def update(self, layer_idx, k, v):
+        """
+        ----------
+        Writes new keys and values (batch, heads, n_new, head_dim) for a layer after the cached
+        positions and returns the full keys and values seen so far. Call advance once all layers
+        have been updated.
+        ----------
+        """
+
+        start   = self.length
+        end     = start + k.shape[2]
+        assert end <= self.capacity, "KVCache capacity exceeded (%d > %d)" % (end, self.capacity)
+
+        self.keys[layer_idx][:, :, start:end]   = k
+        self.values[layer_idx][:, :, start:end] = v
+
+        return self.keys[layer_idx][:, :, :end], self.values[layer_idx][:, :, :end]
+
+    # advance
+    def advance(self, n):
+        """
+        ----------
+        Marks n more positions as cached
+        ----------
+        """
+
+        self.length += n
+
+    # crop
+    def crop(self, length):
+        """
+        ----------
+        Forgets every cached position from length onwards (e.g. rejected speculative tokens)
+        ----------
+        """
+
+        assert length <= self.length, "Cannot crop KVCache to a longer length"
+        self.length = length
+
+    # index_select
+    def index_select(self, rows):
+        """
+        ----------
+        Reorders, duplicates or drops batch rows of the cache in place. Used when hypotheses are
+        reordered during beam search and when finished rows leave a batch.
+        ----------
+        """
+
+        for i in range(self.n_layers):
+            self.keys[i]    = self.keys[i].index_select(0, rows)
+            self.values[i]  = self.values[i].index_select(0, rows)
+
+        if(self.pad_lens is not None):
+            self.pad_lens = self.pad_lens.index_select(0, rows)
+
+    # snapshot
+    def snapshot(self):
+        """
+        ----------
+        Copies out the cached keys and values (up to length) as a dict that restore can load into
+        another cache with the same model. Used to keep primer prefixes around (see PrefixCache).
+        ----------
+        """
+
+        return {
+            "length": self.length,
+            "keys":   [k[:, :, :self.length].clone() for k in self.keys],
+            "values": [v[:, :, :self.length].clone() for v in self.values],
+        }
+
+    # restore
+    def restore(self, snapshot):
+        """
+        ----------
+        Loads a snapshot into this (empty or reused) cache, replacing its contents
+        ----------
+        """
+
+        length = snapshot["length"]
+        assert length <= self.capacity, "KVCache capacity exceeded (%d > %d)" % (length, self.capacity)
+
+        for i in range(self.n_layers):
+            self.keys[i][:, :, :length]     = snapshot["keys"][i]
+            self.values[i][:, :, :length]   = snapshot["values"][i]
+
+        self.length     = length
+        self.pad_lens   = None
+
+
+# incremental_forward
+def incremental_forward(model, x, cache):
+    """
+    ----------
+    Runs MusicTransformer on the new tokens x (batch, n_new) given the cache of everything before
+    them. Returns logits for the new positions only (batch, n_new, VOCAB_SIZE) and advances the cache.
+
+    Equivalent to model.forward on the full sequence followed by slicing out the last n_new rows.
+    ----------
+    """
+
+    offset = cache.length
+    if(cache.pad_lens is not None):
+        offset = offset - cache.pad_lens
+
+    x = model.embedding(x)
+    x = x.permute(1,0,2)
+    x = model.positional_encoding(x, offset=offset)
+
+    encoder = model.transformer.encoder
+    for i, layer in enumerate(encoder.layers):
+        x = _encoder_layer_cached(layer, x, cache, i)
+
+    if(encoder.norm is not None):
+        x = encoder.norm(x)
+
+    cache.advance(x.shape[0])
+
+    x = x.permute(1,0,2)
+    return model.Wout(x)
+
+# _encoder_layer_cached
+def _encoder_layer_cached(layer, src, cache, layer_idx):
+    """
+    ----------
+    Cached equivalent of TransformerEncoderLayer(RPR).forward with a causal mask. Works for both
+    the Pytorch encoder layer and TransformerEncoderLayerRPR since they share parameter names.
+    ----------
+    """
+
+    activation = getattr(layer, "activation", F.relu)
+
+    if(getattr(layer, "norm_first", False)):
+        src = src + layer.dropout1(_self_attention_cached(layer.self_attn, layer.norm1(src), cache, layer_idx))
+        src = src + layer.dropout2(layer.linear2(layer.dropout(activation(layer.linear1(layer.norm2(src))))))
+        return src
+
+    src2 = _self_attention_cached(layer.self_attn, src, cache, layer_idx)
+    src = src + layer.dropout1(src2)
+    src = layer.norm1(src)
+    src2 = layer.linear2(layer.dropout(activation(layer.linear1(src))))
+    src = src + layer.dropout2(src2)
+    src = layer.norm2(src)
+    return src
+
+# _self_attention_cached
+def _self_attention_cached(attn, x, cache, layer_idx):
+    """
+    ----------
+    Causal self attention of the new positions x (n_new, batch, embed_dim) over the cached keys
+    and values plus their own. Adds the relative position term when the module carries Er.
+    ----------
+    """
+
+    tgt_len, bsz, embed_dim = x.size()
+    num_heads   = attn.num_heads
+    head_dim    = embed_dim // num_heads
+    scaling     = float(head_dim) ** -0.5
+    past_len    = cache.length
+
+    # Quantized models carry the input projection as an nn.Linear (see model/quantize.py)
+    in_proj = getattr(attn, "in_proj", None)
+    if(isinstance(in_proj, torch.nn.Module)):
+        q, k, v = in_proj(x).chunk(3, dim=-1)
+    else:
+        q, k, v = F.linear(x, attn.in_proj_weight, attn.in_proj_bias).chunk(3, dim=-1)
+    q = q * scaling
+
+    # (n_new, batch, embed_dim) -> (batch, heads, n_new, head_dim)
+    q = q.contiguous().view(tgt_len, bsz, num_heads, head_dim).permute(1, 2, 0, 3)
+    k = k.contiguous().view(tgt_len, bsz, num_heads, head_dim).permute(1, 2, 0, 3)
+    v = v.contiguous().view(tgt_len, bsz, num_heads, head_dim).permute(1, 2, 0, 3)
+
+    k, v = cache.update(layer_idx, k, v)
+    src_len = k.shape[2]
+
+    attn_weights = torch.matmul(q, k.transpose(-2, -1))
+
+    er = getattr(attn, "Er", None)
+    if(er is not None):
+        attn_weights += rpr_cached_logits(q, er, past_len)
+
+    # A single new token may attend to everything cached, blocks need the causal mask
+    q_pos = torch.arange(past_len, src_len, device=x.device).unsqueeze(1)
+    k_pos = torch.arange(src_len, device=x.device).unsqueeze(0)
+    mask = None
+    if(tgt_len > 1):
+        mask = (k_pos > q_pos)
+
+    # Real tokens never see left padding. Padding queries still see padding keys so that no
+    # softmax row is fully masked (which would produce nan).
+    if(cache.pad_lens is not None):
+        pad = cache.pad_lens.view(bsz, 1, 1, 1)
+        pad_mask = (k_pos < pad) & (q_pos >= pad)
+        mask = pad_mask if mask is None else (mask | pad_mask)
+
+    if(mask is not None):
+        attn_weights = attn_weights.masked_fill(mask, float("-inf"))
+
+    attn_weights = F.softmax(attn_weights, dim=-1)
+    attn_weights = F.dropout(attn_weights, p=attn.dropout, training=attn.training)
+
+    attn_output = torch.matmul(attn_weights, v)
+    attn_output = attn_output.permute(2, 0, 1, 3).contiguous().view(tgt_len, bsz, embed_dim)
+
+    return attn.out_proj(attn_output)
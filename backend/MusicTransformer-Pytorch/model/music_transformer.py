@@ -1,13 +1,16 @@
 import torch
 import torch.nn as nn
 from torch.nn.modules.normalization import LayerNorm
-import random
+import warnings
 
 from utilities.constants import *
 from utilities.device import get_device
 
 from .positional_encoding import PositionalEncoding
+from .kv_cache import KVCache, incremental_forward
+from .generation import generate_batch, beam_search, speculative_generate, stream_generate, sliding_window_generate
 from .rpr import TransformerEncoderRPR, TransformerEncoderLayerRPR
+from .rpr import segment_attn_mask
 
 
 # MusicTransformer
@@ -29,7 +32,7 @@ class MusicTransformer(nn.Module):
     """
 
     def __init__(self, n_layers=6, num_heads=8, d_model=512, dim_feedforward=1024,
-                 dropout=0.1, max_sequence=2048, rpr=False):
+                 dropout=0.1, max_sequence=2048, rpr=False, rpr_block_size=None):
         super(MusicTransformer, self).__init__()
 
         self.dummy      = DummyDecoder()
@@ -41,6 +44,8 @@ class MusicTransformer(nn.Module):
         self.dropout    = dropout
         self.max_seq    = max_sequence
         self.rpr        = rpr
+        self.rpr_block  = rpr_block_size
+        self.quantized  = False # Set by model.quantize.quantize_model
 
         # Input embedding
         self.embedding = nn.Embedding(VOCAB_SIZE, self.d_model)
@@ -60,7 +65,7 @@ class MusicTransformer(nn.Module):
         # RPR Transformer
         else:
             encoder_norm = LayerNorm(self.d_model)
-            encoder_layer = TransformerEncoderLayerRPR(self.d_model, self.nhead, self.d_ff, self.dropout, er_len=self.max_seq)
+            encoder_layer = TransformerEncoderLayerRPR(self.d_model, self.nhead, self.d_ff, self.dropout, er_len=self.max_seq, block_size=self.rpr_block)
             encoder = TransformerEncoderRPR(encoder_layer, self.nlayers, encoder_norm)
             self.transformer = nn.Transformer(
                 d_model=self.d_model, nhead=self.nhead, num_encoder_layers=self.nlayers,
@@ -73,7 +78,7 @@ class MusicTransformer(nn.Module):
         self.softmax    = nn.Softmax(dim=-1)
 
     # forward
-    def forward(self, x, mask=True):
+    def forward(self, x, mask=True, segments=None):
         """
         ----------
         Author: Damon Gwinn
@@ -81,11 +86,17 @@ class MusicTransformer(nn.Module):
         Takes an input sequence and outputs predictions using a sequence to sequence method.
 
         A prediction at one index is the "next" prediction given all information seen previously.
+
+        For packed batches (EPianoPackedDataset), segments gives the piece of every position and
+        positions only attend to earlier positions of the same piece.
         ----------
         """
 
         if(mask is True):
             mask = self.transformer.generate_square_subsequent_mask(x.shape[1]).to(get_device())
+            # torch's own attention only takes the segments as a dense (batch * heads, L, L) mask
+            if(segments is not None and not self.rpr):
+                mask = segment_attn_mask(mask, segments, self.nhead)
         else:
             mask = None
 
@@ -98,7 +109,12 @@ class MusicTransformer(nn.Module):
 
         # Since there are no true decoder layers, the tgt is unused
         # Pytorch wants src and tgt to have some equal dims however
-        x_out = self.transformer(src=x, tgt=x, src_mask=mask)
+        if(segments is not None and self.rpr):
+            # The RPR attention masks from the segment ids itself (per tile when tiled). nn.Transformer
+            # cannot pass them on, and its decoder only returns the encoder output
+            x_out = self.transformer.encoder(x, mask=mask, segments=segments)
+        else:
+            x_out = self.transformer(src=x, tgt=x, src_mask=mask)
 
         # Back to (batch_size, max_seq, d_model)
         x_out = x_out.permute(1,0,2)
@@ -111,19 +127,76 @@ class MusicTransformer(nn.Module):
         # They are trained to predict the next note in sequence (we don't need the last one)
         return y
 
+    # forward_cached
+    def forward_cached(self, x, cache):
+        """
+        ----------
+        Incremental forward for generation. Takes only the tokens not yet in the KVCache and
+        returns their predictions, reusing the cached keys and values of every earlier position.
+        ----------
+        """
+
+        return incremental_forward(self, x, cache)
+
+    # new_cache
+    def new_cache(self, batch_size=1):
+        """
+        ----------
+        Creates an empty KVCache for this model
+        ----------
+        """
+
+        return KVCache.for_model(self, batch_size)
+
     # generate
-    def generate(self, primer=None, target_seq_length=1024, beam=0, beam_chance=1.0):
+    def generate(self, primer=None, target_seq_length=1024, beam=0, beam_chance=None, use_cache=True,
+                 length_penalty=0.0, early_stop=True, draft=None, num_draft=4, window_stride=None, cache=None):
         """
         ----------
         Author: Damon Gwinn
         ----------
         Generates midi given a primer sample. Music can be generated using a probability distribution over
         the softmax probabilities (recommended) or by using a beam search.
+
+        With use_cache, each step only runs the newest token through the model using per-layer
+        key/value caches instead of re-encoding the whole sequence.
+
+        A beam above 0 runs beam_search (model/generation.py) with the given length_penalty and
+        early_stop. beam_chance is no longer used, passing it only warns.
+
+        Given a small draft MusicTransformer, sampling uses speculative decoding: the draft proposes
+        num_draft tokens that are verified by this model in one forward pass, with the same output
+        distribution as sampling from this model alone.
+
+        A target_seq_length past max_sequence samples with a sliding window of max_sequence tokens
+        that moves window_stride tokens at a time (see sliding_window_generate).
+
+        Sampling can resume from a cache that already holds the start of the primer (see
+        model/prefix_cache.py) instead of running the primer through the model.
         ----------
         """
 
         assert (not self.training), "Cannot generate while in training mode"
 
+        if(beam_chance is not None):
+            warnings.warn("beam_chance is no longer used, beam > 0 always runs beam_search", DeprecationWarning, stacklevel=2)
+
+        assert (target_seq_length <= self.max_seq) or (beam == 0 and draft is None), \
+            "Beam search and speculative decoding are limited to max_sequence"
+
+        if(beam > 0):
+            return beam_search(self, primer, target_seq_length, beam, length_penalty=length_penalty, early_stop=early_stop)
+
+        if(draft is not None):
+            return speculative_generate(self, draft, primer, target_seq_length, num_draft=num_draft)
+
+        if(target_seq_length > self.max_seq):
+            return sliding_window_generate(self, primer, target_seq_length, window_stride=window_stride, cache=cache)
+
+        # Quantized attention only exists in the cached path
+        if(self.quantized):
+            use_cache = True
+
         print("Generating sequence of max length:", target_seq_length)
 
         gen_seq = torch.full((1,target_seq_length), TOKEN_PAD, dtype=TORCH_LABEL_TYPE, device=get_device())
@@ -134,38 +207,31 @@ class MusicTransformer(nn.Module):
 
         # print("primer:",primer)
         # print(gen_seq)
+        if(cache is not None):
+            assert cache.length < num_primer, "Cache does not hold a prefix of the primer"
+        elif(use_cache):
+            cache = self.new_cache(batch_size=1)
+
         cur_i = num_primer
         while(cur_i < target_seq_length):
             # gen_seq_batch     = gen_seq.clone()
-            y = self.softmax(self.forward(gen_seq[..., :cur_i]))[..., :TOKEN_END]
-            token_probs = y[:, cur_i-1, :]
-
-            if(beam == 0):
-                beam_ran = 2.0
+            if(cache is None):
+                y = self.softmax(self.forward(gen_seq[..., :cur_i]))[..., :TOKEN_END]
+                token_probs = y[:, cur_i-1, :]
             else:
-                beam_ran = random.uniform(0,1)
+                y = self.softmax(self.forward_cached(gen_seq[..., cache.length:cur_i], cache))[..., :TOKEN_END]
+                token_probs = y[:, -1, :]
 
-            if(beam_ran <= beam_chance):
-                token_probs = token_probs.flatten()
-                top_res, top_i = torch.topk(token_probs, beam)
+            distrib = torch.distributions.categorical.Categorical(probs=token_probs)
+            next_token = distrib.sample()
+            # print("next token:",next_token)
+            gen_seq[:, cur_i] = next_token
 
-                beam_rows = top_i // VOCAB_SIZE
-                beam_cols = top_i % VOCAB_SIZE
 
-                gen_seq = gen_seq[beam_rows, :]
-                gen_seq[..., cur_i] = beam_cols
-
-            else:
-                distrib = torch.distributions.categorical.Categorical(probs=token_probs)
-                next_token = distrib.sample()
-                # print("next token:",next_token)
-                gen_seq[:, cur_i] = next_token
-
-
-                # Let the transformer decide to end if it wants to
-                if(next_token == TOKEN_END):
-                    print("Model called end of sequence at:", cur_i, "/", target_seq_length)
-                    break
+            # Let the transformer decide to end if it wants to
+            if(next_token == TOKEN_END):
+                print("Model called end of sequence at:", cur_i, "/", target_seq_length)
+                break
 
             cur_i += 1
             if(cur_i % 50 == 0):
@@ -173,6 +239,28 @@ class MusicTransformer(nn.Module):
 
         return gen_seq[:, :cur_i]
 
+    # generate_batch
+    def generate_batch(self, primers, target_seq_length=1024, seeds=None):
+        """
+        ----------
+        Generates one sequence per primer as a single batch, sampling from the softmax distribution.
+        Finished rows drop out of the batch. See model/generation.py.
+        ----------
+        """
+
+        return generate_batch(self, primers, target_seq_length, seeds=seeds)
+
+    # generate_stream
+    def generate_stream(self, primer, target_seq_length=1024, window_stride=None, cache=None):
+        """
+        ----------
+        Like generate with random sampling, but yields each token as it is sampled instead of
+        returning the finished sequence. See model/generation.py.
+        ----------
+        """
+
+        return stream_generate(self, primer, target_seq_length, window_stride=window_stride, cache=cache)
+
 # Used as a dummy to nn.Transformer
 # DummyDecoder
 class DummyDecoder(nn.Module):
@@ -18,6 +18,12 @@ class PositionalEncoding(nn.Module):
         pe = pe.unsqueeze(0).transpose(0, 1)
         self.register_buffer('pe', pe)
 
-    def forward(self, x):
-        x = x + self.pe[:x.size(0), :]
+    def forward(self, x, offset=0):
+        # offset is the absolute position of x[0], used by incremental (cached) decoding.
+        # It may also be a per batch row tensor when rows start at different positions.
+        if(torch.is_tensor(offset)):
+            pos = offset.unsqueeze(0) + torch.arange(x.size(0), device=offset.device).unsqueeze(1)
+            x = x + self.pe[pos.clamp(min=0), 0, :]
+        else:
+            x = x + self.pe[offset:offset + x.size(0), :]
         return self.dropout(x)
@@ -0,0 +1,161 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import torch
+
+from .kv_cache import KVCache
+
+# checkpoint_hash
+def checkpoint_hash(path, chunk_size=1 << 20):
+    """
+    ----------
+    Short content hash of a weights file, so cached prefixes are never reused across checkpoints
+    ----------
+    """
+
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+
+    return h.hexdigest()[:16]
+
+# PrefixCache
+class PrefixCache:
+    """
+    ----------
+    Cache of the per-layer key/value state after a primer, keyed by
+    (checkpoint hash, primer id, num_prime).
+
+    Dataset primers come from a small fixed set, so generation can resume from the stored state
+    instead of running the primer through the model every time. The state covers every primer
+    token except the last, which generation feeds as its first step to get the first prediction.
+
+    Entries are kept in memory up to max_bytes, evicting the least recently used. With cache_dir,
+    entries are also written to disk and reloaded from there after eviction or a restart.
+    ----------
+    """
+
+    def __init__(self, max_bytes=256 * (1 << 20), cache_dir=None):
+        self.max_bytes  = max_bytes
+        self.cache_dir  = cache_dir
+        self.n_bytes    = 0
+        self.hits       = 0
+        self.misses     = 0
+
+        self._entries   = OrderedDict()
+        self._lock      = threading.Lock()
+
+        if(cache_dir is not None):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    # get
+    def get(self, key):
+        """
+        ----------
+        Returns the snapshot stored for key (from memory, then disk) or None
+        ----------
+        """
+
+        with self._lock:
+            snapshot = self._entries.get(key)
+            if(snapshot is not None):
+                self._entries.move_to_end(key)
+                return snapshot
+
+        path = self._path(key)
+        if(path is None or not os.path.isfile(path)):
+            return None
+
+        snapshot = torch.load(path, map_location="cpu")
+        self._insert(key, snapshot)
+        return snapshot
+
+    # put
+    def put(self, key, snapshot):
+        """
+        ----------
+        Stores a KVCache snapshot for key in memory and, with cache_dir, on disk
+        ----------
+        """
+
+        path = self._path(key)
+        if(path is not None and not os.path.isfile(path)):
+            # Write then rename so a crash never leaves a truncated entry behind
+            tmp_path = path + ".tmp." + str(os.getpid())
+            torch.save({k: _to_cpu(v) for k, v in snapshot.items()}, tmp_path)
+            os.replace(tmp_path, path)
+
+        self._insert(key, snapshot)
+
+    # prime
+    def prime(self, model, primer, key, capacity=None):
+        """
+        ----------
+        Returns a KVCache for model holding every primer token but the last, restored from the
+        cache when possible and computed (then stored) otherwise. Pass it as cache to
+        generate / generate_stream together with the same primer.
+        ----------
+        """
+
+        cache = KVCache.for_model(model, 1, capacity=capacity)
+        param = next(model.parameters())
+
+        snapshot = self.get(key)
+        if(snapshot is not None):
+            self.hits += 1
+            cache.restore({k: _to(v, param.device, param.dtype) for k, v in snapshot.items()})
+            return cache
+
+        self.misses += 1
+        primer = primer.to(param.device)
+        if(len(primer) > 1):
+            model.forward_cached(primer[:-1].unsqueeze(0), cache)
+
+        self.put(key, cache.snapshot())
+        return cache
+
+    # _insert
+    def _insert(self, key, snapshot):
+        size = _snapshot_bytes(snapshot)
+        if(size > self.max_bytes):
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if(old is not None):
+                self.n_bytes -= _snapshot_bytes(old)
+
+            self._entries[key] = snapshot
+            self.n_bytes += size
+
+            while(self.n_bytes > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self.n_bytes -= _snapshot_bytes(evicted)
+
+    # _path
+    def _path(self, key):
+        if(self.cache_dir is None):
+            return None
+
+        name = "_".join(str(k) for k in key)
+        name = "".join(c if (c.isalnum() or c in "-_.") else "-" for c in name)
+        return os.path.join(self.cache_dir, name + ".kv")
+
+# _snapshot_bytes
+def _snapshot_bytes(snapshot):
+    return sum(t.numel() * t.element_size() for t in snapshot["keys"] + snapshot["values"])
+
+# _to_cpu
+def _to_cpu(v):
+    if(isinstance(v, list)):
+        return [t.cpu() for t in v]
+    return v
+
+# _to
+def _to(v, device, dtype):
+    if(isinstance(v, list)):
+        return [t.to(device=device, dtype=dtype) for t in v]
+    return v
@@ -0,0 +1,64 @@
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic
+
+# quantize_model
+def quantize_model(model, dtype=torch.qint8):
+    """
+    ----------
+    Converts a MusicTransformer to dynamic int8 inference on the CPU (in place, returns the model).
+
+    Every nn.Linear is quantized: Wout, the feedforward linear1/linear2 and the attention out_proj.
+    The packed attention input projection (in_proj_weight / in_proj_bias) is a raw parameter, so it
+    is first moved into an equivalent nn.Linear (attn.in_proj) to be quantized along with the rest.
+    Embeddings, layer norms and the RPR Er matrix stay fp32.
+
+    Quantized models run through the cached incremental path (forward_cached, generate with
+    use_cache) since the Pytorch attention forward expects the raw in_proj_weight.
+
+    To load a quantized checkpoint, build the fp32 model with the same arguments, call
+    quantize_model on it and then load_state_dict.
+    ----------
+    """
+
+    model = model.cpu().eval()
+
+    for layer in model.transformer.encoder.layers:
+        attn = layer.self_attn
+        _split_in_proj(attn)
+
+        # The Pytorch MultiheadAttention out_proj opts out of dynamic quantization by type
+        if(type(attn.out_proj) is not nn.Linear):
+            out_proj = nn.Linear(attn.out_proj.in_features, attn.out_proj.out_features, bias=(attn.out_proj.bias is not None))
+            out_proj.load_state_dict(attn.out_proj.state_dict())
+            attn.out_proj = out_proj
+
+    model = quantize_dynamic(model, {nn.Linear}, dtype=dtype, inplace=True)
+    model.quantized = True
+
+    return model
+
+# _split_in_proj
+def _split_in_proj(attn):
+    """
+    ----------
+    Replaces the packed in_proj_weight / in_proj_bias parameters of an attention module with an
+    equivalent nn.Linear named in_proj
+    ----------
+    """
+
+    if(isinstance(getattr(attn, "in_proj", None), nn.Module)):
+        return
+
+    weight  = attn.in_proj_weight
+    bias    = attn.in_proj_bias
+
+    in_proj = nn.Linear(weight.shape[1], weight.shape[0], bias=(bias is not None))
+    with torch.no_grad():
+        in_proj.weight.copy_(weight)
+        if(bias is not None):
+            in_proj.bias.copy_(bias)
+
+    del attn.in_proj_weight
+    del attn.in_proj_bias
+    attn.in_proj = in_proj
@@ -11,6 +11,7 @@ from torch.nn.modules.normalization import LayerNorm
 from torch.nn.init import *
 
 from torch.nn.functional import linear, softmax, dropout
+from torch.utils.checkpoint import checkpoint
 
 # TransformerEncoderRPR
 class TransformerEncoderRPR(Module):
@@ -31,13 +32,13 @@ class TransformerEncoderRPR(Module):
         self.num_layers = num_layers
         self.norm = norm
 
-    def forward(self, src, mask=None, src_key_padding_mask=None):
+    def forward(self, src, mask=None, src_key_padding_mask=None, segments=None):
 
         output = src
 
         for i in range(self.num_layers):
             output = self.layers[i](output, src_mask=mask,
-                                    src_key_padding_mask=src_key_padding_mask)
+                                    src_key_padding_mask=src_key_padding_mask, segments=segments)
 
         if self.norm:
             output = self.norm(output)
@@ -58,9 +59,9 @@ class TransformerEncoderLayerRPR(Module):
     ----------
     """
 
-    def __init__(self, d_model, nhead, dim_feedforward=2048, dropout=0.1, er_len=None):
+    def __init__(self, d_model, nhead, dim_feedforward=2048, dropout=0.1, er_len=None, block_size=None):
         super(TransformerEncoderLayerRPR, self).__init__()
-        self.self_attn = MultiheadAttentionRPR(d_model, nhead, dropout=dropout, er_len=er_len)
+        self.self_attn = MultiheadAttentionRPR(d_model, nhead, dropout=dropout, er_len=er_len, block_size=block_size)
         # Implementation of Feedforward model
         self.linear1 = Linear(d_model, dim_feedforward)
         self.dropout = Dropout(dropout)
@@ -71,9 +72,9 @@ class TransformerEncoderLayerRPR(Module):
         self.dropout1 = Dropout(dropout)
         self.dropout2 = Dropout(dropout)
 
-    def forward(self, src, src_mask=None, src_key_padding_mask=None):
+    def forward(self, src, src_mask=None, src_key_padding_mask=None, segments=None):
         src2 = self.self_attn(src, src, src, attn_mask=src_mask,
-                              key_padding_mask=src_key_padding_mask)[0]
+                              key_padding_mask=src_key_padding_mask, segments=segments)[0]
         src = src + self.dropout1(src2)
         src = self.norm1(src)
         src2 = self.linear2(self.dropout(F.relu(self.linear1(src))))
@@ -91,11 +92,12 @@ class MultiheadAttentionRPR(Module):
     For Relative Position Representation support (https://arxiv.org/abs/1803.02155)
     https://pytorch.org/docs/1.2.0/_modules/torch/nn/modules/activation.html#MultiheadAttention
 
-    Modification to add RPR embedding Er and call custom multi_head_attention_forward_rpr
+    Modification to add RPR embedding Er and call custom multi_head_attention_forward_rpr.
+    With block_size set, attention is computed in tiles (see rpr_attention_chunked).
     ----------
     """
 
-    def __init__(self, embed_dim, num_heads, dropout=0., bias=True, add_bias_kv=False, add_zero_attn=False, kdim=None, vdim=None, er_len=None):
+    def __init__(self, embed_dim, num_heads, dropout=0., bias=True, add_bias_kv=False, add_zero_attn=False, kdim=None, vdim=None, er_len=None, block_size=None):
         super(MultiheadAttentionRPR, self).__init__()
         self.embed_dim = embed_dim
         self.kdim = kdim if kdim is not None else embed_dim
@@ -134,6 +136,8 @@ class MultiheadAttentionRPR(Module):
         else:
             self.Er = None
 
+        self.block_size = block_size
+
         self._reset_parameters()
 
     def _reset_parameters(self):
@@ -153,7 +157,7 @@ class MultiheadAttentionRPR(Module):
             xavier_normal_(self.bias_v)
 
     def forward(self, query, key, value, key_padding_mask=None,
-                need_weights=True, attn_mask=None):
+                need_weights=True, attn_mask=None, segments=None):
 
         if hasattr(self, '_qkv_same_embed_dim') and self._qkv_same_embed_dim is False:
             # return F.multi_head_attention_forward(
@@ -176,7 +180,8 @@ class MultiheadAttentionRPR(Module):
                 key_padding_mask=key_padding_mask, need_weights=need_weights,
                 attn_mask=attn_mask, use_separate_proj_weight=True,
                 q_proj_weight=self.q_proj_weight, k_proj_weight=self.k_proj_weight,
-                v_proj_weight=self.v_proj_weight, rpr_mat=self.Er)
+                v_proj_weight=self.v_proj_weight, rpr_mat=self.Er, block_size=getattr(self, 'block_size', None),
+                segments=segments)
         else:
             if not hasattr(self, '_qkv_same_embed_dim'):
                 warnings.warn('A new version of MultiheadAttention module has been implemented. \
@@ -199,7 +204,8 @@ class MultiheadAttentionRPR(Module):
                 self.dropout, self.out_proj.weight, self.out_proj.bias,
                 training=self.training,
                 key_padding_mask=key_padding_mask, need_weights=need_weights,
-                attn_mask=attn_mask, rpr_mat=self.Er)
+                attn_mask=attn_mask, rpr_mat=self.Er, block_size=getattr(self, 'block_size', None),
+                segments=segments)
 
 # multi_head_attention_forward_rpr
 def multi_head_attention_forward_rpr(query,                       # type: Tensor
@@ -225,7 +231,9 @@ def multi_head_attention_forward_rpr(query,                       # type: Tensor
                                  v_proj_weight=None,              # type: Optional[Tensor]
                                  static_k=None,                   # type: Optional[Tensor]
                                  static_v=None,                   # type: Optional[Tensor]
-                                 rpr_mat=None
+                                 rpr_mat=None,
+                                 block_size=None,                 # type: Optional[int]
+                                 segments=None                    # type: Optional[Tensor]
                                  ):
     """
     ----------
@@ -235,7 +243,10 @@ def multi_head_attention_forward_rpr(query,                       # type: Tensor
     For Relative Position Representation support (https://arxiv.org/abs/1803.02155)
     https://pytorch.org/docs/1.2.0/_modules/torch/nn/functional.html
 
-    Modification to take RPR embedding matrix and perform skew optimized RPR (https://arxiv.org/abs/1809.04281)
+    Modification to take RPR embedding matrix and perform skew optimized RPR (https://arxiv.org/abs/1809.04281).
+    With block_size, RPR attention runs tiled in memory linear in the sequence length
+    (rpr_attention_chunked) and no attention weights are returned. segments, the (bsz, L) segment
+    ids of a packed batch, keeps every position from attending to other segments.
     ----------
     """
 
@@ -391,6 +402,21 @@ def multi_head_attention_forward_rpr(query,                       # type: Tensor
                                                dtype=key_padding_mask.dtype,
                                                device=key_padding_mask.device)], dim=1)
 
+    ######### CHUNKED RPR ###########
+    if(rpr_mat is not None and block_size is not None):
+        if key_padding_mask is not None:
+            key_padding_mask = key_padding_mask.repeat_interleave(num_heads, dim=0)
+
+        if segments is not None:
+            segments = segments.repeat_interleave(num_heads, dim=0)
+
+        attn_output = rpr_attention_chunked(q, k, v, rpr_mat, attn_mask=attn_mask, key_padding_mask=key_padding_mask,
+                                            block_size=block_size, dropout_p=dropout_p, training=training,
+                                            segments=segments)
+        attn_output = attn_output.transpose(0, 1).contiguous().view(tgt_len, bsz, embed_dim)
+        attn_output = linear(attn_output, out_proj_weight, out_proj_bias)
+        return attn_output, None
+
     attn_output_weights = torch.bmm(q, k.transpose(1, 2))
     assert list(attn_output_weights.size()) == [bsz * num_heads, tgt_len, src_len]
 
@@ -414,6 +440,14 @@ def multi_head_attention_forward_rpr(query,                       # type: Tensor
         )
         attn_output_weights = attn_output_weights.view(bsz * num_heads, tgt_len, src_len)
 
+    if segments is not None:
+        attn_output_weights = attn_output_weights.view(bsz, num_heads, tgt_len, src_len)
+        attn_output_weights = attn_output_weights.masked_fill(
+            (segments.unsqueeze(2) != segments.unsqueeze(1)).unsqueeze(1),
+            float('-inf'),
+        )
+        attn_output_weights = attn_output_weights.view(bsz * num_heads, tgt_len, src_len)
+
     attn_output_weights = softmax(
         attn_output_weights, dim=-1)
 
@@ -462,3 +496,176 @@ def _skew(qe):
 
     srel = qe[:, 1:, :]
     return srel
+
+def rpr_cached_logits(q, Er, past_len):
+    """
+    ----------
+    Relative position logits for incremental decoding. q holds the (already scaled) queries for
+    the new positions past_len .. past_len + n_new - 1 as (batch, heads, n_new, head_dim).
+    Returns (batch, heads, n_new, past_len + n_new).
+
+    Matches _skew without building the L x L qe matrix: query i and key j <= i use
+    Er[len_e - 1 - (i - j)], so a single new row is just q against the last src_len rows of Er.
+    A block of rows is the same product shifted by one column per row, done with a gather over
+    n_new x src_len entries. Entries for j > i are meaningless and must be masked by the caller.
+    ----------
+    """
+
+    n_new   = q.shape[2]
+    src_len = past_len + n_new
+    len_e   = Er.shape[0]
+
+    # Row m of er_win holds relative distance src_len - 1 - m
+    er_win  = Er[max(0, len_e - src_len):, :]
+    qe      = torch.matmul(q, er_win.t())
+
+    # Distances past len_e can only reach left padding of a batch (masked by the caller)
+    if(src_len > len_e):
+        qe = F.pad(qe, (src_len - len_e, 0))
+
+    if(n_new == 1):
+        return qe
+
+    # Query row t (distance offset n_new - 1 - t from the last row) reads qe[t, j + n_new - 1 - t]
+    shift   = torch.arange(n_new - 1, -1, -1, device=q.device).unsqueeze(1)
+    idx     = (torch.arange(src_len, device=q.device).unsqueeze(0) + shift).clamp(max=src_len - 1)
+    idx     = idx.expand(qe.shape[0], qe.shape[1], n_new, src_len)
+
+    return torch.gather(qe, -1, idx)
+
+def segment_attn_mask(attn_mask, segments, num_heads):
+    """
+    ----------
+    Combines the additive (L, L) attn_mask with a block-diagonal mask from the (bsz, L) segment
+    ids of a packed batch: query i may only attend to key j when both are in the same segment.
+    Returns the dense (bsz * num_heads, L, L) additive mask torch's own attention needs (the
+    non-RPR model). The RPR attention takes the segment ids directly and never builds it.
+    ----------
+    """
+
+    same = segments.unsqueeze(2) == segments.unsqueeze(1)
+    mask = attn_mask.unsqueeze(0).masked_fill(~same.to(attn_mask.device), float('-inf'))
+    return mask.repeat_interleave(num_heads, dim=0)
+
+def rpr_attention_chunked(q, k, v, Er, attn_mask=None, key_padding_mask=None, block_size=256, dropout_p=0.0, training=True,
+                          segments=None):
+    """
+    ----------
+    Block-wise (flash-style) version of the RPR attention in multi_head_attention_forward_rpr.
+    q (already scaled), k and v are (bsz * heads, L, head_dim), attn_mask is the additive (L, L)
+    mask and key_padding_mask is (bsz * heads, L). With segments, the (bsz * heads, L) segment ids
+    of a packed batch, keys of another segment are masked out as well. Returns the attention
+    output with the shape of q.
+
+    Each block of queries runs an online softmax over key blocks, adding the relative term per
+    tile (_rpr_tile), so no (bsz * heads, L, L) tensor is ever built. Key tiles that attn_mask
+    masks out entirely (above the diagonal for the causal mask) are skipped. When gradients are
+    needed each query block is checkpointed and recomputed in backward, keeping training memory
+    linear in L as well. Gives the same results as the full computation up to float rounding.
+    ----------
+    """
+
+    tgt_len = q.shape[1]
+
+    # A real tensor input makes checkpoint recompute the block even when only weights need grad
+    track_grad = torch.is_grad_enabled() and (q.requires_grad or k.requires_grad or v.requires_grad or Er.requires_grad)
+
+    out = []
+    for i0 in range(0, tgt_len, block_size):
+        i1 = min(i0 + block_size, tgt_len)
+        if(track_grad):
+            out.append(checkpoint(_rpr_query_block, q[:, i0:i1], k, v, Er, attn_mask, key_padding_mask,
+                                  i0, block_size, dropout_p, training, segments, use_reentrant=False))
+        else:
+            out.append(_rpr_query_block(q[:, i0:i1], k, v, Er, attn_mask, key_padding_mask,
+                                        i0, block_size, dropout_p, training, segments))
+
+    return torch.cat(out, dim=1)
+
+def _rpr_query_block(q_blk, k, v, Er, attn_mask, key_padding_mask, i0, block_size, dropout_p, training, segments=None):
+    """
+    ----------
+    Online softmax attention of the queries i0 .. i0 + len(q_blk) - 1 over all keys, one key
+    tile at a time
+    ----------
+    """
+
+    n, n_q, head_dim = q_blk.shape
+    src_len = k.shape[1]
+    i1 = i0 + n_q
+
+    row_max = torch.full((n, n_q, 1), float('-inf'), dtype=q_blk.dtype, device=q_blk.device)
+    row_sum = torch.zeros((n, n_q, 1), dtype=q_blk.dtype, device=q_blk.device)
+    acc = torch.zeros((n, n_q, head_dim), dtype=q_blk.dtype, device=q_blk.device)
+
+    for j0 in range(0, src_len, block_size):
+        j1 = min(j0 + block_size, src_len)
+
+        mask_tile = None
+        if attn_mask is not None:
+            mask_tile = attn_mask[i0:i1, j0:j1]
+            if torch.isneginf(mask_tile).all():
+                continue
+
+        # Packed batches: the segment mask of the tile, tiles between two segments are skipped
+        other_tile = None
+        if segments is not None:
+            other_tile = segments[:, i0:i1, None] != segments[:, None, j0:j1]
+            if other_tile.all():
+                continue
+
+        scores = torch.bmm(q_blk, k[:, j0:j1].transpose(1, 2))
+        scores = scores + _rpr_tile(q_blk, Er, i0, j0, j1)
+
+        if mask_tile is not None:
+            scores = scores + mask_tile
+        if key_padding_mask is not None:
+            scores = scores.masked_fill(key_padding_mask[:, None, j0:j1], float('-inf'))
+        if other_tile is not None:
+            scores = scores.masked_fill(other_tile, float('-inf'))
+
+        new_max = torch.maximum(row_max, scores.amax(dim=-1, keepdim=True))
+
+        # Rows without any unmasked key so far shift by 0 instead of -inf (avoids nan from inf - inf)
+        shift = new_max.masked_fill(torch.isneginf(new_max), 0.0)
+        probs = torch.exp(scores - shift)
+        rescale = torch.exp(row_max - shift)
+
+        # Dropout applies to the weights after normalizing, so the normalizer uses the undropped probs
+        row_sum = row_sum * rescale + probs.sum(dim=-1, keepdim=True)
+        probs = dropout(probs, p=dropout_p, training=training)
+        acc = acc * rescale + torch.bmm(probs, v[:, j0:j1])
+        row_max = new_max
+
+    return acc / row_sum
+
+def _rpr_tile(q_blk, Er, i0, j0, j1):
+    """
+    ----------
+    Relative logits of the queries i0 .. i0 + len(q_blk) - 1 for the keys j0 .. j1 - 1, the same
+    values _skew produces for that tile: q_i . Er[len_e - 1 - (i - j)] for j <= i and 0 for j > i.
+    Only the Er rows for the distances the tile spans are multiplied.
+    ----------
+    """
+
+    n, n_q, _ = q_blk.shape
+    n_k = j1 - j0
+    len_e = Er.shape[0]
+
+    # Distances i - j covered by the tile, limited to those with a relative embedding
+    d_max = min(i0 + n_q - 1 - j0, len_e - 1)
+    d_min = max(i0 - (j1 - 1), 0)
+    if d_max < d_min:
+        return torch.zeros((n, n_q, n_k), dtype=q_blk.dtype, device=q_blk.device)
+
+    # Row m of er_win holds distance d_max - m
+    er_win = Er[len_e - 1 - d_max:len_e - d_min, :]
+    qe = torch.matmul(q_blk, er_win.t())
+
+    dist = (torch.arange(i0, i0 + n_q, device=q_blk.device).unsqueeze(1)
+            - torch.arange(j0, j1, device=q_blk.device).unsqueeze(0))
+    valid = (dist >= d_min) & (dist <= d_max)
+    idx = (d_max - dist).clamp(0, er_win.shape[0] - 1)
+
+    srel = torch.gather(qe, -1, idx.unsqueeze(0).expand(n, n_q, n_k))
+    return srel.masked_fill(~valid, 0.0)
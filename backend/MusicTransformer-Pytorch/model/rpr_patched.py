@@ -12,6 +12,8 @@ from torch.nn.init import *
 from torch.nn.functional import linear, softmax, dropout
 import warnings
 
+from .rpr import rpr_attention_chunked
+
 # TransformerEncoderRPR
 class TransformerEncoderRPR(Module):
     """
@@ -54,13 +56,13 @@ class TransformerEncoderLayerRPR(Module):
     For Relative Position Representation support (https://arxiv.org/abs/1803.02155)
     https://pytorch.org/docs/1.2.0/_modules/torch/nn/modules/transformer.html#TransformerEncoderLayer
 
-    Modification to create and call custom MultiheadAttentionRPR
+    Modification to create and call custom MultiheadAttentionRPRFused
     ----------
     """
 
-    def __init__(self, d_model, nhead, dim_feedforward=2048, dropout=0.1, er_len=None):
+    def __init__(self, d_model, nhead, dim_feedforward=2048, dropout=0.1, er_len=None, block_size=None):
         super(TransformerEncoderLayerRPR, self).__init__()
-        self.self_attn = MultiheadAttentionRPR(d_model, nhead, dropout=dropout, er_len=er_len)
+        self.self_attn = MultiheadAttentionRPRFused(d_model, nhead, dropout=dropout, er_len=er_len, block_size=block_size)
         # Implementation of Feedforward model
         self.linear1 = Linear(d_model, dim_feedforward)
         self.dropout = Dropout(dropout)
@@ -97,7 +99,7 @@ class MultiheadAttentionRPR(Module):
     ----------
     """
 
-    def __init__(self, embed_dim, num_heads, dropout=0., bias=True, add_bias_kv=False, add_zero_attn=False, kdim=None, vdim=None, er_len=None):
+    def __init__(self, embed_dim, num_heads, dropout=0., bias=True, add_bias_kv=False, add_zero_attn=False, kdim=None, vdim=None, er_len=None, block_size=None):
         super(MultiheadAttentionRPR, self).__init__()
         self.embed_dim = embed_dim
         self.kdim = kdim if kdim is not None else embed_dim
@@ -136,6 +138,9 @@ class MultiheadAttentionRPR(Module):
         else:
             self.Er = None
 
+        # Tiled attention with memory linear in the sequence length (see rpr_attention_chunked)
+        self.block_size = block_size
+
         self._reset_parameters()
 
     def _reset_parameters(self):
@@ -169,7 +174,7 @@ class MultiheadAttentionRPR(Module):
                 key_padding_mask=key_padding_mask, need_weights=need_weights,
                 attn_mask=attn_mask, use_separate_proj_weight=True,
                 q_proj_weight=self.q_proj_weight, k_proj_weight=self.k_proj_weight,
-                v_proj_weight=self.v_proj_weight, rpr_mat=self.Er, **kwargs) # Passed **kwargs
+                v_proj_weight=self.v_proj_weight, rpr_mat=self.Er, block_size=self.block_size, **kwargs) # Passed **kwargs
 
         else:
             if not hasattr(self, '_qkv_same_embed_dim'):
@@ -185,7 +190,86 @@ class MultiheadAttentionRPR(Module):
                 self.dropout, self.out_proj.weight, self.out_proj.bias,
                 training=self.training,
                 key_padding_mask=key_padding_mask, need_weights=need_weights,
-                attn_mask=attn_mask, rpr_mat=self.Er, **kwargs) # Passed **kwargs
+                attn_mask=attn_mask, rpr_mat=self.Er, block_size=self.block_size, **kwargs) # Passed **kwargs
+
+# MultiheadAttentionRPRFused
+class MultiheadAttentionRPRFused(MultiheadAttentionRPR):
+    """
+    ----------
+    Self attention with RPR on the fused F.scaled_dot_product_attention kernel.
+
+    Has the same parameters as MultiheadAttentionRPR (in_proj_weight, in_proj_bias, out_proj, Er)
+    so existing checkpoints load unchanged. Only packed self attention is supported, which is all
+    TransformerEncoderLayerRPR needs, so there are no torch.equal checks on the inputs. The skewed
+    relative logits and the masks (including the block-diagonal mask of the segment ids of a
+    packed batch) are passed to the kernel as one additive bias. Attention weights
+    are never computed outside the kernel and None is returned in their place. With block_size set
+    the tiled rpr_attention_chunked is used instead, which never builds the (L, L) bias.
+    ----------
+    """
+
+    # PATCH: Accepting **kwargs (is_causal) like MultiheadAttentionRPR
+    def forward(self, query, key, value, key_padding_mask=None,
+                need_weights=False, attn_mask=None, segments=None, **kwargs):
+
+        tgt_len, bsz, embed_dim = query.size()
+        num_heads = self.num_heads
+        head_dim = self.head_dim
+        scaling = float(head_dim) ** -0.5
+
+        q, k, v = linear(query, self.in_proj_weight, self.in_proj_bias).chunk(3, dim=-1)
+
+        # (L, batch, embed_dim) -> (batch, heads, L, head_dim)
+        q = q.contiguous().view(tgt_len, bsz, num_heads, head_dim).permute(1, 2, 0, 3)
+        k = k.contiguous().view(tgt_len, bsz, num_heads, head_dim).permute(1, 2, 0, 3)
+        v = v.contiguous().view(tgt_len, bsz, num_heads, head_dim).permute(1, 2, 0, 3)
+
+        # Long sequences: tiled attention instead of the (batch, heads, L, L) bias
+        if(self.Er is not None and self.block_size is not None):
+            if key_padding_mask is not None:
+                key_padding_mask = key_padding_mask.repeat_interleave(num_heads, dim=0)
+            if segments is not None:
+                segments = segments.repeat_interleave(num_heads, dim=0)
+
+            attn_output = rpr_attention_chunked(
+                (q * scaling).reshape(bsz * num_heads, tgt_len, head_dim),
+                k.reshape(bsz * num_heads, tgt_len, head_dim), v.reshape(bsz * num_heads, tgt_len, head_dim),
+                self.Er, attn_mask=attn_mask, key_padding_mask=key_padding_mask, block_size=self.block_size,
+                dropout_p=self.dropout, training=self.training, segments=segments)
+
+            attn_output = attn_output.view(bsz, num_heads, tgt_len, head_dim).permute(2, 0, 1, 3).contiguous().view(tgt_len, bsz, embed_dim)
+            return self.out_proj(attn_output), None
+
+        attn_bias = None
+
+        if(self.Er is not None):
+            rpr_mat = _get_valid_embedding(self.Er, tgt_len, tgt_len)
+            qe = torch.matmul(q * scaling, rpr_mat.t())
+            srel = _skew(qe.reshape(bsz * num_heads, tgt_len, -1))
+            attn_bias = srel.view(bsz, num_heads, tgt_len, tgt_len)
+
+        if attn_mask is not None:
+            if attn_mask.dtype == torch.bool:
+                attn_mask = torch.zeros(attn_mask.shape, dtype=q.dtype, device=q.device).masked_fill(attn_mask, float('-inf'))
+            attn_bias = attn_mask if attn_bias is None else attn_bias + attn_mask
+
+        if key_padding_mask is not None:
+            pad_mask = torch.zeros((bsz, 1, 1, tgt_len), dtype=q.dtype, device=q.device).masked_fill(
+                key_padding_mask.view(bsz, 1, 1, tgt_len), float('-inf'))
+            attn_bias = pad_mask if attn_bias is None else attn_bias + pad_mask
+
+        if segments is not None:
+            seg_mask = torch.zeros((bsz, 1, tgt_len, tgt_len), dtype=q.dtype, device=q.device).masked_fill(
+                (segments.unsqueeze(2) != segments.unsqueeze(1)).unsqueeze(1), float('-inf'))
+            attn_bias = seg_mask if attn_bias is None else attn_bias + seg_mask
+
+        dropout_p = self.dropout if self.training else 0.0
+        attn_output = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_bias, dropout_p=dropout_p)
+
+        attn_output = attn_output.permute(2, 0, 1, 3).contiguous().view(tgt_len, bsz, embed_dim)
+        attn_output = self.out_proj(attn_output)
+
+        return attn_output, None
 
 # multi_head_attention_forward_rpr
 def multi_head_attention_forward_rpr(query,                       # type: Tensor
@@ -212,6 +296,8 @@ def multi_head_attention_forward_rpr(query,                       # type: Tensor
                                  static_k=None,                   # type: Optional[Tensor]
                                  static_v=None,                   # type: Optional[Tensor]
                                  rpr_mat=None,
+                                 block_size=None,                 # type: Optional[int]
+                                 segments=None,                   # type: Optional[Tensor]
                                  # CRITICAL PATCH: Adding **kwargs here prevents TypeError
                                  **kwargs): 
     """
@@ -222,7 +308,9 @@ def multi_head_attention_forward_rpr(query,                       # type: Tensor
     For Relative Position Representation support (https://arxiv.org/abs/1803.02155)
     https://pytorch.org/docs/1.2.0/_modules/torch/nn/functional.html
 
-    Modification to take RPR embedding matrix and perform skew optimized RPR (https://arxiv.org/abs/1809.04281)
+    Modification to take RPR embedding matrix and perform skew optimized RPR (https://arxiv.org/abs/1809.04281).
+    With block_size, RPR attention runs tiled in memory linear in the sequence length
+    (rpr_attention_chunked) and no attention weights are returned.
     ----------
     """
     
@@ -378,6 +466,21 @@ def multi_head_attention_forward_rpr(query,                       # type: Tensor
                                                dtype=key_padding_mask.dtype,
                                                device=key_padding_mask.device)], dim=1)
 
+    ######### CHUNKED RPR ###########
+    if(rpr_mat is not None and block_size is not None):
+        if key_padding_mask is not None:
+            key_padding_mask = key_padding_mask.repeat_interleave(num_heads, dim=0)
+
+        if segments is not None:
+            segments = segments.repeat_interleave(num_heads, dim=0)
+
+        attn_output = rpr_attention_chunked(q, k, v, rpr_mat, attn_mask=attn_mask, key_padding_mask=key_padding_mask,
+                                            block_size=block_size, dropout_p=dropout_p, training=training,
+                                            segments=segments)
+        attn_output = attn_output.transpose(0, 1).contiguous().view(tgt_len, bsz, embed_dim)
+        attn_output = linear(attn_output, out_proj_weight, out_proj_bias)
+        return attn_output, None
+
     attn_output_weights = torch.bmm(q, k.transpose(1, 2))
     assert list(attn_output_weights.size()) == [bsz * num_heads, tgt_len, src_len]
 
@@ -406,6 +509,14 @@ def multi_head_attention_forward_rpr(query,                       # type: Tensor
         )
         attn_output_weights = attn_output_weights.view(bsz * num_heads, tgt_len, src_len)
 
+    if segments is not None:
+        attn_output_weights = attn_output_weights.view(bsz, num_heads, tgt_len, src_len)
+        attn_output_weights = attn_output_weights.masked_fill(
+            (segments.unsqueeze(2) != segments.unsqueeze(1)).unsqueeze(1),
+            float('-inf'),
+        )
+        attn_output_weights = attn_output_weights.view(bsz * num_heads, tgt_len, src_len)
+
     attn_output_weights = softmax(
         attn_output_weights, dim=-1)
 
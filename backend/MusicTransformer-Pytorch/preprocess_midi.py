@@ -2,20 +2,302 @@ import argparse
 import os
 import pickle
 import json
-import random
+import hashlib
+import inspect
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 
 import third_party.midi_processor.processor as midi_processor
+from utilities.constants import VOCAB_SIZE, MANIFEST_FILE, SHARD_TOKENS_FILE, SHARD_OFFSETS_FILE
 
 JSON_FILE = "maestro-v3.0.0.json"
 
+# Everything encode_midi runs. Decoding (decode_midi, StreamingDecoder) is left out, so changing
+# it does not invalidate the manifest
+ENCODER_SOURCES = (
+    midi_processor.encode_midi, midi_processor._control_preprocess, midi_processor._note_preprocess,
+    midi_processor._divide_note, midi_processor._make_time_sift_events, midi_processor._snote2events,
+    midi_processor.SustainAdapter, midi_processor.SustainDownManager, midi_processor.SplitNote,
+    midi_processor.Event,
+)
+
+# tokenizer_version
+def tokenizer_version():
+    """
+    ----------
+    Hash of the encoder's source and vocabulary layout. Outputs are re-encoded whenever it changes.
+    ----------
+    """
+
+    digest = hashlib.sha256(repr(midi_processor.START_IDX).encode("utf-8"))
+    for obj in ENCODER_SOURCES:
+        digest.update(inspect.getsource(obj).encode("utf-8"))
+    return digest.hexdigest()[:12]
+
+TOKENIZER_VERSION = tokenizer_version()
+
+# encode_file
+def encode_file(task):
+    """
+    ----------
+    Encodes one midi file and writes the token list to its output pickle. The pickle is written
+    to a temporary file next to it and renamed into place, so an interrupted run never leaves a
+    truncated output behind. Runs in the worker processes of encode_files.
+
+    Returns (midi path, number of tokens, error message or None). Errors are returned rather than
+    raised so one bad file does not stop the run.
+    ----------
+    """
+
+    mid_path, o_file = task
+    tmp_file = "%s.%d.tmp" % (o_file, os.getpid())
+    try:
+        prepped = midi_processor.encode_midi(mid_path)
+
+        with open(tmp_file, "wb") as o_stream:
+            pickle.dump(prepped, o_stream)
+        os.replace(tmp_file, o_file)
+    except Exception as e:
+        if(os.path.exists(tmp_file)):
+            os.remove(tmp_file)
+        return mid_path, 0, "%s: %s" % (type(e).__name__, e)
+
+    return mid_path, len(prepped), None
+
+# encode_files
+def encode_files(tasks, n_workers=1):
+    """
+    ----------
+    Encodes every (midi path, output pickle) task across n_workers processes (in this process if
+    n_workers is 1), printing progress and the throughput in files/sec and tokens/sec.
+
+    Returns the (midi path, number of tokens, error message or None) of every task.
+    ----------
+    """
+
+    start       = time.time()
+    n_tokens    = 0
+    n_done      = 0
+    errors      = []
+    finished    = []
+
+    if(n_workers > 1):
+        executor = ProcessPoolExecutor(max_workers=n_workers)
+        results = executor.map(encode_file, tasks, chunksize=4)
+    else:
+        executor = None
+        results = map(encode_file, tasks)
+
+    try:
+        for mid_path, count, error in results:
+            finished.append((mid_path, count, error))
+            n_done += 1
+            n_tokens += count
+            if(error is not None):
+                print("ERROR: Failed to process %s with error: %s. Skipping." % (mid_path, error))
+                errors.append((mid_path, error))
+
+            if(n_done % 50 == 0):
+                print(n_done, "/", len(tasks))
+    finally:
+        if(executor is not None):
+            executor.shutdown()
+
+    elapsed = max(time.time() - start, 1e-9)
+    print("Encoded %d files (%d failed) in %.1fs with %d worker(s): %.1f files/sec, %.0f tokens/sec" %
+          (n_done - len(errors), len(errors), elapsed, n_workers, n_done / elapsed, n_tokens / elapsed))
+    if(len(errors) > 0):
+        print("Failed files:")
+        for mid_path, error in errors:
+            print("   ", mid_path, "-", error)
+
+    return finished
+
+# file_hash
+def file_hash(path):
+    """
+    ----------
+    sha256 of a file's contents
+    ----------
+    """
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as stream:
+        for block in iter(lambda: stream.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# stable_split
+def stable_split(key, valid_p=0.1, test_p=0.2):
+    """
+    ----------
+    Assigns a piece to "train", "validation" or "test" from a hash of its key (its path relative
+    to the dataset root), so the same piece always lands in the same split. Same proportions as
+    the original random split: valid_p of the pieces leave train, test_p of those go to test.
+    ----------
+    """
+
+    digest = hashlib.sha256(key.encode("utf-8")).digest()
+    u_train = int.from_bytes(digest[:8], "big") / 2**64
+    u_test  = int.from_bytes(digest[8:16], "big") / 2**64
+
+    if(u_train > valid_p):
+        return "train"
+    elif(u_test > test_p):
+        return "validation"
+    else:
+        return "test"
+
+# load_manifest
+def load_manifest(output_dir):
+    """
+    ----------
+    Loads the preprocessing manifest of output_dir (empty if there is none yet)
+    ----------
+    """
+
+    path = os.path.join(output_dir, MANIFEST_FILE)
+    if(not os.path.isfile(path)):
+        return {"files": {}}
+
+    try:
+        with open(path, "r") as stream:
+            manifest = json.load(stream)
+    except ValueError:
+        print("WARNING: Unreadable manifest, re-encoding everything:", path)
+        return {"files": {}}
+
+    manifest.setdefault("files", {})
+    return manifest
+
+# save_manifest
+def save_manifest(output_dir, manifest):
+    path = os.path.join(output_dir, MANIFEST_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as stream:
+        json.dump(manifest, stream, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+# update_outputs
+def update_outputs(sources, output_dir, n_workers=1, force=False):
+    """
+    ----------
+    Brings output_dir in line with sources, a dict of key -> (midi path, split, output pickle)
+    where key is the midi path relative to the dataset root.
+
+    The manifest next to the outputs records the content hash, tokenizer version, split, output
+    and token count of every encoded file. Only new files, changed files (content, tokenizer
+    version, split or output path) and files whose output is missing are encoded. Every pickle
+    in the train, val and test folders that is not the output of a file in sources is deleted,
+    whether an earlier run recorded it in the manifest or not (e.g. copies left in another split
+    by a run before the manifest existed). force re-encodes all.
+
+    Failed files are left out of the manifest so the next run retries them, and lose any output
+    of their previous content so it is not trained on. Returns the manifest entries (key ->
+    entry) of the files that have an output.
+    ----------
+    """
+
+    manifest    = load_manifest(output_dir)
+    old_files   = manifest["files"]
+    new_files   = {}
+    tasks       = []
+    pending     = {}
+
+    for key, (mid_path, split_type, o_file) in sources.items():
+        entry = {
+            "hash": file_hash(mid_path),
+            "split": split_type,
+            "output": os.path.relpath(o_file, output_dir),
+            "tokenizer": TOKENIZER_VERSION,
+        }
+
+        old = old_files.get(key)
+        up_to_date = (
+            not force and old is not None and os.path.isfile(o_file) and
+            all(old.get(field) == entry[field] for field in ("hash", "split", "output", "tokenizer"))
+        )
+        if(up_to_date):
+            new_files[key] = old
+        else:
+            # The stale output is replaced on success and must not survive a failure
+            if(os.path.isfile(o_file)):
+                os.remove(o_file)
+            tasks.append((mid_path, o_file))
+            pending[mid_path] = (key, entry)
+
+    # Outputs of removed files and of files whose output moved (e.g. to another split)
+    kept_outputs = set(os.path.normpath(o_file) for _, _, o_file in sources.values())
+    n_removed = 0
+    for split in ("train", "val", "test"):
+        split_dir = os.path.join(output_dir, split)
+        if(not os.path.isdir(split_dir)):
+            continue
+        for f in os.listdir(split_dir):
+            output = os.path.normpath(os.path.join(split_dir, f))
+            if(f.endswith(".pickle") and output not in kept_outputs):
+                os.remove(output)
+                n_removed += 1
+
+    print("Up to date:", len(new_files), "Encoding:", len(tasks), "Removed:", n_removed)
+
+    for mid_path, count, error in encode_files(tasks, n_workers):
+        if(error is None):
+            key, entry = pending[mid_path]
+            entry["tokens"] = count
+            new_files[key] = entry
+
+    manifest["files"] = new_files
+    manifest["tokenizer"] = TOKENIZER_VERSION
+    save_manifest(output_dir, manifest)
+
+    return new_files
+
+# write_shards
+def write_shards(output_dir, splits=("train", "val", "test")):
+    """
+    ----------
+    Packs the pickles of each split folder into one contiguous uint16 token array plus an int64
+    offsets index (see SHARD_TOKENS_FILE / SHARD_OFFSETS_FILE), read by EPianoShardDataset.
+    Pieces are stored in sorted file name order. Both files are written under temporary names and
+    renamed into place.
+    ----------
+    """
+
+    assert VOCAB_SIZE <= np.iinfo(np.uint16).max + 1, "Vocabulary does not fit in uint16 shards"
+
+    for split in splits:
+        split_dir = os.path.join(output_dir, split)
+        files = sorted(f for f in os.listdir(split_dir) if f.endswith(".pickle"))
+
+        pieces = []
+        for f in files:
+            with open(os.path.join(split_dir, f), "rb") as i_stream:
+                pieces.append(np.asarray(pickle.load(i_stream), dtype=np.uint16))
+
+        offsets = np.zeros(len(pieces) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(p) for p in pieces])
+        tokens = np.concatenate(pieces) if pieces else np.zeros(0, dtype=np.uint16)
+
+        for name, array in ((SHARD_TOKENS_FILE, tokens), (SHARD_OFFSETS_FILE, offsets)):
+            path = os.path.join(output_dir, name % split)
+            with open(path + ".tmp", "wb") as o_stream:
+                np.save(o_stream, array)
+            os.replace(path + ".tmp", path)
+
+        print("Shard %s: %d pieces, %d tokens" % (split, len(pieces), len(tokens)))
+
 # prep_midi
-def prep_maestro_midi(maestro_root, output_dir):
+def prep_maestro_midi(maestro_root, output_dir, n_workers=1, force=False):
     """
     ----------
     Author: Damon Gwinn
     ----------
     Pre-processes the maestro dataset, putting processed midi data (train, eval, test) into the
-    given output folder
+    given output folder. Files are encoded across n_workers processes, and only when new or
+    changed since the last run (see update_outputs).
     ----------
     """
 
@@ -42,10 +324,7 @@ def prep_maestro_midi(maestro_root, output_dir):
     print("Found", len(midi_filenames), "pieces")
     print("Preprocessing...")
 
-    total_count = 0
-    train_count = 0
-    val_count   = 0
-    test_count  = 0
+    sources     = {}
 
     # Iterate over the indices, not the dictionaries themselves
     for i in range(len(midi_filenames)):
@@ -68,32 +347,22 @@ def prep_maestro_midi(maestro_root, output_dir):
         o_file = None
         if split_type == "train":
             o_file = os.path.join(train_dir, f_name)
-            train_count += 1
         elif split_type == "validation":
             o_file = os.path.join(val_dir, f_name)
-            val_count += 1
         elif split_type == "test":
             o_file = os.path.join(test_dir, f_name)
-            test_count += 1
         else:
             print("ERROR: Unrecognized split type:", split_type)
             return False
 
-        try:
-            prepped = midi_processor.encode_midi(mid_path)
-            with open(o_file, "wb") as o_stream:
-                pickle.dump(prepped, o_stream)
-        except Exception as e:
-            print(f"ERROR: Failed to process {mid_path} with error: {e}. Skipping.")
-            continue
+        sources[midi_filename] = (mid_path, split_type, o_file)
 
-        total_count += 1
-        if total_count % 50 == 0:
-            print(total_count, "/", len(midi_filenames))
+    # Counted from the files that have an output, failed files are not in the dataset
+    splits = [entry["split"] for entry in update_outputs(sources, output_dir, n_workers, force).values()]
 
-    print("Num Train:", train_count)
-    print("Num Val:", val_count)
-    print("Num Test:", test_count)
+    print("Num Train:", splits.count("train"))
+    print("Num Val:", splits.count("validation"))
+    print("Num Test:", splits.count("test"))
     return True
 
     # for piece in maestro_json:
@@ -129,13 +398,15 @@ def prep_maestro_midi(maestro_root, output_dir):
     # print("Num Test:", test_count)
     # return True
 
-def prep_custom_midi(custom_midi_root, output_dir, valid_p = 0.1, test_p = 0.2):
+def prep_custom_midi(custom_midi_root, output_dir, valid_p = 0.1, test_p = 0.2, n_workers=1, force=False):
     """
     ----------
     Author: Corentin Nelias
     ----------
     Pre-processes custom midi files that are not part of the maestro dataset, putting processed midi data (train, eval, test) into the
-    given output folder. 
+    given output folder. Each piece's split is derived from its file name (see stable_split), so
+    it stays put across runs. Files are encoded across n_workers processes, and only when new or
+    changed since the last run (see update_outputs).
     ----------
     """
     train_dir = os.path.join(output_dir, "train")
@@ -147,49 +418,30 @@ def prep_custom_midi(custom_midi_root, output_dir, valid_p = 0.1, test_p = 0.2):
     
     print("Found", len(os.listdir(custom_midi_root)), "pieces")
     print("Preprocessing custom data...")
-    total_count = 0
-    train_count = 0
-    val_count   = 0
-    test_count  = 0
-    
-    for piece in os.listdir(custom_midi_root):
+    sources     = {}
+
+    for piece in sorted(os.listdir(custom_midi_root)):
         #deciding whether the data should be part of train, valid or test dataset
-        is_train = True if random.random() > valid_p else False
-        if not is_train:
-            is_valid = True if random.random() > test_p else False
-        if is_train:
-            split_type  = "train"
-        elif is_valid:
-            split_type = "validation"
-        else:
-            split_type = "test"
-            
+        split_type = stable_split(piece, valid_p, test_p)
+
         mid         = os.path.join(custom_midi_root, piece)
         f_name      = piece.split(".")[0] + ".pickle"
 
         if(split_type == "train"):
             o_file = os.path.join(train_dir, f_name)
-            train_count += 1
         elif(split_type == "validation"):
             o_file = os.path.join(val_dir, f_name)
-            val_count += 1
         elif(split_type == "test"):
             o_file = os.path.join(test_dir, f_name)
-            test_count += 1
-        
-        prepped = midi_processor.encode_midi(mid)
 
-        o_stream = open(o_file, "wb")
-        pickle.dump(prepped, o_stream)
-        o_stream.close()
+        sources[piece] = (mid, split_type, o_file)
 
-        total_count += 1
-        if(total_count % 50 == 0):
-            print(total_count, "/", len(os.listdir(custom_midi_root)))
+    # Counted from the files that have an output, failed files are not in the dataset
+    splits = [entry["split"] for entry in update_outputs(sources, output_dir, n_workers, force).values()]
 
-    print("Num Train:", train_count)
-    print("Num Val:", val_count)
-    print("Num Test:", test_count)
+    print("Num Train:", splits.count("train"))
+    print("Num Val:", splits.count("validation"))
+    print("Num Test:", splits.count("test"))
     return True
 
 
@@ -208,6 +460,9 @@ def parse_args():
     parser.add_argument("root", type=str, help="Root folder for the Maestro dataset or for custom data.")
     parser.add_argument("-output_dir", type=str, default="./dataset/e_piano", help="Output folder to put the preprocessed midi into.")
     parser.add_argument("--custom_dataset", action="store_true", help="Whether or not the specified root folder contains custom data.")
+    parser.add_argument("--shards", action="store_true", help="Also pack each split into a memory-mappable token shard (see EPianoShardDataset)")
+    parser.add_argument("--force", action="store_true", help="Re-encode every file, even those the manifest lists as up to date")
+    parser.add_argument("-n_workers", type=int, default=os.cpu_count(), help="Number of processes encoding midi files in parallel (1 encodes in this process)")
 
     return parser.parse_args()
 
@@ -227,9 +482,11 @@ def main():
 
     print("Preprocessing midi files and saving to", output_dir)
     if args.custom_dataset:
-        prep_custom_midi(root, output_dir)
+        prep_custom_midi(root, output_dir, n_workers=args.n_workers, force=args.force)
     else:
-        prep_maestro_midi(root, output_dir)
+        prep_maestro_midi(root, output_dir, n_workers=args.n_workers, force=args.force)
+    if args.shards:
+        write_shards(output_dir)
     print("Done!")
     print("")
 
@@ -0,0 +1,85 @@
+import copy
+import math
+
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+
+from dataset.e_piano import create_epiano_datasets
+
+from model.music_transformer_patched import MusicTransformer
+from model.quantize import quantize_model
+
+from utilities.constants import *
+from utilities.device import use_cuda
+from utilities.argument_funcs import parse_quantize_args, print_quantize_args
+
+# main
+def main():
+    """
+    ----------
+    Entry point. Quantizes a trained model to dynamic int8 for cpu inference, saves it and compares
+    its perplexity and next token agreement against the fp32 model on the test split
+    ----------
+    """
+
+    args = parse_quantize_args()
+    print_quantize_args(args)
+
+    # Dynamic quantization is cpu only, so both models are evaluated there
+    use_cuda(False)
+
+    model = MusicTransformer(n_layers=args.n_layers, num_heads=args.num_heads,
+                d_model=args.d_model, dim_feedforward=args.dim_feedforward,
+                max_sequence=args.max_sequence, rpr=args.rpr)
+
+    model.load_state_dict(torch.load(args.model_weights, map_location="cpu"))
+    model.eval()
+
+    q_model = quantize_model(copy.deepcopy(model))
+    torch.save(q_model.state_dict(), args.output_weights)
+    print("Saved quantized model to:", args.output_weights)
+    print("")
+
+    if(args.no_eval):
+        return
+
+    _, _, test_dataset = create_epiano_datasets(args.dataset_dir, args.max_sequence)
+    test_loader = DataLoader(test_dataset, batch_size=args.batch_size, num_workers=args.n_workers)
+
+    loss = nn.CrossEntropyLoss(ignore_index=TOKEN_PAD, reduction="sum")
+
+    print("Evaluating fp32 and int8:")
+    sum_loss    = 0.0
+    sum_q_loss  = 0.0
+    n_agree     = 0
+    n_tokens    = 0
+    with torch.set_grad_enabled(False):
+        for batch_num, (x, tgt) in enumerate(test_loader):
+            # Both run through the cached path so the comparison only measures quantization
+            y   = model.forward_cached(x, model.new_cache(x.shape[0]))
+            q_y = q_model.forward_cached(x, q_model.new_cache(x.shape[0]))
+
+            sum_loss    += float(loss(y.reshape(-1, y.shape[-1]), tgt.flatten()))
+            sum_q_loss  += float(loss(q_y.reshape(-1, q_y.shape[-1]), tgt.flatten()))
+
+            real        = (tgt != TOKEN_PAD)
+            n_agree     += int((y.argmax(dim=-1) == q_y.argmax(dim=-1))[real].sum())
+            n_tokens    += int(real.sum())
+
+            if((batch_num+1) % 50 == 0):
+                print(batch_num+1, "/", len(test_loader))
+
+    ppl     = math.exp(sum_loss / n_tokens)
+    q_ppl   = math.exp(sum_q_loss / n_tokens)
+
+    print("fp32 perplexity:", ppl)
+    print("int8 perplexity:", q_ppl)
+    print("Perplexity increase:", q_ppl - ppl, "(", 100.0 * (q_ppl - ppl) / ppl, "% )")
+    print("Next token agreement:", n_agree / n_tokens)
+    print(SEPERATOR)
+    print("")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import pytest
+import torch
+
+from model.music_transformer_patched import MusicTransformer
+from model.rpr import MultiheadAttentionRPR
+from model.rpr_patched import MultiheadAttentionRPRFused
+
+ATOL = 1e-5
+L, BSZ, D_MODEL, HEADS = 40, 2, 32, 4
+
+def causal_mask(n):
+    return torch.triu(torch.full((n, n), float('-inf')), diagonal=1)
+
+def attention_pair(block_size=None):
+    """
+    ----------
+    The legacy RPR attention and the fused one with the same weights
+    ----------
+    """
+
+    torch.manual_seed(0)
+    legacy = MultiheadAttentionRPR(D_MODEL, HEADS, dropout=0.0, er_len=64).eval()
+    fused = MultiheadAttentionRPRFused(D_MODEL, HEADS, dropout=0.0, er_len=64, block_size=block_size).eval()
+    fused.load_state_dict(legacy.state_dict())
+    return legacy, fused
+
+def segments_of(lengths):
+    return torch.cat([torch.full((n,), i) for i, n in enumerate(lengths)])
+
+def test_fused_attention_matches_legacy():
+    legacy, fused = attention_pair()
+    x = torch.randn(L, BSZ, D_MODEL)
+
+    with torch.no_grad():
+        ref = legacy(x, x, x, attn_mask=causal_mask(L))[0]
+        out = fused(x, x, x, attn_mask=causal_mask(L))[0]
+
+    torch.testing.assert_close(out, ref, atol=ATOL, rtol=0)
+
+def test_fused_attention_gradients_match_legacy():
+    legacy, fused = attention_pair()
+    x = torch.randn(L, BSZ, D_MODEL)
+
+    legacy(x, x, x, attn_mask=causal_mask(L))[0].square().sum().backward()
+    fused(x, x, x, attn_mask=causal_mask(L))[0].square().sum().backward()
+
+    for (name, p_ref), p in zip(legacy.named_parameters(), fused.parameters()):
+        torch.testing.assert_close(p.grad, p_ref.grad, atol=1e-4, rtol=1e-4, msg=name)
+
+@pytest.mark.parametrize("block_size", [7, 8, 64])
+def test_tiled_attention_matches_dense(block_size):
+    legacy, _ = attention_pair()
+    tiled, fused_tiled = attention_pair(block_size)
+    tiled.block_size = block_size
+    x = torch.randn(L, BSZ, D_MODEL)
+
+    with torch.no_grad():
+        ref = legacy(x, x, x, attn_mask=causal_mask(L))[0]
+        torch.testing.assert_close(tiled(x, x, x, attn_mask=causal_mask(L))[0], ref, atol=ATOL, rtol=0)
+        torch.testing.assert_close(fused_tiled(x, x, x, attn_mask=causal_mask(L))[0], ref, atol=ATOL, rtol=0)
+
+def test_tiled_attention_gradients_match_dense():
+    dense, _ = attention_pair()
+    tiled, _ = attention_pair()
+    tiled.block_size = 8
+    x = torch.randn(L, BSZ, D_MODEL)
+
+    dense(x, x, x, attn_mask=causal_mask(L))[0].square().sum().backward()
+    tiled(x, x, x, attn_mask=causal_mask(L))[0].square().sum().backward()
+
+    for (name, p_ref), p in zip(dense.named_parameters(), tiled.parameters()):
+        torch.testing.assert_close(p.grad, p_ref.grad, atol=1e-4, rtol=1e-4, msg=name)
+
+@pytest.mark.parametrize("block_size", [None, 8])
+def test_segmented_attention_matches_separate_pieces(block_size):
+    legacy, fused = attention_pair(block_size)
+    legacy.block_size = block_size
+    lengths = [15, 25]
+    segments = segments_of(lengths)[None].expand(BSZ, L)
+    x = torch.randn(L, BSZ, D_MODEL)
+
+    with torch.no_grad():
+        for attn in (legacy, fused):
+            packed = attn(x, x, x, attn_mask=causal_mask(L), segments=segments)[0]
+
+            start = 0
+            for n in lengths:
+                piece = x[start:start+n]
+                alone = attn(piece, piece, piece, attn_mask=causal_mask(n))[0]
+                torch.testing.assert_close(packed[start:start+n], alone, atol=ATOL, rtol=0)
+                start += n
+
+@pytest.mark.parametrize("rpr", [False, True])
+def test_model_segments_isolate_pieces(rpr):
+    torch.manual_seed(0)
+    model = MusicTransformer(n_layers=2, num_heads=HEADS, d_model=D_MODEL, dim_feedforward=64,
+                             dropout=0.0, max_sequence=64, rpr=rpr).eval()
+    x = torch.randint(0, 388, (2, L))
+    segments = torch.stack([segments_of([15, 25]), torch.zeros(L, dtype=torch.long)])
+
+    with torch.no_grad():
+        packed = model(x, segments=segments)
+        torch.testing.assert_close(packed[0, :15], model(x[:1, :15])[0], atol=ATOL, rtol=0)
+        torch.testing.assert_close(packed[1], model(x[1:])[0], atol=ATOL, rtol=0)
+
+        # The second piece does not see what came before it
+        other = x.clone()
+        other[0, :15] = torch.randint(0, 388, (15,))
+        torch.testing.assert_close(model(other, segments=segments)[0, 15:], packed[0, 15:], atol=ATOL, rtol=0)
+
+def test_tiled_model_matches_dense_model():
+    def model(block_size):
+        torch.manual_seed(0)
+        return MusicTransformer(n_layers=2, num_heads=HEADS, d_model=D_MODEL, dim_feedforward=64,
+                                dropout=0.0, max_sequence=64, rpr=True, rpr_block_size=block_size).eval()
+
+    x = torch.randint(0, 388, (2, L))
+    with torch.no_grad():
+        torch.testing.assert_close(model(8)(x), model(None)(x), atol=ATOL, rtol=0)
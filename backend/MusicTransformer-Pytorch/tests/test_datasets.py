@@ -0,0 +1,177 @@
+import os
+import pickle
+import random
+
+import numpy as np
+import pytest
+import torch
+
+import preprocess_midi
+from dataset.e_piano import EPianoShardDataset, EPianoPackedDataset, EPianoWindowDataset, create_epiano_datasets, load_pieces, process_midi
+from utilities.constants import TOKEN_END, TOKEN_PAD
+
+MAX_SEQ = 16
+LENGTHS = {"train": [5, 40, 100, 13, 7], "val": [3], "test": [50]}
+
+@pytest.fixture
+def dataset_root(tmp_path):
+    """
+    ----------
+    A pre-processed dataset root of random pieces, with token shards. Pieces are listed in file
+    name order, the order of the shards.
+    ----------
+    """
+
+    rng = np.random.default_rng(0)
+    pieces = {}
+    for split, lengths in LENGTHS.items():
+        os.makedirs(tmp_path / split)
+        pieces[split] = []
+        for i, n in enumerate(lengths):
+            tokens = [int(t) for t in rng.integers(0, 356, n)]
+            with open(tmp_path / split / ("piece_%d.pickle" % i), "wb") as o_stream:
+                pickle.dump(tokens, o_stream)
+            pieces[split].append(tokens)
+
+    preprocess_midi.write_shards(str(tmp_path))
+    return str(tmp_path), pieces
+
+def piece_tokens(dataset, pieces, idx):
+    """
+    ----------
+    Tokens of piece idx of an EPianoWindowDataset. Without shards its pieces are in directory
+    listing order.
+    ----------
+    """
+
+    if(isinstance(dataset.pieces, EPianoShardDataset)):
+        return pieces[idx]
+
+    name = os.path.basename(dataset.pieces.data_files[idx])
+    return pieces[int(name[len("piece_"):-len(".pickle")])]
+
+def test_shard_dataset_matches_pickles(dataset_root):
+    root, pieces = dataset_root
+    dataset = EPianoShardDataset(root, "train", MAX_SEQ, random_seq=False)
+
+    assert len(dataset) == len(pieces["train"])
+    for i, tokens in enumerate(pieces["train"]):
+        assert dataset.piece(i).tolist() == tokens
+
+        x, tgt = dataset[i]
+        ref_x, ref_tgt = process_midi(torch.tensor(tokens), MAX_SEQ, False)
+        assert torch.equal(x, ref_x) and torch.equal(tgt, ref_tgt)
+
+def test_shard_dataset_pickles_without_mapping(dataset_root):
+    root, _ = dataset_root
+    dataset = EPianoShardDataset(root, "train", MAX_SEQ, random_seq=False)
+    dataset.piece(0)
+
+    copy = pickle.loads(pickle.dumps(dataset))
+    assert copy.tokens is None
+    assert all(torch.equal(a, b) for a, b in zip(copy[2], dataset[2]))
+
+def test_load_pieces_matches_shards(dataset_root):
+    root, pieces = dataset_root
+    tokens, offsets = load_pieces(os.path.join(root, "train"))
+
+    assert offsets.tolist() == np.cumsum([0] + LENGTHS["train"]).tolist()
+    assert tokens.tolist() == sum(pieces["train"], [])
+
+@pytest.mark.parametrize("shards", [False, True])
+def test_packed_dataset_covers_stream(dataset_root, shards):
+    root, pieces = dataset_root
+    stream = sum((p + [TOKEN_END] for p in pieces["train"]), [])
+    piece_ids = sum(([i] * (len(p) + 1) for i, p in enumerate(pieces["train"])), [])
+
+    dataset = EPianoPackedDataset(root, "train", MAX_SEQ, random_seq=False, segments=True, shards=shards)
+    assert len(dataset) == -(-(len(stream) - 1) // MAX_SEQ)
+
+    xs, tgts, segs = zip(*(dataset[i] for i in range(len(dataset))))
+    x, tgt, seg = torch.cat(xs).tolist(), torch.cat(tgts).tolist(), torch.cat(segs).tolist()
+
+    n = len(stream)
+    assert x[:n] == stream
+    assert seg[:n] == piece_ids
+    assert set(x[n:]) <= {TOKEN_PAD}
+    assert set(seg[n:]) <= {-1}
+
+    # Targets are the next token, except after TOKEN_END where the next piece begins
+    for i in range(n):
+        expected = TOKEN_PAD if stream[i] == TOKEN_END else stream[i+1]
+        assert tgt[i] == expected
+
+@pytest.mark.parametrize("shards", [False, True])
+def test_packed_dataset_random_windows_stay_in_stream(dataset_root, shards):
+    root, pieces = dataset_root
+    stream = sum((p + [TOKEN_END] for p in pieces["train"]), [])
+
+    dataset = EPianoPackedDataset(root, "train", MAX_SEQ, random_seq=True, segments=False, shards=shards)
+    for i in range(len(dataset)):
+        x, tgt = dataset[i]
+        window = [t for t in x.tolist() if t != TOKEN_PAD]
+        starts = [s for s in range(len(stream)) if stream[s:s+len(window)] == window]
+        assert starts, "window %d is not a slice of the packed stream" % i
+
+@pytest.mark.parametrize("shards", [False, True])
+def test_window_dataset_strided_windows(dataset_root, shards):
+    root, pieces = dataset_root
+    stride = 8
+
+    dataset = EPianoWindowDataset(root, "train", MAX_SEQ, stride=stride, shards=shards)
+
+    covered = [np.zeros(n, dtype=bool) for n in dataset.lengths]
+    for i in range(len(dataset)):
+        piece, start = int(dataset.window_piece[i]), int(dataset.window_start[i])
+        tokens = piece_tokens(dataset, pieces["train"], piece)
+        assert start == 0 or start + MAX_SEQ + 1 <= len(tokens)
+
+        x, tgt = dataset[i]
+        window = tokens[start:start+MAX_SEQ+1]
+        assert x.tolist()[:len(window)] == window[:MAX_SEQ]
+        covered[piece][start:start+MAX_SEQ+1] = True
+
+    assert all(c.all() for c in covered)
+
+    # Starts go 0, stride, ... and the last window ends with the piece
+    longest = int(np.argmax(dataset.lengths))
+    starts_100 = dataset.window_start[dataset.window_piece == longest].tolist()
+    assert starts_100 == [0, 8, 16, 24, 32, 40, 48, 56, 64, 72, 80, 83]
+
+def test_window_dataset_epoch_tokens(dataset_root):
+    root, _ = dataset_root
+
+    dataset = EPianoWindowDataset(root, "train", MAX_SEQ, epoch_tokens=100)
+    assert len(dataset) == -(-100 // MAX_SEQ)
+    for i in range(len(dataset)):
+        x, tgt = dataset[i]
+        assert x.shape == (MAX_SEQ,) and tgt.shape == (MAX_SEQ,)
+
+    with pytest.raises(ValueError):
+        EPianoWindowDataset(root, "train", MAX_SEQ, stride=8, epoch_tokens=100)
+
+def test_window_dataset_draws_pieces_in_proportion_to_length(dataset_root):
+    root, _ = dataset_root
+    random.seed(0)
+
+    dataset = EPianoWindowDataset(root, "train", MAX_SEQ, epoch_tokens=100, shards=True)
+    drawn = []
+    piece = dataset.pieces.piece
+    dataset.pieces.piece = lambda idx: drawn.append(idx) or piece(idx)
+
+    n_draws = 20000
+    for _ in range(n_draws):
+        dataset[0]
+
+    counts = np.bincount(drawn, minlength=len(dataset.lengths))
+    np.testing.assert_allclose(counts / n_draws, dataset.lengths / dataset.lengths.sum(), atol=0.015)
+
+    expected = dataset.n_windows * np.dot(dataset.lengths, np.minimum(dataset.lengths, MAX_SEQ)) / dataset.lengths.sum()
+    assert dataset.epoch_tokens == round(expected)
+
+@pytest.mark.parametrize("window", [{"stride": 8}, {"epoch_tokens": 100}])
+def test_pack_rejects_window_options(dataset_root, window):
+    root, _ = dataset_root
+
+    with pytest.raises(ValueError):
+        create_epiano_datasets(root, MAX_SEQ, pack=True, **window)
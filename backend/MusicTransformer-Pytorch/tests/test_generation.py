@@ -0,0 +1,34 @@
+import pytest
+import torch
+
+from model.music_transformer_patched import MusicTransformer
+from model.generation import generate_batch
+
+def small_model(rpr, seed=0):
+    torch.manual_seed(seed)
+    return MusicTransformer(n_layers=2, num_heads=4, d_model=32, dim_feedforward=64,
+                            dropout=0.0, max_sequence=64, rpr=rpr).eval()
+
+@pytest.mark.parametrize("rpr", [False, True])
+def test_generate_batch_rows_match_single_generation(rpr):
+    model = small_model(rpr)
+    primers = [torch.randint(0, 356, (10,)), torch.randint(0, 356, (4,))]
+
+    with torch.no_grad():
+        batch = generate_batch(model, primers, 30, seeds=[1, 2])
+        singles = [generate_batch(model, [p], 30, seeds=[s])[0] for p, s in zip(primers, [1, 2])]
+
+    for row, single, primer in zip(batch, singles, primers):
+        assert torch.equal(row[:len(primer)], primer)
+        assert torch.equal(row, single)
+
+def test_generate_batch_rejects_targets_past_max_sequence():
+    model = small_model(True)
+
+    with pytest.raises(AssertionError, match="max_sequence"):
+        generate_batch(model, [torch.randint(0, 356, (4,))], 65)
+
+    # Primers of different lengths may need more cache slots than max_sequence, which is fine
+    with torch.no_grad():
+        rows = generate_batch(model, [torch.randint(0, 356, (40,)), torch.randint(0, 356, (4,))], 64, seeds=[1, 2])
+    assert all(len(row) <= 64 for row in rows)
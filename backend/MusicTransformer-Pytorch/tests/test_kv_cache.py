@@ -0,0 +1,65 @@
+import pytest
+import torch
+
+from model.music_transformer_patched import MusicTransformer
+from model.kv_cache import KVCache, incremental_forward
+
+ATOL = 1e-5
+
+def small_model(rpr, seed=0):
+    torch.manual_seed(seed)
+    return MusicTransformer(n_layers=2, num_heads=4, d_model=32, dim_feedforward=64,
+                            dropout=0.0, max_sequence=64, rpr=rpr).eval()
+
+@pytest.mark.parametrize("rpr", [False, True])
+def test_cached_forward_matches_full_forward(rpr):
+    model = small_model(rpr)
+    x = torch.randint(0, 388, (2, 40))
+
+    with torch.no_grad():
+        full = model(x)
+
+        cache = model.new_cache(2)
+        out = [model.forward_cached(x[:, :10], cache)]
+        out += [model.forward_cached(x[:, t:t+1], cache) for t in range(10, 40)]
+
+    assert cache.length == 40
+    torch.testing.assert_close(torch.cat(out, dim=1), full, atol=ATOL, rtol=0)
+
+@pytest.mark.parametrize("rpr", [False, True])
+def test_cache_crop_forgets_rejected_tokens(rpr):
+    model = small_model(rpr)
+    x = torch.randint(0, 388, (1, 30))
+
+    with torch.no_grad():
+        full = model(x)
+
+        cache = KVCache.for_model(model)
+        incremental_forward(model, x[:, :20], cache)
+        incremental_forward(model, torch.randint(0, 388, (1, 5)), cache)
+        cache.crop(20)
+        out = incremental_forward(model, x[:, 20:], cache)
+
+    torch.testing.assert_close(out, full[:, 20:], atol=ATOL, rtol=0)
+
+@pytest.mark.parametrize("rpr", [False, True])
+def test_left_padded_batch_matches_single(rpr):
+    model = small_model(rpr)
+    long = torch.randint(0, 388, (25,))
+    short = torch.randint(0, 388, (10,))
+
+    x = torch.zeros((2, 25), dtype=torch.long)
+    x[0] = long
+    x[1, 15:] = short
+
+    with torch.no_grad():
+        cache = KVCache.for_model(model, 2)
+        cache.pad_lens = torch.tensor([0, 15])
+        batch = incremental_forward(model, x, cache)
+        step = incremental_forward(model, torch.tensor([[3], [4]]), cache)
+
+        torch.testing.assert_close(batch[0], model(long[None])[0], atol=ATOL, rtol=0)
+        torch.testing.assert_close(batch[1, 15:], model(short[None])[0], atol=ATOL, rtol=0)
+
+        short_next = model(torch.cat([short, torch.tensor([4])])[None])
+        torch.testing.assert_close(step[1, 0], short_next[0, -1], atol=ATOL, rtol=0)
@@ -0,0 +1,48 @@
+import glob
+import os
+
+import numpy as np
+import pytest
+
+import third_party.midi_processor.processor as midi_processor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def note_list(mid):
+    return sorted((n.pitch, round(n.start, 6), round(n.end, 6), n.velocity) for n in mid.instruments[0].notes)
+
+@pytest.mark.parametrize("seed", range(20))
+def test_streaming_decoder_matches_decode_midi(seed):
+    tokens = [int(t) for t in np.random.default_rng(seed).integers(0, 388, 300)]
+
+    decoder = midi_processor.StreamingDecoder()
+    pushed = []
+    for t in tokens:
+        pushed += decoder.push(t)
+
+    ref = note_list(midi_processor.decode_midi(tokens))
+    assert note_list(decoder.to_midi()) == ref
+    assert sorted((n.pitch, round(n.start, 6), round(n.end, 6), n.velocity) for n in pushed) == ref
+
+def test_streaming_decoder_matches_decode_midi_on_maestro():
+    files = sorted(glob.glob(os.path.join(ROOT, "maestro-v3.0.0", "*", "*.midi")))
+    if(not files):
+        pytest.skip("No MAESTRO midi files in the tree")
+
+    tokens = midi_processor.encode_midi(files[0])[:4000]
+
+    decoder = midi_processor.StreamingDecoder()
+    decoder.extend(tokens)
+
+    assert note_list(decoder.to_midi()) == note_list(midi_processor.decode_midi(tokens))
+
+def test_held_notes_are_cut_at_end():
+    note_on = midi_processor.Event("note_on", 60).to_int()
+    shift = midi_processor.Event("time_shift", 49).to_int() # 0.5 seconds
+
+    decoder = midi_processor.StreamingDecoder()
+    assert decoder.extend([note_on, shift]) == []
+
+    held = decoder.held_notes()
+    assert [(n.pitch, n.start, n.end) for n in held] == [(60, 0, 0.5)]
+    assert decoder.held_notes(end=0.25)[0].end == 0.25
@@ -248,6 +248,67 @@ def decode_midi(idx_array, file_path=None):
     return mid
 
 
+class StreamingDecoder:
+    """
+    Incremental version of decode_midi. Tokens are pushed one at a time and each finished
+    pretty_midi.Note is returned as soon as its note_off arrives, so rendering can start before
+    generation ends. Produces the same notes as decode_midi on the full sequence.
+    """
+    def __init__(self):
+        self.time = 0
+        self.velocity = 0
+        self.notes = []
+        self._note_on_dict = {} # key: pitch, value: (start time, velocity)
+        self._held = {} # pitches with a note_on and no note_off yet
+
+    def push(self, idx):
+        event = Event.from_int(int(idx))
+
+        if event.type == 'time_shift':
+            self.time += ((event.value+1) / 100)
+        elif event.type == 'velocity':
+            self.velocity = event.value * 4
+        elif event.type == 'note_on':
+            self._note_on_dict[event.value] = (self.time, self.velocity)
+            self._held[event.value] = (self.time, self.velocity)
+        elif event.type == 'note_off':
+            self._held.pop(event.value, None)
+            if event.value not in self._note_on_dict:
+                print('info removed pitch: {}'.format(event.value))
+                return []
+            start, velocity = self._note_on_dict[event.value]
+            if self.time - start == 0:
+                return []
+            note = pretty_midi.Note(velocity, event.value, start, self.time)
+            self.notes.append(note)
+            return [note]
+        return []
+
+    def held_notes(self, end=None):
+        # Notes still sounding at the current time, cut off at end (default: now)
+        end = self.time if end is None else end
+        return [pretty_midi.Note(velocity, pitch, start, end)
+                for pitch, (start, velocity) in self._held.items() if end > start]
+
+    def extend(self, idx_array):
+        result = []
+        for idx in idx_array:
+            result += self.push(idx)
+        return result
+
+    def to_midi(self, file_path=None):
+        notes = sorted(self.notes, key=lambda x: x.start)
+
+        mid = pretty_midi.PrettyMIDI()
+        instument = pretty_midi.Instrument(1, False, "Developed By Yang-Kichang")
+        instument.notes = notes
+
+        mid.instruments.append(instument)
+        if file_path is not None:
+            mid.write(file_path)
+        return mid
+
+
 if __name__ == '__main__':
     encoded = encode_midi('bin/ADIG04.mid')
     print(encoded)
@@ -68,7 +68,12 @@ def main():
         tensorboard_summary = SummaryWriter(log_dir=tensorboad_dir)
 
     ##### Datasets #####
-    train_dataset, val_dataset, test_dataset = create_epiano_datasets(args.input_dir, args.max_sequence)
+    train_dataset, val_dataset, test_dataset = create_epiano_datasets(args.input_dir, args.max_sequence, shards=args.shards,
+                                                                      pack=args.pack, pack_mask=args.pack_mask,
+                                                                      stride=args.window_stride, epoch_tokens=args.epoch_tokens)
+    if(hasattr(train_dataset, "epoch_tokens")):
+        print("Train windows per epoch:", len(train_dataset), "tokens:", train_dataset.epoch_tokens)
+        print("")
 
     train_loader = DataLoader(train_dataset, batch_size=args.batch_size, num_workers=args.n_workers, shuffle=True)
     val_loader = DataLoader(val_dataset, batch_size=args.batch_size, num_workers=args.n_workers)
@@ -76,7 +81,7 @@ def main():
 
     model = MusicTransformer(n_layers=args.n_layers, num_heads=args.num_heads,
                 d_model=args.d_model, dim_feedforward=args.dim_feedforward, dropout=args.dropout,
-                max_sequence=args.max_sequence, rpr=args.rpr).to(get_device())
+                max_sequence=args.max_sequence, rpr=args.rpr, rpr_block_size=args.rpr_block_size).to(get_device())
 
     ##### Continuing from previous training session #####
     start_epoch = BASELINE_EPOCH
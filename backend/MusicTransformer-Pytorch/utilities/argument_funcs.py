@@ -15,6 +15,11 @@ def parse_train_args():
     parser = argparse.ArgumentParser()
 
     parser.add_argument("-input_dir", type=str, default="./dataset/e_piano", help="Folder of preprocessed and pickled midi files")
+    parser.add_argument("--shards", action="store_true", help="Read the packed token shards in input_dir (preprocess_midi.py --shards) instead of the pickles")
+    parser.add_argument("--pack", action="store_true", help="Pack several pieces, separated by TOKEN_END, into every training window instead of padding")
+    parser.add_argument("--pack_mask", action="store_true", help="With --pack, use a block-diagonal attention mask so packed pieces do not attend to each other")
+    parser.add_argument("-window_stride", type=int, default=None, help="Train on every window of every piece, starting every window_stride tokens (instead of one random window per piece)")
+    parser.add_argument("-epoch_tokens", type=int, default=None, help="Train on this many tokens per epoch, windows drawn from pieces in proportion to their length")
     parser.add_argument("-output_dir", type=str, default="./saved_models", help="Folder to save model weights. Saves one every epoch")
     parser.add_argument("-weight_modulus", type=int, default=1, help="How often to save epoch weights (ex: value of 10 means save every 10 epochs)")
     parser.add_argument("-print_modulus", type=int, default=1, help="How often to print train results for a batch (batch loss, learn rate, etc.)")
@@ -33,6 +38,7 @@ def parse_train_args():
 
     parser.add_argument("--rpr", action="store_true", help="Use a modified Transformer for Relative Position Representations")
     parser.add_argument("-max_sequence", type=int, default=2048, help="Maximum midi sequence to consider")
+    parser.add_argument("-rpr_block_size", type=int, default=None, help="Compute RPR attention in tiles of this many tokens (memory linear in max_sequence)")
     parser.add_argument("-n_layers", type=int, default=6, help="Number of decoder layers to use")
     parser.add_argument("-num_heads", type=int, default=8, help="Number of heads to use for multi-head attention")
     parser.add_argument("-d_model", type=int, default=512, help="Dimension of the model (output dim of embedding layers, etc.)")
@@ -55,6 +61,11 @@ def print_train_args(args):
 
     print(SEPERATOR)
     print("input_dir:", args.input_dir)
+    print("shards:", args.shards)
+    print("pack:", args.pack)
+    print("pack_mask:", args.pack_mask)
+    print("window_stride:", args.window_stride)
+    print("epoch_tokens:", args.epoch_tokens)
     print("output_dir:", args.output_dir)
     print("weight_modulus:", args.weight_modulus)
     print("print_modulus:", args.print_modulus)
@@ -73,6 +84,7 @@ def print_train_args(args):
     print("")
     print("rpr:", args.rpr)
     print("max_sequence:", args.max_sequence)
+    print("rpr_block_size:", args.rpr_block_size)
     print("n_layers:", args.n_layers)
     print("num_heads:", args.num_heads)
     print("d_model:", args.d_model)
@@ -140,12 +152,13 @@ def print_eval_args(args):
     print("")
 
 # parse_generate_args
-def parse_generate_args():
+def parse_generate_args(argv=None):
     """
     ----------
     Author: Damon Gwinn
     ----------
-    Argparse arguments for generation
+    Argparse arguments for generation. argv defaults to the command line, but a list of arguments
+    can be given to configure generation in-process (see backend_service/engine.py).
     ----------
     """
 
@@ -160,6 +173,13 @@ def parse_generate_args():
     parser.add_argument("-num_prime", type=int, default=256, help="Amount of messages to prime the generator with")
     parser.add_argument("-model_weights", type=str, default="./saved_models/model.pickle", help="Pickled model weights file saved with torch.save and model.state_dict()")
     parser.add_argument("-beam", type=int, default=0, help="Beam search k. 0 for random probability sample and 1 for greedy")
+    parser.add_argument("-length_penalty", type=float, default=0.0, help="Beam search length penalty exponent (0.0 for none, higher favors longer pieces)")
+    parser.add_argument("-prefix_cache_dir", type=str, default=None, help="Folder to persist key/value caches of dataset primers in (reused across runs)")
+    parser.add_argument("-prefix_cache_mb", type=int, default=256, help="Memory budget in MB for cached dataset primer prefixes")
+    parser.add_argument("-window_stride", type=int, default=None, help="Past max_sequence, how many tokens the sliding window moves at a time (defaults to half of max_sequence)")
+    parser.add_argument("--no_kv_cache", action="store_true", help="Re-encode the full sequence every step instead of using cached incremental decoding")
+    parser.add_argument("--quantized", action="store_true", help="model_weights is an int8 checkpoint written by quantize.py (runs on the cpu)")
+    parser.add_argument("-num_samples", type=int, default=1, help="Number of pieces to generate together as one batch (random sampling only)")
 
     parser.add_argument("--rpr", action="store_true", help="Use a modified Transformer for Relative Position Representations")
     parser.add_argument("-max_sequence", type=int, default=2048, help="Maximum midi sequence to consider")
@@ -170,8 +190,16 @@ def parse_generate_args():
     parser.add_argument("-dim_feedforward", type=int, default=1024, help="Dimension of the feedforward layer")
     parser.add_argument("--force_mps", action="store_true", help="Force use of MPS (Apple Silicon GPU)")
 
+    parser.add_argument("-draft_weights", type=str, default=None, help="Weights of a small draft model for speculative decoding (default is no draft model)")
+    parser.add_argument("-num_draft", type=int, default=4, help="Number of tokens the draft model proposes per verification step")
+    parser.add_argument("--draft_rpr", action="store_true", help="Draft model uses Relative Position Representations")
+    parser.add_argument("-draft_n_layers", type=int, default=2, help="Number of decoder layers of the draft model")
+    parser.add_argument("-draft_num_heads", type=int, default=8, help="Number of heads of the draft model")
+    parser.add_argument("-draft_d_model", type=int, default=128, help="Dimension of the draft model")
+    parser.add_argument("-draft_dim_feedforward", type=int, default=512, help="Dimension of the feedforward layer of the draft model")
 
-    return parser.parse_args()
+
+    return parser.parse_args(argv)
 
 # print_generate_args
 def print_generate_args(args):
@@ -193,6 +221,13 @@ def print_generate_args(args):
     print("num_prime:", args.num_prime)
     print("model_weights:", args.model_weights)
     print("beam:", args.beam)
+    print("length_penalty:", args.length_penalty)
+    print("kv_cache:", not args.no_kv_cache)
+    print("window_stride:", args.window_stride)
+    print("prefix_cache_dir:", args.prefix_cache_dir)
+    print("prefix_cache_mb:", args.prefix_cache_mb)
+    print("quantized:", args.quantized)
+    print("num_samples:", args.num_samples)
     print("")
     print("rpr:", args.rpr)
     print("max_sequence:", args.max_sequence)
@@ -202,6 +237,70 @@ def print_generate_args(args):
     print("")
     print("dim_feedforward:", args.dim_feedforward)
     print("force_mps", args.force_mps)
+    print("")
+    print("draft_weights:", args.draft_weights)
+    if(args.draft_weights is not None):
+        print("num_draft:", args.num_draft)
+        print("draft_rpr:", args.draft_rpr)
+        print("draft_n_layers:", args.draft_n_layers)
+        print("draft_num_heads:", args.draft_num_heads)
+        print("draft_d_model:", args.draft_d_model)
+        print("draft_dim_feedforward:", args.draft_dim_feedforward)
+    print(SEPERATOR)
+    print("")
+
+# parse_quantize_args
+def parse_quantize_args():
+    """
+    ----------
+    Argparse arguments for quantizing a model to int8
+    ----------
+    """
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-dataset_dir", type=str, default="./dataset/e_piano", help="Folder of preprocessed and pickled midi files")
+    parser.add_argument("-model_weights", type=str, default="./saved_models/model.pickle", help="Pickled fp32 model weights file saved with torch.save and model.state_dict()")
+    parser.add_argument("-output_weights", type=str, default="./saved_models/model_int8.pickle", help="Where to save the quantized model weights")
+    parser.add_argument("-n_workers", type=int, default=1, help="Number of threads for the dataloader")
+    parser.add_argument("--no_eval", action="store_true", help="Only quantize and save, skip comparing against fp32 on the test split")
+
+    parser.add_argument("-batch_size", type=int, default=2, help="Batch size to use")
+
+    parser.add_argument("--rpr", action="store_true", help="Use a modified Transformer for Relative Position Representations")
+    parser.add_argument("-max_sequence", type=int, default=2048, help="Maximum midi sequence to consider in the model")
+    parser.add_argument("-n_layers", type=int, default=6, help="Number of decoder layers to use")
+    parser.add_argument("-num_heads", type=int, default=8, help="Number of heads to use for multi-head attention")
+    parser.add_argument("-d_model", type=int, default=512, help="Dimension of the model (output dim of embedding layers, etc.)")
+
+    parser.add_argument("-dim_feedforward", type=int, default=1024, help="Dimension of the feedforward layer")
+
+    return parser.parse_args()
+
+# print_quantize_args
+def print_quantize_args(args):
+    """
+    ----------
+    Prints quantization arguments
+    ----------
+    """
+
+    print(SEPERATOR)
+    print("dataset_dir:", args.dataset_dir)
+    print("model_weights:", args.model_weights)
+    print("output_weights:", args.output_weights)
+    print("n_workers:", args.n_workers)
+    print("eval:", not args.no_eval)
+    print("")
+    print("batch_size:", args.batch_size)
+    print("")
+    print("rpr:", args.rpr)
+    print("max_sequence:", args.max_sequence)
+    print("n_layers:", args.n_layers)
+    print("num_heads:", args.num_heads)
+    print("d_model:", args.d_model)
+    print("")
+    print("dim_feedforward:", args.dim_feedforward)
     print(SEPERATOR)
     print("")
 
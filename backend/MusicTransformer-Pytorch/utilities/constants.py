@@ -25,4 +25,11 @@ TORCH_INT               = torch.int32
 
 TORCH_LABEL_TYPE        = torch.long
 
+# Preprocessing manifest in the dataset root (preprocess_midi.py), records every piece's token count
+MANIFEST_FILE           = "manifest.json"
+
+# Packed token shards (preprocess_midi.py --shards), one pair per split folder name in the dataset root
+SHARD_TOKENS_FILE       = "%s_tokens.npy"   # every piece's tokens back to back, uint16
+SHARD_OFFSETS_FILE      = "%s_offsets.npy"  # int64, piece i is tokens[offsets[i]:offsets[i+1]]
+
 PREPEND_ZEROS_WIDTH     = 4
@@ -28,7 +28,9 @@ def train_epoch(cur_epoch, model, dataloader, loss, opt, lr_scheduler=None, prin
         x   = batch[0].to(get_device())
         tgt = batch[1].to(get_device())
 
-        y = model(x)
+        segments = batch[2].to(get_device()) if len(batch) > 2 else None
+
+        y = model(x, segments=segments)
 
         y   = y.reshape(y.shape[0] * y.shape[1], -1)
         tgt = tgt.flatten()
@@ -78,7 +80,9 @@ def eval_model(model, dataloader, loss):
             x   = batch[0].to(get_device())
             tgt = batch[1].to(get_device())
 
-            y = model(x)
+            segments = batch[2].to(get_device()) if len(batch) > 2 else None
+
+            y = model(x, segments=segments)
 
             sum_acc += float(compute_epiano_accuracy(y, tgt))
 
@@ -36,7 +36,9 @@ def train_epoch(cur_epoch, model, dataloader, loss, opt, lr_scheduler=None, prin
         tgt = batch[1].to(device)
         # ----------------------------------------------------
 
-        y = model(x)
+        segments = batch[2].to(device) if len(batch) > 2 else None
+
+        y = model(x, segments=segments)
 
         y   = y.reshape(y.shape[0] * y.shape[1], -1)
         tgt = tgt.flatten()
@@ -95,7 +97,9 @@ def eval_model(model, dataloader, loss, device=None):
             tgt = batch[1].to(device)
             # ----------------------------------------------------
 
-            y = model(x)
+            segments = batch[2].to(device) if len(batch) > 2 else None
+
+            y = model(x, segments=segments)
 
             sum_acc += float(compute_epiano_accuracy(y, tgt))
 
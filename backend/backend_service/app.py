@@ -1,71 +1,121 @@
-import os, uuid, subprocess, shutil, glob
+import os, uuid, subprocess, shutil, tempfile
+from contextlib import contextmanager
 from pathlib import Path
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory, stream_with_context
 from flask_cors import CORS
 
-# --- Paths (match your repo layout) ---
-BASE_DIR   = Path(__file__).resolve().parent
-BACKEND = BASE_DIR.parent
-MT_DIR     = BACKEND / "MusicTransformer-Pytorch"       # where generate.py lives
-LOFI_DIR   = BACKEND/ "LofiFiltering"
-LOFI_OUT   = LOFI_DIR / "lofi_songs"                     # generate_lofi.py writes here
+from paths import BACKEND, MT_DIR, LOFI_DIR, add_import_path
+add_import_path(MT_DIR, LOFI_DIR)
+
+from engine import GenerationEngine
+from streaming import stream_lofi_mp3
+from song_pool import SongPool
+from jobs import JobQueue, DONE
+from generate_lofi import generate_lofi
+from synth import resident_synth
+from piano import resident_piano
+
+# --- Paths (match your repo layout, see paths.py for BACKEND, MT_DIR and LOFI_DIR) ---
 MEDIA_DIR  = BACKEND / "media"                          # public files served to frontend
+POOL_DIR   = MEDIA_DIR / "pool"                         # pre-generated songs waiting to be served
+JOBS_DIR   = MEDIA_DIR / "jobs"                         # results of /api/jobs
+WORK_DIR   = BACKEND / "workspaces"                     # one private folder per in-flight request
 
 MT_SCRIPT  = MT_DIR / "generate.py"
 LOFI_SCRIPT= LOFI_DIR / "generate_lofi.py"
 
 MEDIA_DIR.mkdir(parents=True, exist_ok=True)
-LOFI_OUT.mkdir(parents=True, exist_ok=True)
+WORK_DIR.mkdir(parents=True, exist_ok=True)
 
 app = Flask(__name__)
 CORS(app, resources={r"/api/*": {"origins": "*"}}) # Should explicitly state origins later on for security
 
-def run_music_transformer():
+# generate.py arguments for the model, also used to configure the in-process engine
+MT_ARGS = [
+    "-output_dir", "songs",
+    "-model_weights", "training_output/results/best_loss_weights.pickle",
+    "--rpr",
+    "-max_sequence", "1024",
+    "-d_model", "256",
+    "-n_layers", "6",
+    "-num_heads", "8",
+    "-midi_root", "./preprocessed_data"
+]
+
+# Requests work in separate workspaces, so several can generate at once on a multi-core host
+GEN_CONCURRENCY = 2
+ENGINE = GenerationEngine(MT_ARGS, max_concurrent=GEN_CONCURRENCY)
+
+# SoundFont loaded once, one synth instance per concurrent request (None without pyfluidsynth,
+# then every render starts the fluidsynth command line)
+SYNTH = resident_synth(instances=GEN_CONCURRENCY)
+
+# Whole songs mix cached per-note samples (PianoRenderer) instead of synthesizing every note,
+# samples are kept on disk next to the SoundFont and shared with the worker processes
+SAMPLE_PIANO = True
+RENDERER = resident_piano(SYNTH) if (SYNTH is not None and SAMPLE_PIANO) else SYNTH
+
+# Pre-generated songs: keep SONG_POOL_DEPTH ready, start at most SONG_POOL_REFILL_PER_MIN per minute
+# on SONG_POOL_WORKERS background processes (each loads its own copy of the model)
+SONG_POOL_DEPTH          = 8
+SONG_POOL_REFILL_PER_MIN = 4.0
+SONG_POOL_WORKERS        = 1
+POOL = SongPool(POOL_DIR, MT_ARGS, target_depth=SONG_POOL_DEPTH,
+                refill_per_minute=SONG_POOL_REFILL_PER_MIN, max_workers=SONG_POOL_WORKERS)
+
+# Asynchronous jobs: JOB_WORKERS processes, at most JOB_MAX_PENDING queued or running (more are
+# rejected with 503), each job abandoned JOB_TIMEOUT_S seconds after submission
+JOB_WORKERS     = 1
+JOB_MAX_PENDING = 8
+JOB_TIMEOUT_S   = 600.0
+JOBS = JobQueue(JOBS_DIR, MT_ARGS, max_workers=JOB_WORKERS, max_pending=JOB_MAX_PENDING,
+                job_timeout=JOB_TIMEOUT_S)
+
+DEBUG = True
+
+@contextmanager
+def request_workspace():
     """
-    Runs music transformer script using the specifications for the model.
+    Private folder for one request's intermediate files, removed when the request is done.
     """
-    cmd = [
-        "python3", str(MT_SCRIPT),
-        "-output_dir", "songs",
-        "-model_weights", "training_output/results/best_loss_weights.pickle",
-        "--rpr",
-        "-max_sequence", "1024",
-        "-d_model", "256",
-        "-n_layers", "6",
-        "-num_heads", "8",
-        "-midi_root", "./preprocessed_data"
-    ]
-    subprocess.run(cmd, check=True, cwd=str(MT_DIR)) # check for problems, set current directory to Music Transformer Directory.
+    workdir = Path(tempfile.mkdtemp(prefix="req_", dir=WORK_DIR))
+    try:
+        yield workdir
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
 
-def newest_file(dir_glob: str) -> Path | None:
-    files = glob.glob(dir_glob)
-    if not files:
-        return None
-    files.sort(key=os.path.getmtime)
-    return Path(files[-1])
+def run_music_transformer(midi_out: Path) -> Path:
+    """
+    Generates a MIDI file at midi_out with the resident model (loaded once per process).
+    """
+    return ENGINE.generate_midi(midi_out)
+
+def run_music_transformer_subprocess(workdir: Path) -> Path:
+    """
+    Runs music transformer script using the specifications for the model, writing into workdir.
+    Pays the full model load on every call, kept for debugging the engine against generate.py.
+    """
+    cmd = ["python3", str(MT_SCRIPT)] + MT_ARGS + ["-output_dir", str(workdir)]
+    subprocess.run(cmd, check=True, cwd=str(MT_DIR)) # check for problems, set current directory to Music Transformer Directory.
+    return workdir / "rand.mid"
 
-def run_lofi_filter() -> Path:
+def run_lofi_filter(midi_file: Path, mp3_file: Path, workdir: Path) -> Path:
     """
-    Runs piano pipeline, returns newest available mp3 in the case that it does not return anything.
+    Runs the single-pass piano to lo-fi pipeline on midi_file, writing mp3_file (its PCM pipe lives in workdir).
     """
-    cp = subprocess.run(
-        ["python3", str(LOFI_SCRIPT)],
-        check=True,
-        cwd=str(BASE_DIR),
-        text=True,
-        capture_output=True
-    )
-    # Try to read the last printed line as an absolute mp3 path (your script prints it).
-    last_line = cp.stdout.strip().splitlines()[-1] if cp.stdout.strip().splitlines() else ""
-    candidate = Path(last_line)
-    if candidate.suffix.lower() == ".mp3" and candidate.exists():
-        return candidate
-
-    # Fallback: newest MP3 in lofi_songs
-    mp3 = newest_file(str(LOFI_OUT / "*.mp3"))
-    if not mp3 or not mp3.exists():
+    generate_lofi(midi_file, mp3_file, workdir, synth=RENDERER)
+    if not mp3_file.exists():
         raise RuntimeError("No MP3 produced by lo-fi filter.")
-    return mp3
+    return mp3_file
+
+@app.before_request
+def start_workers():
+    """
+    Starts the song pool and job workers with the first request, so they also run under flask run
+    or a WSGI server, where the __main__ block below never runs. Later calls do nothing.
+    """
+    POOL.start()
+    JOBS.start()
 
 @app.route("/api/generate", methods=["POST"])
 def generate():
@@ -73,16 +123,25 @@ def generate():
     _ = (request.get_json(silent=True) or {}).get("prompt", "")
 
     try:
-        # 1) Generate rand.mid with your MusicTransformer
-        run_music_transformer()
-
-        # 2) Convert to lo-fi MP3
-        mp3_src = run_lofi_filter()
-
-        # 3) Copy into public media as a unique name
         uid = uuid.uuid4().hex
         mp3_dst = MEDIA_DIR / f"{uid}.mp3"
-        shutil.copyfile(mp3_src, mp3_dst)
+
+        # 0) Any finished song satisfies the request, so serve one from the pool if possible
+        pooled = POOL.take()
+        if pooled is not None:
+            os.replace(pooled, mp3_dst)
+            return jsonify({"audioUrl": f"/media/{mp3_dst.name}", "id": uid})
+
+        # Pool is empty: generate live (refilling pauses meanwhile)
+        with POOL.live_request(), request_workspace() as workdir:
+            # 1) Generate a MIDI with your MusicTransformer
+            midi_file = run_music_transformer(workdir / "song.mid")
+
+            # 2) Convert to lo-fi MP3
+            mp3_src = run_lofi_filter(midi_file, workdir / "song.mp3", workdir)
+
+            # 3) Move into public media under its unique name
+            shutil.move(str(mp3_src), str(mp3_dst))
 
         return jsonify({"audioUrl": f"/media/{mp3_dst.name}", "id": uid})
     except subprocess.CalledProcessError as e:
@@ -90,9 +149,79 @@ def generate():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route("/api/generate/stream", methods=["GET", "POST"])
+def generate_stream():
+    """
+    Streams a freshly generated lo-fi song as chunked MP3 while it is being generated, so the
+    client can start playback after the first few seconds of audio instead of the whole pipeline.
+    """
+    #ignoring prompt for now, will adjust if/when needed
+    _ = (request.get_json(silent=True) or {}).get("prompt", "")
+
+    mp3_chunks = stream_lofi_mp3(ENGINE.stream_tokens(), synth=SYNTH)
+    return Response(stream_with_context(mp3_chunks), mimetype="audio/mpeg",
+                    headers={"Cache-Control": "no-cache"})
+
+def job_response(job):
+    body = job.to_dict()
+    body["statusUrl"] = f"/api/jobs/{job.id}"
+    body["resultUrl"] = f"/api/jobs/{job.id}/result" if job.status == DONE else None
+    return body
+
+@app.route("/api/jobs", methods=["POST"])
+def create_job():
+    """
+    Enqueues a song generation job and returns its id right away (poll statusUrl for progress).
+    """
+    #ignoring prompt for now, will adjust if/when needed
+    _ = (request.get_json(silent=True) or {}).get("prompt", "")
+
+    job = JOBS.submit()
+    if job is None:
+        resp = jsonify({"error": "Too many songs in progress, try again shortly"})
+        resp.headers["Retry-After"] = "30"
+        return resp, 503
+
+    resp = jsonify(job_response(job))
+    resp.headers["Location"] = f"/api/jobs/{job.id}"
+    return resp, 202
+
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = JOBS.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job_response(job))
+
+@app.route("/api/jobs/<job_id>/result", methods=["GET"])
+def job_result(job_id):
+    job = JOBS.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    if job.status != DONE:
+        return jsonify(job_response(job)), 409
+    return send_from_directory(JOBS_DIR, JOBS.result_path(job.id).name, as_attachment=False)
+
+@app.route("/api/jobs", methods=["GET"])
+def jobs_stats():
+    return jsonify(JOBS.stats())
+
+@app.route("/api/pool", methods=["GET"])
+def pool_stats():
+    return jsonify(POOL.stats())
+
 @app.route("/media/<path:filename>", methods=["GET"])
 def serve_media(filename):
     return send_from_directory(MEDIA_DIR, filename, as_attachment=False)
 
 if __name__ == "__main__":
-    app.run(host="127.0.0.1", port=5001, debug=True)
+    ENGINE.load() # Pay model and checkpoint loading once at startup instead of on the first request
+    if SYNTH is not None:
+        SYNTH.load() # likewise for the SoundFont
+
+    # With the debug reloader, only the serving child process runs the worker pools
+    if not DEBUG or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        POOL.start()
+        JOBS.start()
+
+    app.run(host="127.0.0.1", port=5001, debug=DEBUG)
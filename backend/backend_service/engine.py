@@ -0,0 +1,132 @@
+import os, random, threading
+from pathlib import Path
+
+from paths import MT_DIR, add_import_path
+add_import_path(MT_DIR)
+
+import torch
+
+from third_party.midi_processor.processor import decode_midi
+from model.music_transformer_patched import MusicTransformer
+from model.quantize import quantize_model
+from model.prefix_cache import PrefixCache, checkpoint_hash
+from dataset.e_piano import create_epiano_datasets
+from utilities.argument_funcs import parse_generate_args
+from utilities.device import get_device, use_cuda
+
+
+class GenerationEngine:
+    """
+    Long-lived MusicTransformer generation engine.
+
+    Configured with the same arguments as generate.py, but the model, weights and primer dataset
+    are loaded once and reused by every request. Every generation keeps its own key/value cache
+    and the model is only read, so up to max_concurrent request threads generate at once.
+    """
+
+    def __init__(self, argv: list[str], max_concurrent: int = 1):
+        self.args = parse_generate_args(argv)
+        self.model = None
+        self.draft = None
+        self.primers = None
+        self.prefix_cache = None
+        self.weights_hash = None
+        self._load_lock = threading.Lock()
+        self._gen_slots = threading.BoundedSemaphore(max_concurrent)
+
+    def _resolve(self, path: str) -> str:
+        # Relative paths in the config are relative to MusicTransformer-Pytorch, as for generate.py
+        return path if os.path.isabs(path) else str(MT_DIR / path)
+
+    def load(self) -> "GenerationEngine":
+        """
+        Builds the model and loads the checkpoint and primer dataset. Safe to call repeatedly.
+        """
+        with self._load_lock:
+            if self.model is not None:
+                return self
+
+            args = self.args
+            # Dynamically quantized weights only run on the cpu
+            if args.force_cpu or args.quantized:
+                use_cuda(False)
+
+            _, _, self.primers = create_epiano_datasets(self._resolve(args.midi_root), args.num_prime, random_seq=False)
+
+            model = MusicTransformer(n_layers=args.n_layers, num_heads=args.num_heads,
+                        d_model=args.d_model, dim_feedforward=args.dim_feedforward,
+                        max_sequence=args.max_sequence, rpr=args.rpr).to(get_device())
+            if args.quantized:
+                model = quantize_model(model)
+            model.load_state_dict(torch.load(self._resolve(args.model_weights), map_location=get_device()))
+            model.eval()
+
+            # Optional draft model for speculative decoding
+            draft = None
+            if args.draft_weights is not None:
+                draft = MusicTransformer(n_layers=args.draft_n_layers, num_heads=args.draft_num_heads,
+                            d_model=args.draft_d_model, dim_feedforward=args.draft_dim_feedforward,
+                            max_sequence=args.max_sequence, rpr=args.draft_rpr).to(get_device())
+                draft.load_state_dict(torch.load(self._resolve(args.draft_weights), map_location=get_device()))
+                draft.eval()
+
+            # Key/value state after each dataset primer, so requests skip the primer prefill
+            cache_dir = None if args.prefix_cache_dir is None else self._resolve(args.prefix_cache_dir)
+            self.prefix_cache = PrefixCache(max_bytes=args.prefix_cache_mb * (1 << 20), cache_dir=cache_dir)
+            self.weights_hash = checkpoint_hash(self._resolve(args.model_weights))
+
+            self.draft = draft
+            self.model = model
+            return self
+
+    def _primer_cache(self, primer_index: int, primer):
+        key = (self.weights_hash, os.path.basename(self.primers.data_files[primer_index]), len(primer))
+        return self.prefix_cache.prime(self.model, primer, key)
+
+    def generate_midi(self, out_path: Path, primer_index: int | None = None, target_seq_length: int | None = None) -> Path:
+        """
+        Generates one piece from a test split primer (random unless given) and writes it as MIDI.
+        """
+        self.load()
+        args = self.args
+
+        if primer_index is None:
+            primer_index = random.randrange(len(self.primers))
+        if target_seq_length is None:
+            target_seq_length = args.target_seq_length
+
+        primer, _ = self.primers[primer_index]
+        primer = primer[:args.num_prime].to(get_device())
+
+        with self._gen_slots, torch.no_grad():
+            # Speculative decoding keeps its own caches for both models
+            cache = self._primer_cache(primer_index, primer) if self.draft is None else None
+            seq = self.model.generate(primer, target_seq_length, beam=0, device=get_device(),
+                                      draft=self.draft, num_draft=args.num_draft, window_stride=args.window_stride,
+                                      cache=cache)
+
+        out_path = Path(out_path)
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        decode_midi(seq[0].cpu().numpy(), file_path=str(out_path))
+        return out_path
+
+    def stream_tokens(self, primer_index: int | None = None, target_seq_length: int | None = None):
+        """
+        Yields the primer tokens followed by each generated token as soon as it is sampled. Holds
+        a generation slot until the stream is exhausted or closed.
+        """
+        self.load()
+        args = self.args
+
+        if primer_index is None:
+            primer_index = random.randrange(len(self.primers))
+        if target_seq_length is None:
+            target_seq_length = args.target_seq_length
+
+        primer, _ = self.primers[primer_index]
+        primer = primer[:args.num_prime].to(get_device())
+
+        yield from primer.tolist()
+        with self._gen_slots, torch.no_grad():
+            cache = self._primer_cache(primer_index, primer)
+            yield from self.model.generate_stream(primer, target_seq_length, window_stride=args.window_stride, cache=cache)
@@ -0,0 +1,263 @@
+import time, uuid, shutil, tempfile, threading, traceback
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from paths import LOFI_DIR, add_import_path
+add_import_path(LOFI_DIR)
+
+from generate_lofi import generate_lofi
+from synth import resident_synth
+from piano import resident_piano
+
+# Job states
+QUEUED   = "queued"
+RUNNING  = "running"
+DONE     = "done"
+FAILED   = "failed"
+EXPIRED  = "expired"
+
+FINISHED = (DONE, FAILED, EXPIRED)
+
+PROGRESS_EVERY = 16 # tokens between generation progress updates
+
+# Set in each worker process by _init_worker
+_WORKER_ENGINE = None
+_WORKER_RENDERER = None
+_PROGRESS = None
+
+
+class JobExpired(Exception):
+    pass
+
+
+@dataclass
+class Job:
+    id: str
+    deadline: float
+    status: str = QUEUED
+    stage: str = "queued"
+    progress: float = 0.0
+    error: str | None = None
+    created: float = field(default_factory=time.time)
+    finished: float | None = None
+
+    def to_dict(self) -> dict:
+        return {"id": self.id, "status": self.status, "stage": self.stage,
+                "progress": round(self.progress, 3), "error": self.error,
+                "secondsLeft": max(0.0, round(self.deadline - time.time(), 1))}
+
+
+def _init_worker(mt_args: list[str], progress_queue):
+    """
+    Loads a resident generation engine and piano renderer (if available) once per worker process.
+    """
+    global _WORKER_ENGINE, _WORKER_RENDERER, _PROGRESS
+    from engine import GenerationEngine
+    _WORKER_ENGINE = GenerationEngine(mt_args).load()
+    synth = resident_synth()
+    _WORKER_RENDERER = resident_piano(synth.load()) if synth is not None else None
+    _PROGRESS = progress_queue
+
+
+def _run_job(job_id: str, mp3_file: str, deadline: float) -> str:
+    """
+    Runs the transformer, render and encode stages of one job in a worker process, reporting
+    (job_id, stage, progress) on the progress queue. Gives up with JobExpired once the deadline
+    passes, checked at every token and between stages.
+    """
+    from third_party.midi_processor.processor import decode_midi
+
+    def report(stage, progress):
+        if time.time() > deadline:
+            raise JobExpired(f"deadline passed during {stage}")
+        _PROGRESS.put((job_id, stage, progress))
+
+    if time.time() > deadline:
+        raise JobExpired("deadline passed while queued")
+
+    engine = _WORKER_ENGINE
+    target = engine.args.target_seq_length
+    workdir = Path(tempfile.mkdtemp(prefix=f"job_{job_id}_"))
+    try:
+        report("generate", 0.0)
+
+        tokens = []
+        stream = engine.stream_tokens()
+        try:
+            for token in stream:
+                tokens.append(token)
+                if len(tokens) % PROGRESS_EVERY == 0:
+                    report("generate", min(len(tokens) / target, 1.0) * 0.8)
+        finally:
+            stream.close() # releases the engine lock if we stopped early
+
+        midi_file = workdir / "song.mid"
+        decode_midi(tokens, file_path=str(midi_file))
+
+        tmp_mp3 = workdir / "song.mp3"
+        stage_progress = {"render": 0.8, "encode": 0.95}
+        generate_lofi(midi_file, tmp_mp3, workdir, on_stage=lambda stage: report(stage, stage_progress[stage]),
+                      synth=_WORKER_RENDERER)
+
+        shutil.move(str(tmp_mp3), mp3_file)
+        return mp3_file
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+class JobQueue:
+    """
+    Asynchronous song generation jobs on a bounded pool of worker processes.
+
+    submit() admits a job only while fewer than max_pending jobs are queued or running and
+    returns None otherwise, so overload is rejected immediately instead of timing out. Every job
+    has a deadline job_timeout seconds after submission: jobs still queued at the deadline are
+    dropped and running jobs stop at their next checkpoint. Workers report their stage and
+    progress back through a queue. Finished jobs and their MP3s are kept for retention seconds.
+    """
+
+    def __init__(self, result_dir: Path, mt_args: list[str], max_workers: int = 1,
+                 max_pending: int = 8, job_timeout: float = 600.0, retention: float = 3600.0):
+        self.result_dir = Path(result_dir)
+        self.mt_args = list(mt_args)
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.job_timeout = job_timeout
+        self.retention = retention
+
+        self.result_dir.mkdir(parents=True, exist_ok=True)
+
+        self._jobs: dict[str, Job] = {}
+        self._lock = threading.Lock()
+        self._ctx = mp.get_context("spawn") # workers must not inherit the parent's torch / flask threads
+        self._progress = self._ctx.Queue()
+        self._executor = None
+        self._listener = None
+
+    def start(self) -> "JobQueue":
+        """
+        Starts the worker processes and the progress listener. Does nothing if already started,
+        and submit() calls it, so jobs also run when app.py is served by a WSGI host.
+        """
+        with self._lock:
+            if self._executor is not None:
+                return self
+
+            self._executor = self._new_executor()
+            self._listener = threading.Thread(target=self._listen, name="job-progress", daemon=True)
+            self._listener.start()
+        return self
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        self._progress.put(None)
+        if self._listener is not None:
+            self._listener.join()
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=self._ctx,
+                                   initializer=_init_worker, initargs=(self.mt_args, self._progress))
+
+    def result_path(self, job_id: str) -> Path:
+        return self.result_dir / f"{job_id}.mp3"
+
+    def submit(self) -> Job | None:
+        """
+        Enqueues a new job, or returns None when the queue is full. A job that cannot be handed
+        to the workers is returned already failed.
+        """
+        self.start()
+        self._prune()
+        with self._lock:
+            pending = sum(1 for j in self._jobs.values() if j.status not in FINISHED)
+            if pending >= self.max_pending:
+                return None
+
+            job = Job(id=uuid.uuid4().hex, deadline=time.time() + self.job_timeout)
+            self._jobs[job.id] = job
+
+            # Submitted under the lock, so concurrent submits never race on a pool being replaced
+            try:
+                future = self._executor.submit(_run_job, job.id, str(self.result_path(job.id)), job.deadline)
+            except BrokenProcessPool:
+                # A worker died (e.g. out of memory): replace the pool once and retry
+                self._executor.shutdown(wait=False)
+                self._executor = self._new_executor()
+                try:
+                    future = self._executor.submit(_run_job, job.id, str(self.result_path(job.id)), job.deadline)
+                except Exception as e:
+                    traceback.print_exc()
+                    self._finish(job, FAILED, str(e) or type(e).__name__)
+                    return job
+
+        # Outside the lock: a future that is already done runs _on_done right away
+        future.add_done_callback(lambda f, job_id=job.id: self._on_done(job_id, f))
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            # Queued jobs whose deadline passed are reported as expired right away
+            if job is not None and job.status == QUEUED and time.time() > job.deadline:
+                self._finish(job, EXPIRED, "deadline passed while queued")
+            return job
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return {"jobs": counts, "max_pending": self.max_pending, "workers": self.max_workers}
+
+    def _listen(self):
+        while True:
+            msg = self._progress.get()
+            if msg is None:
+                break
+
+            job_id, stage, progress = msg
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is not None and job.status not in FINISHED:
+                    job.status = RUNNING
+                    job.stage = stage
+                    job.progress = progress
+
+    def _on_done(self, job_id: str, future):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status in FINISHED:
+                return
+
+            try:
+                future.result()
+                job.progress = 1.0
+                self._finish(job, DONE)
+            except JobExpired as e:
+                self._finish(job, EXPIRED, str(e))
+            except Exception as e:
+                traceback.print_exc()
+                self._finish(job, FAILED, str(e) or type(e).__name__)
+
+    def _finish(self, job: Job, status: str, error: str | None = None):
+        job.status = status
+        job.stage = status
+        job.error = error
+        job.finished = time.time()
+
+    def _prune(self):
+        """
+        Forgets jobs (and deletes results) that finished more than retention seconds ago.
+        """
+        cutoff = time.time() - self.retention
+        with self._lock:
+            old = [j.id for j in self._jobs.values() if j.finished is not None and j.finished < cutoff]
+            for job_id in old:
+                del self._jobs[job_id]
+
+        for job_id in old:
+            self.result_path(job_id).unlink(missing_ok=True)
@@ -0,0 +1,17 @@
+import sys
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent
+BACKEND  = BASE_DIR.parent
+MT_DIR   = BACKEND / "MusicTransformer-Pytorch" # model, utilities, dataset, third_party
+LOFI_DIR = BACKEND / "LofiFiltering"            # generate_lofi, lofi_dsp, synth, piano
+
+
+def add_import_path(*dirs: Path):
+    """
+    Makes the modules of the given folders importable (MusicTransformer-Pytorch and LofiFiltering
+    are not packages, their modules import each other relative to their own folder).
+    """
+    for d in dirs:
+        if str(d) not in sys.path:
+            sys.path.insert(0, str(d))
@@ -0,0 +1,183 @@
+import os, time, uuid, shutil, tempfile, threading, traceback
+import multiprocessing as mp
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from pathlib import Path
+
+from paths import LOFI_DIR, add_import_path
+add_import_path(LOFI_DIR)
+
+from generate_lofi import generate_lofi
+from synth import resident_synth
+from piano import resident_piano
+
+# Set in each worker process by _init_worker
+_WORKER_ENGINE = None
+_WORKER_RENDERER = None
+
+
+def _init_worker(mt_args: list[str]):
+    """
+    Loads a resident generation engine and piano renderer (if available) once per worker process.
+    """
+    global _WORKER_ENGINE, _WORKER_RENDERER
+    from engine import GenerationEngine
+    _WORKER_ENGINE = GenerationEngine(mt_args).load()
+    synth = resident_synth()
+    _WORKER_RENDERER = resident_piano(synth.load()) if synth is not None else None
+
+
+def _produce_song(out_dir: str) -> str:
+    """
+    Generates one song in a worker process and returns the path of its MP3 in out_dir.
+
+    Everything is written under a private temp folder and the finished MP3 is renamed into
+    out_dir, so the pool never sees partial files and workers never share paths.
+    """
+    workdir = Path(tempfile.mkdtemp(prefix="song_pool_"))
+    try:
+        midi_file = workdir / "song.mid"
+        tmp_mp3 = workdir / "song.mp3"
+
+        _WORKER_ENGINE.generate_midi(midi_file)
+        generate_lofi(midi_file, tmp_mp3, workdir, synth=_WORKER_RENDERER)
+
+        mp3_file = Path(out_dir) / f"{uuid.uuid4().hex}.mp3"
+        shutil.move(str(tmp_mp3), str(mp3_file))
+        return str(mp3_file)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+class SongPool:
+    """
+    Pool of finished lo-fi MP3s kept topped up in the background.
+
+    A refill thread keeps target_depth songs ready (counting those in progress), starting at most
+    refill_per_minute new songs per minute, on at most max_workers worker processes that each
+    hold their own copy of the model. Refilling only starts new songs while no request is being
+    generated live (see live_request). take() pops a finished song in O(1).
+
+    Songs left in pool_dir are picked up again on start, so the pool survives restarts.
+    """
+
+    def __init__(self, pool_dir: Path, mt_args: list[str], target_depth: int = 8,
+                 refill_per_minute: float = 4.0, max_workers: int = 1):
+        self.pool_dir = Path(pool_dir)
+        self.mt_args = list(mt_args)
+        self.target_depth = target_depth
+        self.refill_interval = 60.0 / refill_per_minute
+        self.max_workers = max_workers
+
+        self.pool_dir.mkdir(parents=True, exist_ok=True)
+
+        self._ready: deque[Path] = deque()
+        self._in_flight = 0
+        self._live = 0
+        self._errors = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._executor = None
+        self._thread = None
+
+    def start(self) -> "SongPool":
+        """
+        Recovers songs left in pool_dir and starts the worker processes and refill thread. Does
+        nothing if already started, so it may be called from every request.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return self
+
+            for mp3 in sorted(self.pool_dir.glob("*.mp3"), key=os.path.getmtime):
+                self._ready.append(mp3)
+
+            self._executor = self._new_executor()
+            self._thread = threading.Thread(target=self._refill_loop, name="song-pool-refill", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        # spawn: workers must not inherit the parent's torch / flask threads
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=mp.get_context("spawn"),
+                                   initializer=_init_worker, initargs=(self.mt_args,))
+
+    def take(self) -> Path | None:
+        """
+        Returns a finished song, or None if the pool is empty.
+        """
+        try:
+            mp3 = self._ready.popleft()
+        except IndexError:
+            return None
+        self._wake.set()
+        return mp3
+
+    @contextmanager
+    def live_request(self):
+        """
+        Marks a song being generated on the request path, which pauses refilling.
+        """
+        with self._lock:
+            self._live += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._live -= 1
+            self._wake.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"ready": len(self._ready), "in_flight": self._in_flight,
+                    "live": self._live, "errors": self._errors, "target_depth": self.target_depth}
+
+    def _refill_loop(self):
+        last_start = float("-inf")
+        while not self._stop.is_set():
+            with self._lock:
+                wanted = self.target_depth - len(self._ready) - self._in_flight
+                can_start = (wanted > 0 and self._live == 0 and self._in_flight < self.max_workers)
+
+            wait = self.refill_interval - (time.monotonic() - last_start)
+            if can_start and wait <= 0:
+                last_start = time.monotonic()
+                with self._lock:
+                    self._in_flight += 1
+                try:
+                    future = self._executor.submit(_produce_song, str(self.pool_dir))
+                except BrokenProcessPool:
+                    # A worker died (e.g. out of memory): replace the pool and retry at the next slot
+                    with self._lock:
+                        self._in_flight -= 1
+                        self._errors += 1
+                    self._executor.shutdown(wait=False)
+                    self._executor = self._new_executor()
+                    continue
+                future.add_done_callback(self._on_done)
+                continue
+
+            # Woken by take(), finished songs and live requests ending
+            self._wake.wait(timeout=max(wait, 0.0) if can_start else None)
+            self._wake.clear()
+
+    def _on_done(self, future):
+        with self._lock:
+            self._in_flight -= 1
+            try:
+                self._ready.append(Path(future.result()))
+            except Exception:
+                self._errors += 1
+                traceback.print_exc()
+        self._wake.set()
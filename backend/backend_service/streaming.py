@@ -0,0 +1,192 @@
+import os, queue, shutil, subprocess, tempfile, threading
+from contextlib import ExitStack
+from pathlib import Path
+
+from paths import MT_DIR, LOFI_DIR, add_import_path
+add_import_path(MT_DIR, LOFI_DIR)
+
+import pretty_midi
+from third_party.midi_processor.processor import StreamingDecoder
+
+from generate_lofi import SOUNDFONT_PATH, MP3_QUALITY, LOFI_RATE
+from lofi_dsp import LofiFilter
+
+SAMPLE_RATE     = 44100
+CHANNELS        = 2
+SAMPLE_BYTES    = 2             # s16le
+CHUNK_SECONDS   = 4.0           # audio rendered per chunk
+PREROLL_SECONDS = 2.0           # re-rendered before each chunk so notes carry across boundaries (at least)
+TAIL_SECONDS    = 1.0           # release after the last note
+
+
+def render_window(notes: list[pretty_midi.Note], t0: float, t1: float, workdir: Path) -> bytes:
+    """
+    Renders the [t0, t1) seconds of the given notes to raw s16le PCM with FluidSynth.
+
+    The window is rendered with a preroll so notes that started before t0 enter the chunk already
+    sounding; the preroll audio is then dropped. The preroll is PREROLL_SECONDS, or longer to
+    reach back to the start of the earliest note still held at t0, so no note is retriggered.
+
+    This is the fallback for when there is no resident synth: every chunk starts fluidsynth and
+    loads the SoundFont again, and a long held note makes every chunk it spans render from its
+    start.
+    """
+    held_starts = [n.start for n in notes if n.start < t0 < n.end]
+    start = max(0.0, min([t0 - PREROLL_SECONDS] + held_starts))
+
+    mid = pretty_midi.PrettyMIDI()
+    inst = pretty_midi.Instrument(1, False, "Developed By Yang-Kichang")
+    for n in notes:
+        n_start = max(n.start, start)
+        n_end = min(n.end, t1)
+        if n_end > n_start:
+            inst.notes.append(pretty_midi.Note(n.velocity, n.pitch, n_start - start, n_end - start))
+    mid.instruments.append(inst)
+
+    frame_bytes = CHANNELS * SAMPLE_BYTES
+    skip = int(round((t0 - start) * SAMPLE_RATE)) * frame_bytes
+    size = int(round((t1 - t0) * SAMPLE_RATE)) * frame_bytes
+
+    if not inst.notes:
+        return bytes(size)
+
+    mid_file = workdir / "window.mid"
+    raw_file = workdir / "window.raw"
+    mid.write(str(mid_file))
+    subprocess.run([
+        "fluidsynth", "-ni",
+        "-F", str(raw_file),
+        "-T", "raw",
+        "-r", str(SAMPLE_RATE),
+        str(SOUNDFONT_PATH),
+        str(mid_file)
+    ], check=True, capture_output=True)
+
+    pcm = raw_file.read_bytes()[skip:skip + size]
+    return pcm + bytes(size - len(pcm))
+
+
+def stream_lofi_mp3(tokens, chunk_seconds: float = CHUNK_SECONDS, effects: dict | None = None, synth=None):
+    """
+    Turns a token stream into a lo-fi MP3 byte stream.
+
+    Tokens are decoded incrementally; every time the decoded timeline passes the end of the next
+    chunk, that chunk is rendered, run through the lo-fi chain (LofiFilter, with any extra
+    effects given) and piped into a single long-lived ffmpeg process that encodes MP3 to stdout.
+    Yields MP3 bytes as ffmpeg produces them, so playback can start after the first chunk instead
+    of after the whole pipeline.
+
+    Chunks are rendered by one instance of the resident synth (a SynthPool) if given, playing
+    the notes as one continuous performance; otherwise each chunk runs fluidsynth on its own
+    (see render_window).
+    """
+    lofi = LofiFilter(SAMPLE_RATE, CHANNELS, LOFI_RATE, **(effects or {}))
+    encoder = subprocess.Popen([
+        "ffmpeg", "-loglevel", "error",
+        "-f", "s16le", "-ar", str(LOFI_RATE), "-ac", str(CHANNELS), "-i", "pipe:0",
+        "-codec:a", "libmp3lame",
+        "-qscale:a", MP3_QUALITY,
+        "-flush_packets", "1",
+        "-f", "mp3", "pipe:1"
+    ], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    out_q: queue.Queue = queue.Queue()
+    stop = threading.Event()
+    errors: list[Exception] = []
+    workdir = Path(tempfile.mkdtemp(prefix="lofi_stream_"))
+
+    def read_mp3():
+        while True:
+            data = os.read(encoder.stdout.fileno(), 65536)
+            if not data:
+                break
+            out_q.put(data)
+        out_q.put(None)
+
+    def produce_pcm():
+        decoder = StreamingDecoder()
+        notes: list[pretty_midi.Note] = []
+        started: set[tuple[int, float]] = set() # (pitch, start) of notes already on the resident synth
+        t0 = 0.0
+        session = None
+
+        def add_notes(finished):
+            nonlocal notes
+            if session is None:
+                notes += finished
+                return
+            for n in finished:
+                if (n.pitch, n.start) in started:
+                    started.discard((n.pitch, n.start))
+                else:
+                    session.note_on(n.start, n.pitch, n.velocity)
+                session.note_off(n.end, n.pitch)
+
+        def render(t1):
+            if session is None:
+                return render_window(notes + decoder.held_notes(end=t1), t0, t1, workdir)
+            # The resident synth carries sounding notes across chunks, so it only needs the
+            # note_on of notes still held at t1
+            for n in decoder.held_notes(end=t1):
+                if (n.pitch, n.start) not in started:
+                    session.note_on(n.start, n.pitch, n.velocity)
+                    started.add((n.pitch, n.start))
+            return session.render_until(t1)
+
+        def flush_until(t_end):
+            nonlocal t0, notes
+            while t0 + chunk_seconds <= t_end and not stop.is_set():
+                t1 = t0 + chunk_seconds
+                encoder.stdin.write(lofi.process(render(t1)))
+                encoder.stdin.flush()
+                t0 = t1
+                # Notes that ended before the next preroll are no longer needed (held ones are kept)
+                notes = [n for n in notes if n.end > t0 - PREROLL_SECONDS]
+
+        try:
+            with ExitStack() as stack:
+                if synth is not None:
+                    session = stack.enter_context(synth.session())
+                    session.program(0, 1) # Instrument(1), as in decode_midi and render_window
+
+                for token in tokens:
+                    if stop.is_set():
+                        break
+                    add_notes(decoder.push(token))
+                    flush_until(decoder.time)
+
+                last_end = max([decoder.time] + [n.end for n in notes])
+                flush_until(last_end + TAIL_SECONDS + chunk_seconds)
+                encoder.stdin.write(lofi.flush())
+        except Exception as e:
+            errors.append(e)
+        finally:
+            try:
+                encoder.stdin.close()
+            except BrokenPipeError:
+                pass
+            close = getattr(tokens, "close", None)
+            if close is not None:
+                close()
+
+    reader = threading.Thread(target=read_mp3, daemon=True)
+    producer = threading.Thread(target=produce_pcm, daemon=True)
+    reader.start()
+    producer.start()
+
+    try:
+        while True:
+            data = out_q.get()
+            if data is None:
+                break
+            yield data
+        if errors:
+            raise errors[0]
+    finally:
+        # Client went away or we finished: stop generating and reap ffmpeg
+        stop.set()
+        if encoder.poll() is None:
+            encoder.kill()
+        producer.join()
+        encoder.wait()
+        shutil.rmtree(workdir, ignore_errors=True)